@@ -1,11 +1,18 @@
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.websockets import WebSocketState
+from contextlib import asynccontextmanager
+import asyncio
 import torch
 import shutil
 import os
 import csv
+import tempfile
 from pathlib import Path
+from typing import Optional
 import time
+import json
 import warnings
 import logging
 
@@ -16,11 +23,31 @@ warnings.filterwarnings("ignore", category=FutureWarning)
 # Suppress transformers logits_processor warnings (they use logging, not warnings)
 logging.getLogger("transformers.generation.utils").setLevel(logging.ERROR)
 
-# Now import librosa after suppression is set
-import librosa
 from transformers import WhisperProcessor, WhisperForConditionalGeneration
 
-app = FastAPI()
+import numpy as np
+
+import preprocess
+from batching import MicroBatcher, pad_and_stack
+from inference_pool import ExecutorBusy, InferenceExecutor
+from long_form import generate_long_form
+from quantization import quantize_model
+from shared_weights import (
+    export_weights, load_shared_model, shared_weights_path, worker_report
+)
+from streaming import StreamingConfig, StreamingSession
+from transcription_cache import TranscriptionCache, make_key, model_revision
+
+@asynccontextmanager
+async def lifespan(app):
+    # warm up in the background so the worker answers health checks meanwhile; /ready
+    # reports when it is done
+    warmup_task = asyncio.create_task(warm_up())
+    yield
+    warmup_task.cancel()
+    executor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS configuration
 app.add_middleware(
@@ -35,78 +62,415 @@ app.add_middleware(
 device = "cuda" if torch.cuda.is_available() else "cpu"
 model_dir = "whisper-hmong-finetuned"
 
+# QUANTIZE=int8 runs the linear layers with int8 weights; CPU only
+quantize = os.environ.get("QUANTIZE") or None
+if quantize and device != "cpu":
+    print(f"WARNING: QUANTIZE={quantize} is only supported on CPU; ignoring it.")
+    quantize = None
+
+# API_WORKERS > 1 serves from several processes; they memory-map one copy of the weights
+# from SHARED_WEIGHTS_DIR instead of each loading their own (set it empty to opt out)
+api_workers = int(os.environ.get("API_WORKERS", 1))
+shared_weights_dir = os.environ.get(
+    "SHARED_WEIGHTS_DIR", "/dev/shm" if api_workers > 1 and os.path.isdir("/dev/shm") else ""
+)
+if shared_weights_dir and device != "cpu":
+    # weights are copied to the GPU anyway
+    shared_weights_dir = ""
+if shared_weights_dir and quantize:
+    print(
+        f"WARNING: QUANTIZE={quantize} gives each worker a private quantized copy of the "
+        "linear layers; only the remaining weights are shared through SHARED_WEIGHTS_DIR."
+    )
+load_seconds = None
+model = None
+
+# TORCH_COMPILE=1 compiles the encoder and decoder; the compilation happens during warmup
+torch_compile = os.environ.get("TORCH_COMPILE", "0") == "1"
+
+# Batch sizes run through the model at startup, so that the first real requests don't pay
+# for kernel selection, allocator growth and compilation
+WARMUP_BATCH_SIZES = [
+    int(size) for size in os.environ.get("WARMUP_BATCH_SIZES", "1,2,4,8").split(",") if size.strip()
+]
+WARMUP_NEW_TOKENS = 8
+warmup = {"ready": False, "seconds": None, "batches": {}}
+
 # Check if model exists
-if not os.path.exists(model_dir):
+# (preprocessing workers spawned by the executor re-import this file as __mp_main__
+# when it is run as a script; they must not load the model)
+if __name__ == "__mp_main__":
+    pass
+elif not os.path.exists(model_dir):
     print(f"WARNING: Model directory '{model_dir}' not found.")
+elif __name__ == "__main__" and api_workers > 1:
+    # `python api.py` with several workers only starts them: they import this module as
+    # "api" and load the model themselves, so the master just writes the weights file they
+    # map rather than keeping a model of its own
+    if shared_weights_dir:
+        try:
+            export_weights(model_dir, shared_weights_path(model_dir, shared_weights_dir))
+        except Exception as e:
+            print(f"Error exporting shared weights: {e}")
 else:
     print(f"Loading model from {model_dir} on {device}...")
     try:
+        started = time.perf_counter()
         processor = WhisperProcessor.from_pretrained(model_dir)
-        model = WhisperForConditionalGeneration.from_pretrained(model_dir)
+        if shared_weights_dir:
+            model = load_shared_model(model_dir, shared_weights_dir)
+        else:
+            model = WhisperForConditionalGeneration.from_pretrained(model_dir)
         model.to(device)
-        print("Model loaded successfully.")
+        model = quantize_model(model, quantize)
+        if torch_compile:
+            model.model.encoder.compile()
+            # the decoder sees a longer key/value cache at every step
+            model.model.decoder.compile(dynamic=True)
+        load_seconds = time.perf_counter() - started
+        print("Model loaded successfully." + (f" ({quantize})" if quantize else ""))
+        report = worker_report(load_seconds)
+        print(
+            f"Worker {report['pid']}: loaded in {report['load_seconds']:.2f}s, "
+            f"RSS {report['rss_mib']:.0f} MiB ({report['shared_mib']:.0f} MiB shared, "
+            f"{report['private_mib']:.0f} MiB private)"
+        )
     except Exception as e:
         print(f"Error loading model: {e}")
 
+def generate_batch(features, **generate_kwargs):
+    """Run one padded generate call over a batch of log-mel features"""
+    input_features = torch.from_numpy(pad_and_stack(features)).to(device)
+    
+    # Create attention mask (all 1s for non-padded input)
+    attention_mask = torch.ones(input_features.shape[:-1], dtype=torch.long, device=device)
+    
+    # Generate transcription with attention mask to avoid warning
+    # Suppress logits processor warnings
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message=".*logits_processor.*")
+        predicted_ids = model.generate(
+            input_features,
+            attention_mask=attention_mask,
+            **generate_kwargs
+        )
+    
+    return processor.batch_decode(
+        predicted_ids, 
+        skip_special_tokens=True
+    )
+
+def generate_streaming(features, prompt):
+    """Decode one live streaming window, conditioned on the text committed before it"""
+    input_features = torch.from_numpy(features[None]).to(device)
+    kwargs = {}
+    if prompt:
+        kwargs["prompt_ids"] = processor.get_prompt_ids(prompt, return_tensors="pt").to(device)
+    
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message=".*logits_processor.*")
+        predicted_ids = model.generate(input_features, **kwargs)
+    
+    return processor.batch_decode(predicted_ids, skip_special_tokens=True)[0].strip()
+
+# Torch calls run on a thread pool and audio decoding on a process pool, so the event loop
+# keeps serving health checks and uploads while long transcriptions run
+executor = InferenceExecutor(
+    inference_workers=int(os.environ.get("INFERENCE_WORKERS", 1)),
+    cpu_workers=int(os.environ.get("PREPROCESS_WORKERS", 0)) or None,
+    max_pending=int(os.environ.get("MAX_PENDING_REQUESTS", 32)),
+    retry_after=int(os.environ.get("RETRY_AFTER_SECONDS", 1)),
+    cpu_initializer=preprocess.init_worker,
+    cpu_initargs=(model_dir,),
+)
+
+# Transcriptions keyed by decoded audio + model revision, so resubmitted recordings skip
+# the encoder and decoder entirely
+cache = TranscriptionCache(
+    max_memory_bytes=int(os.environ.get("CACHE_MAX_MEMORY_BYTES", 64 * 1024 * 1024)),
+    db_path=os.environ.get("CACHE_DB_PATH") or None,
+    max_disk_bytes=int(os.environ.get("CACHE_MAX_DISK_BYTES", 1024 * 1024 * 1024)),
+)
+cache_revision = model_revision(model_dir) if os.path.isdir(model_dir) else None
+TRANSCRIBE_OPTIONS = {"task": "transcribe"}
+LONG_FORM_OPTIONS = {"task": "transcribe", "long_form": True}
+if quantize:
+    # quantized outputs can differ slightly, so they are cached apart from float32 ones
+    TRANSCRIBE_OPTIONS["quantize"] = LONG_FORM_OPTIONS["quantize"] = quantize
+
+# Recordings longer than 30 s are transcribed window by window, this many windows per
+# generate call
+LONG_FORM_BATCH_SIZE = int(os.environ.get("LONG_FORM_BATCH_SIZE", 8))
+
+# Uploads up to this size are decoded in memory; larger ones are spilled to a temp file
+UPLOAD_SPILL_BYTES = int(os.environ.get("UPLOAD_SPILL_BYTES", 16 * 1024 * 1024))
+
+# Requests arriving within the wait window are decoded together in one generate call
+batcher = MicroBatcher(
+    generate_batch,
+    max_batch_size=int(os.environ.get("TRANSCRIBE_MAX_BATCH_SIZE", 8)),
+    max_wait_ms=float(os.environ.get("TRANSCRIBE_MAX_WAIT_MS", 10)),
+    executor=executor.inference_pool,
+)
+
+# Live transcription over WebSocket; each stream holds at most one 30-second window of audio
+MAX_STREAMS = int(os.environ.get("MAX_STREAMS", 8))
+STREAM_DECODE_INTERVAL = float(os.environ.get("STREAM_DECODE_INTERVAL", 1.0))
+active_streams = 0
+
+def warm_up_batch(batch_size):
+    """Transcribe a batch of silent windows, decoding a few tokens each"""
+    # the encoder's stride-2 convolution maps the 3000 input frames to its 1500 positions
+    n_frames = 2 * model.config.max_source_positions
+    silence = np.zeros((model.config.num_mel_bins, n_frames), dtype=np.float32)
+    generate_batch([silence] * batch_size, max_new_tokens=WARMUP_NEW_TOKENS)
+
+async def warm_up():
+    """Run every warmup batch size through the inference thread, then start the
+    preprocessing workers and load their feature extractors"""
+    if model is None:
+        return
+    started = time.perf_counter()
+    try:
+        for batch_size in WARMUP_BATCH_SIZES:
+            batch_started = time.perf_counter()
+            await executor.run_inference(warm_up_batch, batch_size)
+            warmup["batches"][batch_size] = round(time.perf_counter() - batch_started, 3)
+        
+        silence = np.zeros(preprocess.SAMPLE_RATE, dtype=np.float32)
+        await asyncio.gather(*(
+            executor.run_cpu(preprocess.extract_window_features, silence)
+            for _ in range(executor.cpu_workers)
+        ))
+    except Exception as e:
+        # stay unready: a model that can't run the warmup can't serve requests either
+        print(f"Error during warmup: {e}")
+        return
+    
+    warmup["seconds"] = round(time.perf_counter() - started, 3)
+    warmup["ready"] = True
+    print(f"Warmup done in {warmup['seconds']:.2f}s: {warmup['batches']}")
+
 @app.get("/")
 def read_root():
-    return {"status": "online", "model": model_dir, "device": device}
+    return {"status": "online", "model": model_dir, "device": device, "quantize": quantize}
+
+@app.get("/ready")
+def ready():
+    """
+    Readiness probe: 200 once the model is loaded and warmed up, 503 before. Route traffic
+    on this rather than on GET /, which answers as soon as the server is up.
+    """
+    if model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    if not warmup["ready"]:
+        raise HTTPException(status_code=503, detail="Warming up", headers={"Retry-After": "1"})
+    return {"ready": True, "compiled": torch_compile, "warmup": warmup}
 
 @app.post("/transcribe")
-async def transcribe(file: UploadFile = File(...)):
+async def transcribe(
+    file: UploadFile = File(...),
+    long_form: Optional[bool] = Form(None)
+):
     """
     Upload an audio file and transcribe it using the loaded Whisper model.
+    Recordings longer than 30 seconds (or any recording, with long_form=true) are
+    transcribed in 30-second windows and also return timestamped "segments".
+    Returns 503 with a Retry-After header when too many requests are already in progress.
     """
+    try:
+        with executor.admit():
+            return await transcribe_upload(file, long_form)
+    except ExecutorBusy as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+async def transcribe_upload(file: UploadFile, long_form: Optional[bool] = None):
     filename = file.filename
-    temp_filename = f"temp_{filename}"
+    spill_filename = None
     
     try:
-        # Save uploaded file temporarily
-        with open(temp_filename, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Load and process audio
-        # Whisper expects 16kHz audio
-        audio, sr = librosa.load(temp_filename, sr=16000)
+        if upload_size(file) <= UPLOAD_SPILL_BYTES:
+            # Decode straight from memory in a worker process
+            data = await file.read()
+            features, durations, audio_digest = await executor.run_cpu(
+                preprocess.decode_features, data
+            )
+        else:
+            # Large uploads are spilled to a uniquely named temp file instead of being
+            # shipped to the worker process in one piece
+            spill_filename = await run_in_threadpool(spill_upload, file)
+            features, durations, audio_digest = await executor.run_cpu(
+                preprocess.load_features, spill_filename
+            )
         
-        # Process audio and get input features
-        inputs = processor(
-            audio, 
-            sampling_rate=16000, 
-            return_tensors="pt"
-        )
-        input_features = inputs.input_features.to(device)
+        if long_form is None:
+            long_form = len(features) > 1
         
-        # Create attention mask (all 1s for non-padded input)
-        attention_mask = torch.ones(input_features.shape[:-1], dtype=torch.long, device=device)
+        # cache lookups run in a thread, as the disk tier reads and commits to SQLite
+        if long_form:
+            key = make_key(audio_digest, cache_revision, LONG_FORM_OPTIONS)
+            result = await run_in_threadpool(cache.get, key)
+            cached = result is not None
+            
+            if not cached:
+                segments = await executor.run_inference(
+                    generate_long_form, model, processor, features, durations,
+                    LONG_FORM_BATCH_SIZE
+                )
+                result = {
+                    "transcription": " ".join(segment["text"] for segment in segments),
+                    "segments": segments
+                }
+                await run_in_threadpool(cache.put, key, result)
+            
+            return {"filename": filename, **result, "cached": cached}
         
-        # Generate transcription with attention mask to avoid warning
-        # Suppress logits processor warnings
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", message=".*logits_processor.*")
-            predicted_ids = model.generate(
-                input_features,
-                attention_mask=attention_mask
-            )
+        key = make_key(audio_digest, cache_revision, TRANSCRIBE_OPTIONS)
+        transcription = await run_in_threadpool(cache.get, key)
+        cached = transcription is not None
         
-        # Decode
-        transcription = processor.batch_decode(
-            predicted_ids, 
-            skip_special_tokens=True
-        )[0]
+        if not cached:
+            # Queue for the next batched generate call and wait for the decoded text
+            transcription = await batcher.submit(features[0])
+            await run_in_threadpool(cache.put, key, transcription)
         
         return {
             "filename": filename,
-            "transcription": transcription
+            "transcription": transcription,
+            "cached": cached
         }
         
     except Exception as e:
         return {"error": str(e)}
         
     finally:
-        # Clean up temp file
-        if os.path.exists(temp_filename):
-            os.remove(temp_filename)
+        # Clean up spilled file
+        if spill_filename is not None and os.path.exists(spill_filename):
+            os.remove(spill_filename)
+
+def upload_size(file: UploadFile) -> int:
+    """Size of an upload in bytes, measuring the spooled file if the client sent no length."""
+    if file.size is not None:
+        return file.size
+    position = file.file.tell()
+    size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(position)
+    return size
+
+def spill_upload(file: UploadFile) -> str:
+    """Copy an upload to a temp file (keeping its extension for ffmpeg) and return the path."""
+    suffix = Path(file.filename or "").suffix
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as buffer:
+        shutil.copyfileobj(file.file, buffer)
+    return buffer.name
+
+@app.websocket("/ws/transcribe")
+async def transcribe_stream(websocket: WebSocket):
+    """
+    Stream 16 kHz mono PCM (signed 16-bit little-endian binary frames) and receive text.
+    The live window is re-decoded every STREAM_DECODE_INTERVAL seconds of new audio and
+    sent as {"type": "partial"}; when the speaker pauses or the window reaches 30 s it is
+    sent as {"type": "final"} and its text becomes the prompt for the next window.
+    Send {"type": "end"} to flush the last window; the server replies {"type": "done"}.
+    Decodes are admitted like /transcribe requests: when too many are in progress partials
+    are skipped, and a final closes the connection with code 1013.
+    """
+    global active_streams
+    
+    if model is None:
+        await websocket.close(code=1011, reason="Model not loaded")
+        return
+    
+    await websocket.accept()
+    if active_streams >= MAX_STREAMS:
+        await websocket.close(code=1013, reason="Too many active streams")
+        return
+    
+    session = None
+    
+    async def emit(kind):
+        # decodes count against the same admission limit as /transcribe; a partial is
+        # skipped when the executor is busy, as the next one covers its audio anyway
+        try:
+            with executor.admit():
+                # feature extraction shares the inference thread, keeping the event loop free
+                text = await executor.run_inference(
+                    lambda: generate_streaming(session.features(), session.prompt())
+                )
+        except ExecutorBusy:
+            if kind == "partial":
+                return
+            raise
+        await websocket.send_json(session.segment(kind, text))
+        if kind == "final":
+            session.commit(text)
+    
+    active_streams += 1
+    try:
+        session = StreamingSession(StreamingConfig(
+            n_mels=model.config.num_mel_bins,
+            decode_interval_seconds=STREAM_DECODE_INTERVAL,
+        ))
+        
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            
+            if message.get("bytes") is not None:
+                pcm = np.frombuffer(message["bytes"], np.int16).astype(np.float32) / 32768.0
+                while len(pcm):
+                    pcm = session.append(pcm)
+                    if session.should_finalize():
+                        await emit("final")
+                    elif session.should_decode():
+                        await emit("partial")
+            
+            elif message.get("text") is not None:
+                if json.loads(message["text"]).get("type") == "end":
+                    if session.length:
+                        await emit("final")
+                    await websocket.send_json({"type": "done"})
+                    await websocket.close()
+                    break
+    
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        # the client may have gone away meanwhile, in which case there is no one to tell
+        if websocket.client_state == WebSocketState.CONNECTED:
+            busy = isinstance(e, ExecutorBusy)
+            try:
+                await websocket.send_json({"type": "error", "message": str(e)})
+                await websocket.close(code=1013 if busy else 1011)
+            except (WebSocketDisconnect, RuntimeError):
+                pass
+    finally:
+        active_streams -= 1
+
+@app.get("/metrics/batching")
+def batching_metrics():
+    """Queue depth, batch-size histogram and wait times of the transcription scheduler."""
+    return batcher.stats()
+
+@app.get("/metrics/executor")
+def executor_metrics():
+    """Worker counts and admission counters of the inference executor."""
+    return executor.stats()
+
+@app.get("/metrics/worker")
+def worker_metrics():
+    """Model load time and memory of the worker process that answered."""
+    return {**worker_report(load_seconds or 0.0), "shared_weights": bool(shared_weights_dir)}
+
+@app.get("/metrics/cache")
+def cache_metrics():
+    """Hit/miss counters and sizes of the transcription result cache."""
+    return cache.stats()
 
 @app.post("/dataset/add")
 async def add_to_dataset(
@@ -180,10 +544,12 @@ async def get_dataset_count():
         return {"count": 0}
 
 @app.get("/train/stream")
-async def stream_training():
+async def stream_training(incremental: bool = False):
     """
     Stream fine-tuning process logs via Server-Sent Events (SSE).
     Frontend should use EventSource to consume this endpoint.
+    With ?incremental=true the last fine-tuned model is trained further on the rows
+    added since its run, falling back to a full run when that is not possible.
     """
     import subprocess
     import sys
@@ -202,8 +568,11 @@ async def stream_training():
         env["PYTHONIOENCODING"] = "utf-8"
         
         # Start subprocess with stdout/stderr merged
+        command = [sys.executable, "-u", script_path]  # -u for unbuffered output
+        if incremental:
+            command.append("--incremental")
         process = subprocess.Popen(
-            [sys.executable, "-u", script_path],  # -u for unbuffered output
+            command,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             text=True,
@@ -220,7 +589,9 @@ async def stream_training():
         max_steps = 50  # from fine_tune_hmong.py
         
         try:
-            for line in iter(process.stdout.readline, ''):
+            while True:
+                # Read in a worker thread so the event loop isn't blocked between log lines
+                line = await run_in_threadpool(process.stdout.readline)
                 if not line:
                     break
                     
@@ -248,7 +619,7 @@ async def stream_training():
                 
                 await asyncio.sleep(0.01)  # Small delay to prevent overwhelming
             
-            process.wait()
+            await run_in_threadpool(process.wait)
             
             if process.returncode == 0:
                 yield f"data: {{\"type\": \"complete\", \"message\": \"✅ Training complete!\", \"progress\": 100}}\n\n"
@@ -265,4 +636,13 @@ async def stream_training():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if api_workers > 1:
+        # Workers are separate processes importing this module by name; the weights file
+        # was already written above, so they only map it. Their torch imports alone can
+        # outlast uvicorn's default 5 s health check.
+        uvicorn.run(
+            "api:app", host="0.0.0.0", port=8000, workers=api_workers,
+            timeout_worker_healthcheck=60,
+        )
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
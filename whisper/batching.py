@@ -0,0 +1,172 @@
+"""
+Dynamic micro-batching for the transcription API
+Collects log-mel features from concurrent requests and runs them through one padded
+generate call, bounded by a maximum batch size and a maximum wait deadline
+"""
+
+import asyncio
+import time
+from collections import Counter, deque
+from concurrent.futures import Executor
+from typing import Callable, List, Optional
+
+import numpy as np
+
+
+def pad_and_stack(features: List[np.ndarray]) -> np.ndarray:
+    """Right-pad (n_mels, n_frames) features to the longest one and stack them into a batch"""
+    n_frames = max(f.shape[-1] for f in features)
+    padded = [
+        np.pad(f, [(0, 0)] * (f.ndim - 1) + [(0, n_frames - f.shape[-1])])
+        for f in features
+    ]
+    return np.stack(padded)
+
+
+class MicroBatcher:
+    """
+    Queue incoming requests and group them into batches.
+
+    A batch is dispatched when it reaches `max_batch_size` or when the oldest request in it
+    has waited `max_wait_ms`, whichever comes first. `run_batch` receives the list of
+    features and must return one result per item, in order; it is called on `executor`
+    (the loop's default thread pool if None) so the event loop keeps serving other
+    requests while the model runs.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[np.ndarray]], List[str]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        history: int = 1000,
+        executor: Optional[Executor] = None,
+    ):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight = 0
+
+        # metrics
+        self.total_requests = 0
+        self.total_batches = 0
+        self.total_errors = 0
+        self.batch_sizes = Counter()
+        self.wait_times = deque(maxlen=history)  # seconds spent queued before dispatch
+        self.batch_times = deque(maxlen=history)  # seconds spent in run_batch
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # the queue and worker task are bound to the loop they were created on
+            self._loop, self._queue, self._worker = loop, asyncio.Queue(), None
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+
+    async def submit(self, features: np.ndarray) -> str:
+        """Enqueue one request's features and wait for its decoded result"""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((features, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> list:
+        first = await self._queue.get()
+        batch = [first]
+        deadline = first[2] + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout <= 0:
+                    # past the deadline: take whatever is already queued, but don't wait
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+
+            # drop requests whose clients have gone away while queued
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+
+            dispatched = time.perf_counter()
+            self.wait_times.extend(dispatched - enqueued for _, _, enqueued in batch)
+            self.batch_sizes[len(batch)] += 1
+            self.total_batches += 1
+            self.total_requests += len(batch)
+
+            self._in_flight = len(batch)
+            try:
+                features = [item[0] for item in batch]
+                results = await loop.run_in_executor(
+                    self.executor, self.run_batch, features
+                )
+                if len(results) != len(batch):
+                    raise RuntimeError(
+                        f"run_batch returned {len(results)} results for {len(batch)} inputs"
+                    )
+            except Exception as e:
+                self.total_errors += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            finally:
+                self._in_flight = 0
+                self.batch_times.append(time.perf_counter() - dispatched)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> dict:
+        """Snapshot of the scheduler metrics, for tuning the batch size and deadline"""
+
+        def summarize(values) -> dict:
+            if not values:
+                return {"count": 0}
+            ms = np.asarray(values) * 1000
+            return {
+                "count": len(ms),
+                "mean_ms": round(float(ms.mean()), 3),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                "max_ms": round(float(ms.max()), 3),
+            }
+
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queue_depth": self.queue_depth,
+            "in_flight": self._in_flight,
+            "total_requests": self.total_requests,
+            "total_batches": self.total_batches,
+            "total_errors": self.total_errors,
+            "mean_batch_size": (
+                round(self.total_requests / self.total_batches, 3)
+                if self.total_batches
+                else 0.0
+            ),
+            "batch_size_histogram": {
+                str(size): count for size, count in sorted(self.batch_sizes.items())
+            },
+            "wait_time": summarize(self.wait_times),
+            "batch_time": summarize(self.batch_times),
+        }
@@ -0,0 +1,955 @@
+"""
+Throughput benchmarks for the Hmong transcription service
+
+    python benchmark.py long-form --minutes 10 --batch-sizes 1 4 8
+    python benchmark.py transcribe --whisper-model tiny --batch-sizes 1 8
+    python benchmark.py timestamp-rules --rows 1 5 10 40
+    python benchmark.py beam-search --beam-sizes 1 2 5 10
+    python benchmark.py kv-cache --whisper-model tiny --beam-size 5
+    python benchmark.py fallback --whisper-model tiny --minutes 2
+    python benchmark.py quantize --dataset-dir hmong_dataset
+    python benchmark.py load-model --whisper-model ~/.cache/whisper/small.pt
+    python benchmark.py api-workers --workers 4
+    python benchmark.py warmup --requests 20 --compile
+    python benchmark.py decode-audio --clips 1000 --workers 1 2 4 8
+    python benchmark.py streaming-mel --minutes 60
+    python benchmark.py batch-mel --clips 1000 --batch-sizes 16 64 256
+    python benchmark.py preprocess --clips 256 --workers 1 2 4
+"""
+
+import argparse
+import csv
+import os
+import resource
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import torch
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+SAMPLE_RATE = 16000
+
+
+def load_recording(audio_dir: str, minutes: float) -> np.ndarray:
+    """Concatenate the clips in `audio_dir` (repeating them as needed) into one recording"""
+    import preprocess
+
+    clips = [
+        preprocess.load_audio(str(p)) for p in sorted(Path(audio_dir).glob("*.mp3"))
+    ]
+    if not clips:
+        raise SystemExit(f"No .mp3 files found in {audio_dir}")
+
+    target = int(minutes * 60 * SAMPLE_RATE)
+    pieces, total = [], 0
+    while total < target:
+        for clip in clips:
+            pieces.append(clip)
+            total += len(clip)
+            if total >= target:
+                break
+    return np.concatenate(pieces)[:target]
+
+
+def load_model(model_dir: str):
+    from transformers import WhisperForConditionalGeneration, WhisperProcessor
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    processor = WhisperProcessor.from_pretrained(model_dir)
+    model = WhisperForConditionalGeneration.from_pretrained(model_dir).to(device).eval()
+    return model, processor
+
+
+def bench_long_form(args):
+    import preprocess
+    from long_form import generate_long_form
+
+    model, processor = load_model(args.model_dir)
+    preprocess.init_worker(args.model_dir)
+
+    audio = load_recording(args.audio_dir, args.minutes)
+    audio_seconds = len(audio) / SAMPLE_RATE
+
+    start = time.perf_counter()
+    features, durations = preprocess.extract_window_features(audio)
+    feature_time = time.perf_counter() - start
+
+    print(f"Recording: {audio_seconds:.1f} s of audio, {len(features)} windows")
+    print(f"Feature extraction: {feature_time:.2f} s")
+    print()
+    print(
+        f"{'batch':>5}  {'seconds':>8}  {'windows/s':>9}  {'x realtime':>10}  {'segments':>8}"
+    )
+
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        segments = generate_long_form(model, processor, features, durations, batch_size)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{batch_size:>5}  {elapsed:>8.2f}  {len(features) / elapsed:>9.2f}  "
+            f"{audio_seconds / elapsed:>10.1f}  {len(segments):>8}"
+        )
+
+
+def bench_transcribe(args):
+    import whisper
+    from whisper.audio import HOP_LENGTH
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = whisper.load_model(args.whisper_model, device=device)
+
+    audio = load_recording(args.audio_dir, args.minutes)
+    frames = len(audio) // HOP_LENGTH
+    print(f"Recording: {len(audio) / SAMPLE_RATE:.1f} s of audio, {frames} mel frames")
+    print()
+    print(f"{'batch':>5}  {'seconds':>8}  {'frames/s':>9}  {'segments':>8}")
+
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        result = whisper.transcribe(
+            model,
+            audio,
+            language=args.language,
+            temperature=0.0,
+            condition_on_previous_text=False,
+            fp16=device == "cuda",
+            batch_size=batch_size,
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"{batch_size:>5}  {elapsed:>8.2f}  {frames / elapsed:>9.0f}  "
+            f"{len(result['segments']):>8}"
+        )
+
+
+def bench_timestamp_rules(args):
+    from whisper.decoding import ApplyTimestampRules
+    from whisper.tokenizer import get_tokenizer
+
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    sample_begin = len(tokenizer.sot_sequence)
+    rules = ApplyTimestampRules(tokenizer, sample_begin, max_initial_timestamp_index=50)
+    n_vocab = tokenizer.timestamp_begin + 1501
+
+    print(f"{'rows':>5}  {'us/step':>9}  {'us/row':>8}")
+    for n_rows in args.rows:
+        # a sampled prefix alternating text and timestamp pairs, as in a real decode
+        pattern = []
+        for i in range(args.length // 4):
+            pattern += [tokenizer.timestamp_begin + 2 * i, 100 + i, 200 + i]
+            pattern += [tokenizer.timestamp_begin + 2 * i + 1]
+        prefix = list(tokenizer.sot_sequence) + pattern[: args.length]
+        tokens = torch.tensor([prefix] * n_rows)
+        logits = [torch.randn(n_rows, n_vocab) for _ in range(args.steps)]
+
+        start = time.perf_counter()
+        for step_logits in logits:
+            rules.apply(step_logits, tokens)
+        elapsed = (time.perf_counter() - start) / args.steps * 1e6
+        print(f"{n_rows:>5}  {elapsed:>9.1f}  {elapsed / n_rows:>8.1f}")
+
+
+def bench_beam_search(args):
+    from whisper.decoding import BeamSearchDecoder, Inference
+
+    class NoCache(Inference):
+        def rearrange_kv_cache(self, source_indices):
+            pass
+
+    n_vocab, eot = 51865, 50257
+    print(f"{'beam':>5}  {'us/step':>9}  {'tokens/s':>9}")
+    for beam_size in args.beam_sizes:
+        n_rows = args.n_audio * beam_size
+        decoder = BeamSearchDecoder(beam_size, eot, NoCache())
+        # EOT is pushed down so that every beam keeps going for all steps
+        logits = [torch.randn(n_rows, n_vocab) for _ in range(args.steps)]
+        for step_logits in logits:
+            step_logits[:, eot] = -np.inf
+
+        tokens = torch.zeros(n_rows, 4, dtype=torch.long)
+        sum_logprobs = torch.zeros(n_rows)
+        start = time.perf_counter()
+        for step_logits in logits:
+            tokens, _ = decoder.update(tokens, step_logits, sum_logprobs)
+        elapsed = time.perf_counter() - start
+
+        print(
+            f"{beam_size:>5}  {elapsed / args.steps * 1e6:>9.1f}  "
+            f"{args.n_audio * args.steps / elapsed:>9.0f}"
+        )
+
+
+def bench_kv_cache(args):
+    import whisper
+    from whisper.tokenizer import get_tokenizer
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = whisper.load_model(args.whisper_model, device=device)
+    tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages)
+    mel = torch.randn(args.n_audio, model.dims.n_mels, 3000, device=device)
+
+    print(f"{'cache':>7}  {'ms/token':>9}  {'peak MiB':>9}")
+    for static in (False, True):
+        options = whisper.DecodingOptions(
+            language=args.language,
+            fp16=device == "cuda",
+            beam_size=args.beam_size,
+            sample_len=args.sample_len,
+            without_timestamps=True,
+            suppress_tokens=[tokenizer.eot],  # decode all sample_len tokens
+            static_kv_cache=static,
+        )
+        whisper.decode(model, mel[:1], options)  # warm up
+        if device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+
+        start = time.perf_counter()
+        results = whisper.decode(model, mel, options)
+        elapsed = time.perf_counter() - start
+
+        n_tokens = sum(len(r.tokens) for r in results)
+        peak = "n/a"
+        if device == "cuda":
+            peak = f"{torch.cuda.max_memory_allocated() / 2**20:.0f}"
+        print(
+            f"{'static' if static else 'concat':>7}  "
+            f"{elapsed / max(n_tokens, 1) * 1e3:>9.2f}  {peak:>9}"
+        )
+
+
+def bench_fallback(args):
+    import whisper
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = whisper.load_model(args.whisper_model, device=device)
+
+    # count the windows that go through the encoder and the rows of cross-attention
+    # keys projected, i.e. once per window for each pass that computes them
+    encoded, projected = [], []
+    model.encoder.register_forward_hook(
+        lambda _, inputs, __: encoded.append(inputs[0].shape[0])
+    )
+    model.decoder.blocks[0].cross_attn.key.register_forward_hook(
+        lambda _, __, output: projected.append(output.shape[0])
+    )
+
+    audio = load_recording(args.audio_dir, args.minutes)
+    print(f"Recording: {len(audio) / SAMPLE_RATE:.1f} s of audio")
+    print()
+    print(
+        f"{'batch':>5}  {'fallback':>10}  {'seconds':>8}  {'windows':>7}  "
+        f"{'s/window':>8}  {'decodes/window':>14}  {'encodes/window':>14}  {'kv/window':>9}"
+    )
+
+    for batch_size in args.batch_sizes:
+        for batched_fallback in (False, True):
+            encoded.clear()
+            projected.clear()
+            decodes = []  # the first temperature of each decode call, once per window
+            decode = model.decode
+
+            def counting_decode(mel, options, *rest):
+                t = options.temperature
+                first = t[0] if isinstance(t, tuple) else t
+                decodes.extend([first] * (mel.shape[0] if mel.ndim == 3 else 1))
+                return decode(mel, options, *rest)
+
+            model.decode = counting_decode
+            start = time.perf_counter()
+            whisper.transcribe(
+                model,
+                audio,
+                language=args.language,
+                temperature=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+                best_of=args.best_of,
+                # every window fails the threshold and goes through all temperatures
+                logprob_threshold=0.0 if args.force_fallback else -1.0,
+                condition_on_previous_text=False,
+                fp16=device == "cuda",
+                batch_size=batch_size,
+                batched_fallback=batched_fallback,
+            )
+            elapsed = time.perf_counter() - start
+            del model.decode
+
+            windows = decodes.count(0.0)
+            print(
+                f"{batch_size:>5}  {'batched' if batched_fallback else 'sequential':>10}  "
+                f"{elapsed:>8.2f}  {windows:>7}  {elapsed / windows:>8.2f}  "
+                f"{len(decodes) / windows:>14.2f}  {sum(encoded) / windows:>14.2f}  "
+                f"{sum(projected) / windows:>9.2f}"
+            )
+
+
+def rss_mib() -> float:
+    """Resident set size of this process"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def word_errors(reference: str, hypothesis: str) -> int:
+    """Word-level edit distance"""
+    ref, hyp = reference.lower().split(), hypothesis.lower().split()
+    distances = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        previous, distances[0] = distances[0], i
+        for j, h in enumerate(hyp, 1):
+            previous, distances[j] = distances[j], min(
+                distances[j] + 1, distances[j - 1] + 1, previous + (r != h)
+            )
+    return distances[-1]
+
+
+def word_error_rate(references, hypotheses) -> float:
+    errors = sum(word_errors(r, h) for r, h in zip(references, hypotheses))
+    return 100 * errors / max(sum(len(r.split()) for r in references), 1)
+
+
+def transcribe_clips(model_dir: str, quantize, clips):
+    """Load the model on CPU, optionally quantized, and transcribe each clip; runs in a fresh process"""
+    from transformers import WhisperForConditionalGeneration, WhisperProcessor
+
+    from quantization import quantize_model
+
+    torch.set_num_threads(1)
+    start = time.perf_counter()
+    processor = WhisperProcessor.from_pretrained(model_dir)
+    model = WhisperForConditionalGeneration.from_pretrained(model_dir).eval()
+    model = quantize_model(model, quantize)
+    load_time = time.perf_counter() - start
+    loaded_rss = rss_mib()
+
+    texts, latencies = [], []
+    for audio in clips:
+        start = time.perf_counter()
+        features = processor(audio, sampling_rate=SAMPLE_RATE, return_tensors="pt")
+        with torch.no_grad():
+            predicted_ids = model.generate(features.input_features)
+        texts.append(processor.batch_decode(predicted_ids, skip_special_tokens=True)[0])
+        latencies.append(time.perf_counter() - start)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return texts, latencies, load_time, loaded_rss, peak_rss
+
+
+def load_whisper_model(name: str, **kwargs):
+    """Load a vendored Whisper model on CPU and measure it; runs in a fresh process"""
+    import whisper
+
+    start = time.perf_counter()
+    whisper.load_model(name, device="cpu", **kwargs)
+    elapsed = time.perf_counter() - start
+
+    with open("/proc/self/status") as f:
+        status = dict(line.split(":", 1) for line in f)
+    file_backed = int(status["RssFile"].split()[0]) / 1024
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return elapsed, rss_mib(), file_backed, peak_rss
+
+
+def bench_load_model(args):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    from whisper import _sha256
+
+    name = os.path.expanduser(args.whisper_model)
+    if os.path.isfile(name):
+        sidecar = name + ".sha256"
+        had_sidecar = os.path.exists(sidecar)
+        if had_sidecar:
+            os.rename(sidecar, sidecar + ".bak")
+        start = time.perf_counter()
+        _sha256(name)
+        hashed = time.perf_counter() - start
+        start = time.perf_counter()
+        _sha256(name)
+        cached = time.perf_counter() - start
+        os.remove(sidecar)
+        if had_sidecar:
+            os.rename(sidecar + ".bak", sidecar)
+        print(f"Checksum: {hashed:.2f} s to hash, {cached * 1e3:.2f} ms cached")
+        print()
+
+    print(
+        f"{'load':>9}  {'seconds':>7}  {'RSS MiB':>7}  {'file-backed':>11}  {'peak MiB':>8}"
+    )
+    modes = {
+        "read": dict(mmap=False),
+        "in-memory": dict(in_memory=True),
+        "mmap": dict(mmap=True),
+    }
+    for label, kwargs in modes.items():
+        for _ in range(args.repeat):
+            # a fresh process each time; the page cache stays warm after the first run
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                elapsed, rss, file_backed, peak = pool.submit(
+                    load_whisper_model, name, **kwargs
+                ).result()
+            print(
+                f"{label:>9}  {elapsed:>7.2f}  {rss:>7.0f}  {file_backed:>11.0f}  {peak:>8.0f}"
+            )
+
+
+def bench_quantize(args):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    import preprocess
+
+    clips, references = [], []
+    with open(Path(args.dataset_dir) / "transcripts.csv", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            path = Path(args.dataset_dir) / row["audio_path"]
+            try:
+                clips.append(preprocess.load_audio(str(path)))
+            except Exception as e:
+                print(f"Skipping {path}: {type(e).__name__} {e}")
+                continue
+            references.append(row["text"])
+
+    print(f"Dataset: {len(clips)} clips from {args.dataset_dir}, CPU, 1 thread")
+    print()
+    print(
+        f"{'weights':>7}  {'load s':>6}  {'RSS MiB':>7}  {'peak MiB':>8}  "
+        f"{'ms/clip':>7}  {'p90 ms':>7}  {'WER %':>6}  {'same text':>9}"
+    )
+
+    outputs = {}
+    for quantize in (None, "int8"):
+        # a fresh process per mode, so that the memory figures are not shared
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+            outputs[quantize] = pool.submit(
+                transcribe_clips, args.model_dir, quantize, clips
+            ).result()
+
+        texts, latencies, load_time, loaded_rss, peak_rss = outputs[quantize]
+        same = sum(a == b for a, b in zip(texts, outputs[None][0]))
+        print(
+            f"{quantize or 'fp32':>7}  {load_time:>6.1f}  {loaded_rss:>7.0f}  "
+            f"{peak_rss:>8.0f}  {np.mean(latencies) * 1e3:>7.0f}  "
+            f"{np.percentile(latencies, 90) * 1e3:>7.0f}  "
+            f"{word_error_rate(references, texts):>6.1f}  {same:>4}/{len(texts):<4}"
+        )
+
+    if args.verbose:
+        print()
+        for reference, fp32, int8 in zip(
+            references, outputs[None][0], outputs["int8"][0]
+        ):
+            print(f"ref:  {reference}\nfp32: {fp32.strip()}\nint8: {int8.strip()}\n")
+
+
+def load_audio_capture(file: str) -> np.ndarray:
+    """whisper.audio.load_audio as it was: one ffmpeg run per file, output captured whole"""
+    from subprocess import run
+
+    # fmt: off
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", file,
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-",
+    ]
+    # fmt: on
+    out = run(cmd, capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def bench_decode_audio(args):
+    import shutil
+    import tempfile
+    import wave
+
+    from whisper.audio import AudioDecoder, load_audio
+
+    paths = sorted(str(p) for p in Path(args.audio_dir).iterdir() if p.is_file())
+    has_ffmpeg = shutil.which("ffmpeg") is not None
+    tmp_dir = None
+    if args.wav:
+        # 16 kHz mono WAV copies take the in-process path of load_audio
+        import preprocess
+
+        tmp_dir = tempfile.mkdtemp()
+        for i, path in enumerate(paths):
+            pcm = np.round(preprocess.load_audio(path) * 32767).astype("<i2")
+            paths[i] = os.path.join(tmp_dir, f"{i}.wav")
+            with wave.open(paths[i], "wb") as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(SAMPLE_RATE)
+                f.writeframes(pcm.tobytes())
+    elif not has_ffmpeg:
+        raise SystemExit(
+            "ffmpeg is not installed; use --wav to benchmark the in-process path"
+        )
+
+    files = [paths[i % len(paths)] for i in range(args.clips)]
+    print(
+        f"{len(files)} clips from {len(paths)} {'WAV copies of ' if args.wav else ''}"
+        f"files in {args.audio_dir}"
+    )
+    print()
+    print(f"{'decoder':>18}  {'seconds':>7}  {'clips/s':>8}  {'audio x':>8}")
+
+    modes = {}
+    if has_ffmpeg:
+        modes["ffmpeg per file"] = lambda: [load_audio_capture(f) for f in files]
+    modes["load_audio"] = lambda: [load_audio(f) for f in files]
+    for workers in args.workers:
+
+        def pooled(workers=workers):
+            with AudioDecoder(workers) as decoder:
+                return list(decoder.map(files))
+
+        modes[f"AudioDecoder({workers})"] = pooled
+
+    try:
+        for label, run in modes.items():
+            start = time.perf_counter()
+            audios = run()
+            elapsed = time.perf_counter() - start
+            seconds = sum(len(a) for a in audios) / SAMPLE_RATE
+            print(
+                f"{label:>18}  {elapsed:>7.2f}  {len(files) / elapsed:>8.1f}  "
+                f"{seconds / elapsed:>8.0f}"
+            )
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+
+def compute_windows(path: str, streaming: bool):
+    """Compute the normalized log-Mel input of every 30-second window of a WAV file the way
+    transcribe() does; runs in a fresh process"""
+    from whisper.audio import N_FRAMES, N_SAMPLES, LogMelStream, log_mel_spectrogram
+
+    start = time.perf_counter()
+    n_windows = 0
+    if streaming:
+        mel = LogMelStream(path)
+        seek = 0
+        while seek < mel.read(seek + 2 * N_FRAMES):
+            size = min(N_FRAMES, mel.n_frames - seek)
+            mel.window(seek, size)
+            seek += size
+            n_windows += 1
+    else:
+        mel = log_mel_spectrogram(path, padding=N_SAMPLES)
+        for seek in range(0, mel.shape[-1] - N_FRAMES, N_FRAMES):
+            mel[:, seek : seek + N_FRAMES].clone()
+            n_windows += 1
+    elapsed = time.perf_counter() - start
+    # VmHWM rather than ru_maxrss, which a spawned process inherits from its parent
+    with open("/proc/self/status") as f:
+        status = dict(line.split(":", 1) for line in f)
+    peak_rss = int(status["VmHWM"].split()[0]) / 1024
+    return n_windows, elapsed, peak_rss
+
+
+def bench_streaming_mel(args):
+    import shutil
+    import tempfile
+    import wave
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    audio = load_recording(args.audio_dir, args.minutes)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "recording.wav")
+        with wave.open(path, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(SAMPLE_RATE)
+            f.writeframes(np.round(audio * 32767).astype("<i2").tobytes())
+        del audio
+
+        print(
+            f"{args.minutes:g}-minute recording from {args.audio_dir}, read from a WAV file"
+        )
+        print()
+        print(f"{'frontend':>10}  {'windows':>7}  {'seconds':>7}  {'peak MiB':>8}")
+        for label, streaming in (("whole", False), ("streaming", True)):
+            # a fresh process each, so that the peak RSS is the frontend's own
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                n_windows, elapsed, peak_rss = pool.submit(
+                    compute_windows, path, streaming
+                ).result()
+            print(f"{label:>10}  {n_windows:>7}  {elapsed:>7.2f}  {peak_rss:>8.0f}")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_batch_mel(args):
+    from whisper.audio import log_mel_spectrogram, log_mel_spectrogram_batch
+
+    # short clips cut at random from the recordings in audio_dir
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(
+        int(args.min_seconds * SAMPLE_RATE),
+        int(args.max_seconds * SAMPLE_RATE) + 1,
+        args.clips,
+    )
+    recording = torch.from_numpy(
+        load_recording(args.audio_dir, (lengths.sum() + SAMPLE_RATE) / SAMPLE_RATE / 60)
+    )
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    clips = [recording[o : o + n] for o, n in zip(offsets, lengths)]
+    seconds = lengths.sum() / SAMPLE_RATE
+
+    print(
+        f"{len(clips)} clips of {args.min_seconds:g}-{args.max_seconds:g} s from "
+        f"{args.audio_dir}, {torch.get_num_threads()} thread(s)"
+    )
+    print()
+    print(f"{'frontend':>24}  {'seconds':>7}  {'clips/s':>8}  {'audio x':>8}")
+
+    def report(label, run):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print(
+            f"{label:>24}  {elapsed:>7.2f}  {len(clips) / elapsed:>8.1f}  "
+            f"{seconds / elapsed:>8.0f}"
+        )
+
+    report("per-clip loop", lambda: [log_mel_spectrogram(c) for c in clips])
+    by_length = sorted(clips, key=len)
+    for batch_size in args.batch_sizes:
+        for label, order in (("batch", clips), ("batch, sorted", by_length)):
+            report(
+                f"{label} of {batch_size}",
+                lambda order=order, batch_size=batch_size: [
+                    log_mel_spectrogram_batch(order[i : i + batch_size])
+                    for i in range(0, len(order), batch_size)
+                ],
+            )
+
+
+def bench_preprocess(args):
+    from transformers import WhisperFeatureExtractor
+
+    from fine_tune_hmong import MIN_CLIPS_PER_WORKER, extract_all
+
+    paths = sorted(str(p) for p in Path(args.audio_dir).glob("*.mp3"))
+    if not paths:
+        raise SystemExit(f"No .mp3 files found in {args.audio_dir}")
+    files = [paths[i % len(paths)] for i in range(args.clips)]
+    feature_extractor = WhisperFeatureExtractor.from_pretrained(args.model_dir)
+
+    # extract_all uses at most one worker per MIN_CLIPS_PER_WORKER clips
+    limit = -(-len(files) // MIN_CLIPS_PER_WORKER)
+    workers = sorted({min(n, limit) for n in args.workers + [os.cpu_count() or 1]})
+    print(f"{len(files)} clips from {args.audio_dir}, {os.cpu_count()} cores")
+    print()
+    print(f"{'workers':>7}  {'seconds':>7}  {'clips/s':>8}  {'speedup':>7}")
+    baseline = None
+    for n in workers:
+        # includes starting the pool, as a training run pays for it too
+        start = time.perf_counter()
+        count = sum(1 for _ in extract_all(files, feature_extractor, n))
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(
+            f"{n:>7}  {elapsed:>7.2f}  {count / elapsed:>8.1f}  {baseline / elapsed:>6.2f}x"
+        )
+
+
+def time_first_requests(
+    model_dir: str, batch_sizes, compile: bool, clips, max_new_tokens: int
+):
+    """Load the model, warm it up like the API does and time one request per clip; runs in a
+    fresh process"""
+    from transformers import WhisperForConditionalGeneration, WhisperProcessor
+
+    processor = WhisperProcessor.from_pretrained(model_dir)
+    model = WhisperForConditionalGeneration.from_pretrained(model_dir).eval()
+    if compile:
+        model.model.encoder.compile()
+        model.model.decoder.compile(dynamic=True)
+
+    def generate(input_features):
+        with torch.no_grad():
+            predicted_ids = model.generate(
+                input_features, max_new_tokens=max_new_tokens
+            )
+        return processor.batch_decode(predicted_ids, skip_special_tokens=True)
+
+    start = time.perf_counter()
+    config = model.config
+    for batch_size in batch_sizes:
+        generate(
+            torch.zeros(
+                batch_size, config.num_mel_bins, 2 * config.max_source_positions
+            )
+        )
+    warmup_time = time.perf_counter() - start
+
+    latencies = []
+    for audio in clips:
+        start = time.perf_counter()
+        features = processor(audio, sampling_rate=SAMPLE_RATE, return_tensors="pt")
+        generate(features.input_features)
+        latencies.append(time.perf_counter() - start)
+    return warmup_time, latencies
+
+
+def bench_warmup(args):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    import preprocess
+
+    paths = sorted(Path(args.audio_dir).glob("*.mp3"))
+    if not paths:
+        raise SystemExit(f"No .mp3 files found in {args.audio_dir}")
+    clips = [preprocess.load_audio(str(path)) for path in paths]
+    clips = [clips[i % len(clips)] for i in range(args.requests)]
+
+    print(f"{args.requests} requests, one clip each, after a fresh model load")
+    print()
+    print(
+        f"{'warmup':>15}  {'warmup s':>8}  {'1st ms':>7}  {'2nd ms':>7}  "
+        f"{'p50 ms':>7}  {'p99 ms':>7}"
+    )
+    modes = {"none": ([], False), "batches": (args.batch_sizes, False)}
+    if args.compile:
+        modes["batches+compile"] = (args.batch_sizes, True)
+    for label, (batch_sizes, compile) in modes.items():
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+            warmup_time, latencies = pool.submit(
+                time_first_requests,
+                args.model_dir,
+                batch_sizes,
+                compile,
+                clips,
+                args.max_new_tokens,
+            ).result()
+        latencies = np.array(latencies) * 1e3
+        print(
+            f"{label:>15}  {warmup_time:>8.2f}  {latencies[0]:>7.0f}  {latencies[1]:>7.0f}  "
+            f"{np.percentile(latencies, 50):>7.0f}  {np.percentile(latencies, 99):>7.0f}"
+        )
+
+
+def init_api_worker(barrier):
+    global api_worker_barrier
+    api_worker_barrier = barrier
+
+
+def start_api_worker(model_dir: str, shared_dir: str):
+    """Load the model the way an API worker does, run it once and report; all workers of a
+    run wait for each other so that their memory is measured while they are all alive"""
+    from transformers import WhisperForConditionalGeneration
+
+    from shared_weights import load_shared_model, worker_report
+
+    start = time.perf_counter()
+    if shared_dir:
+        model = load_shared_model(model_dir, shared_dir)
+    else:
+        model = WhisperForConditionalGeneration.from_pretrained(model_dir).eval()
+    load_time = time.perf_counter() - start
+
+    # one forward pass touches every weight
+    config = model.config
+    with torch.no_grad():
+        model(
+            input_features=torch.zeros(1, config.num_mel_bins, 3000),
+            decoder_input_ids=torch.tensor([[config.decoder_start_token_id]]),
+        )
+
+    api_worker_barrier.wait()
+    report = worker_report(load_time)
+    api_worker_barrier.wait()
+    return report
+
+
+def bench_api_workers(args):
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    from shared_weights import export_weights, shared_weights_path
+
+    shared_dir = tempfile.mkdtemp(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    try:
+        start = time.perf_counter()
+        export_weights(args.model_dir, shared_weights_path(args.model_dir, shared_dir))
+        print(f"Shared weights written in {time.perf_counter() - start:.2f} s")
+        print()
+        print(
+            f"{'weights':>7}  {'pid':>7}  {'load s':>6}  {'RSS MiB':>7}  {'shared':>6}  "
+            f"{'private':>7}  {'PSS MiB':>7}"
+        )
+        for label, directory in (("private", ""), ("shared", shared_dir)):
+            context = get_context("spawn")
+            with ProcessPoolExecutor(
+                args.workers,
+                mp_context=context,
+                initializer=init_api_worker,
+                initargs=(context.Barrier(args.workers),),
+            ) as pool:
+                futures = [
+                    pool.submit(start_api_worker, args.model_dir, directory)
+                    for _ in range(args.workers)
+                ]
+                reports = [future.result() for future in futures]
+            for report in reports:
+                print(
+                    f"{label:>7}  {report['pid']:>7}  {report['load_seconds']:>6.2f}  "
+                    f"{report['rss_mib']:>7.0f}  {report['shared_mib']:>6.0f}  "
+                    f"{report['private_mib']:>7.0f}  {report['pss_mib'] or 0:>7.0f}"
+                )
+            total = sum(report["pss_mib"] or 0 for report in reports)
+            print(
+                f"{label:>7}  {'total':>7}  {'':>6}  {'':>7}  {'':>6}  {'':>7}  {total:>7.0f}"
+            )
+    finally:
+        shutil.rmtree(shared_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model-dir", default="whisper-hmong-finetuned")
+    parser.add_argument("--audio-dir", default="audio_hmong")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    long_form = subparsers.add_parser(
+        "long-form", help="windowed transcription of one long recording"
+    )
+    long_form.add_argument("--minutes", type=float, default=10.0)
+    long_form.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    long_form.set_defaults(run=bench_long_form)
+
+    transcribe = subparsers.add_parser(
+        "transcribe",
+        help="whisper.transcribe, sequential windows vs. batched windows",
+    )
+    transcribe.add_argument("--whisper-model", default="tiny")
+    transcribe.add_argument("--language", default="en")
+    transcribe.add_argument("--minutes", type=float, default=10.0)
+    transcribe.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    transcribe.set_defaults(run=bench_transcribe)
+
+    timestamp_rules = subparsers.add_parser(
+        "timestamp-rules", help="per-step cost of ApplyTimestampRules vs. rows"
+    )
+    timestamp_rules.add_argument("--rows", type=int, nargs="+", default=[1, 5, 10, 40])
+    timestamp_rules.add_argument("--length", type=int, default=100)
+    timestamp_rules.add_argument("--steps", type=int, default=200)
+    timestamp_rules.set_defaults(run=bench_timestamp_rules)
+
+    beam_search = subparsers.add_parser(
+        "beam-search", help="cost of one beam search update vs. beam size"
+    )
+    beam_search.add_argument(
+        "--beam-sizes", type=int, nargs="+", default=list(range(1, 11))
+    )
+    beam_search.add_argument("--n-audio", type=int, default=4)
+    beam_search.add_argument("--steps", type=int, default=100)
+    beam_search.set_defaults(run=bench_beam_search)
+
+    kv_cache = subparsers.add_parser(
+        "kv-cache", help="decoding with the concatenated vs. the static kv cache"
+    )
+    kv_cache.add_argument("--whisper-model", default="tiny")
+    kv_cache.add_argument("--language", default="en")
+    kv_cache.add_argument("--beam-size", type=int, default=5)
+    kv_cache.add_argument("--n-audio", type=int, default=4)
+    kv_cache.add_argument("--sample-len", type=int, default=224)
+    kv_cache.set_defaults(run=bench_kv_cache)
+
+    fallback = subparsers.add_parser(
+        "fallback",
+        help="sequential vs. batched temperature fallback, with encoder and "
+        "cross-attention passes per window",
+    )
+    fallback.add_argument("--whisper-model", default="tiny")
+    fallback.add_argument("--language", default="en")
+    fallback.add_argument("--minutes", type=float, default=2.0)
+    fallback.add_argument("--best-of", type=int, default=5)
+    fallback.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    fallback.add_argument(
+        "--no-force-fallback", dest="force_fallback", action="store_false"
+    )
+    fallback.set_defaults(run=bench_fallback)
+
+    quantize = subparsers.add_parser(
+        "quantize",
+        help="accuracy, latency and memory of the int8 model vs. fp32 on the Hmong sample set",
+    )
+    quantize.add_argument("--dataset-dir", default="hmong_dataset")
+    quantize.add_argument("--verbose", action="store_true")
+    quantize.set_defaults(run=bench_quantize)
+
+    load = subparsers.add_parser(
+        "load-model", help="whisper.load_model time and memory, read vs. memory-mapped"
+    )
+    load.add_argument("--whisper-model", default="small")
+    load.add_argument("--repeat", type=int, default=2)
+    load.set_defaults(run=bench_load_model)
+
+    api_workers = subparsers.add_parser(
+        "api-workers",
+        help="startup time and memory of API worker processes, private vs. shared weights",
+    )
+    api_workers.add_argument("--workers", type=int, default=4)
+    api_workers.set_defaults(run=bench_api_workers)
+
+    warmup = subparsers.add_parser(
+        "warmup",
+        help="latency of the first requests after startup, with and without warmup",
+    )
+    warmup.add_argument("--requests", type=int, default=20)
+    warmup.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    warmup.add_argument("--max-new-tokens", type=int, default=32)
+    warmup.add_argument("--compile", action="store_true")
+    warmup.set_defaults(run=bench_warmup)
+
+    decode_audio = subparsers.add_parser(
+        "decode-audio",
+        help="whisper.audio decoding throughput: one ffmpeg per file vs. the decoder pool",
+    )
+    decode_audio.add_argument("--clips", type=int, default=1000)
+    decode_audio.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    decode_audio.add_argument("--wav", action="store_true")
+    decode_audio.set_defaults(run=bench_decode_audio)
+
+    streaming_mel = subparsers.add_parser(
+        "streaming-mel",
+        help="time and peak memory of the log-Mel frontend on a long recording, whole vs. streaming",
+    )
+    streaming_mel.add_argument("--minutes", type=float, default=60)
+    streaming_mel.set_defaults(run=bench_streaming_mel)
+
+    batch_mel = subparsers.add_parser(
+        "batch-mel",
+        help="log-Mel throughput on many short clips: one clip at a time vs. batched",
+    )
+    batch_mel.add_argument("--clips", type=int, default=1000)
+    batch_mel.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[16, 64, 256, 1000]
+    )
+    batch_mel.add_argument("--min-seconds", type=float, default=1)
+    batch_mel.add_argument("--max-seconds", type=float, default=6)
+    batch_mel.set_defaults(run=bench_batch_mel)
+
+    preprocess = subparsers.add_parser(
+        "preprocess",
+        help="fine-tuning feature extraction throughput for 1, 2, 4 and all-core process pools",
+    )
+    preprocess.add_argument("--clips", type=int, default=256)
+    preprocess.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    preprocess.set_defaults(run=bench_preprocess)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
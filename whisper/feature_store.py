@@ -0,0 +1,257 @@
+"""
+On-disk store of training features for fine_tune_hmong.py
+Log-mel features are written once into .npy shards that later runs memory-map, and label ids
+into the store's index. Features are keyed by a hash of the audio file plus the feature
+extractor config, labels by the text plus the tokenizer, so a run only computes the rows of
+transcripts.csv that are new or whose audio, text or config changed since the last one.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+
+def file_digest(path: str) -> str:
+    """SHA256 of a file's bytes"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def config_digest(config: dict) -> str:
+    """Short fingerprint of a JSON-serializable config"""
+    payload = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+class FeatureStore:
+    """
+    Features and label ids of dataset rows, persisted in `store_dir`.
+
+    `update` computes whatever is missing for a list of rows (dicts with "audio_path" and
+    "text") and appends it as one new shard; `features` and `labels` then read a row back, the
+    features as a read-only view into the memory-mapped shard. Shards no longer referenced by
+    the rows of the last pruning `update` are deleted. `add_labels` stores only the label ids,
+    which are cheap, so that they can be in place before any features are.
+
+    The digest of each audio file is kept in the index along with its size and mtime, so an
+    unchanged file is only hashed once, not on every run and in every DataLoader worker.
+
+    Features computed elsewhere, e.g. on demand by DataLoader workers, can be saved with
+    `save_clip`, one file per clip; `lookup` finds them and the next `update` moves them into
+    its shard instead of extracting them again.
+    """
+
+    def __init__(self, store_dir: str, extractor_config: dict, tokenizer_config: dict):
+        self.store_dir = Path(store_dir)
+        self.extractor_key = config_digest(extractor_config)
+        self.tokenizer_key = config_digest(tokenizer_config)
+        self.index_path = self.store_dir / "index.json"
+        self.clip_dir = self.store_dir / "clips"
+
+        self.index = {"version": INDEX_VERSION, "features": {}, "labels": {}}
+        if self.index_path.exists():
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION:
+                self.index = index
+        # {audio path: [size, mtime_ns, digest]}
+        self.index.setdefault("files", {})
+
+        self._shards: Dict[str, np.ndarray] = {}
+        self._digests: Dict[str, str] = {}
+
+    def __getstate__(self):
+        # sent to DataLoader workers: each maps the shards itself rather than copying them
+        return {**self.__dict__, "_shards": {}}
+
+    def feature_key(self, sample: dict) -> str:
+        path = sample["audio_path"]
+        digest = self._known_digest(path)
+        if digest is None:
+            if path not in self._digests:
+                self._digests[path] = file_digest(path)
+            digest = self._digests[path]
+        return f"{digest}-{self.extractor_key}"
+
+    def is_stored(self, sample: dict) -> bool:
+        """Whether the features of `sample` are in a shard; never hashes the audio file"""
+        digest = self._known_digest(sample["audio_path"])
+        if digest is None:
+            return False
+        return f"{digest}-{self.extractor_key}" in self.index["features"]
+
+    def label_key(self, sample: dict) -> str:
+        return config_digest([sample["text"], self.tokenizer_key])
+
+    def update(
+        self,
+        samples: List[dict],
+        extract: Optional[Callable[[List[str]], Iterable[np.ndarray]]],
+        tokenize: Callable[[str], List[int]],
+        progress: Optional[Callable[[int, int], None]] = None,
+        prune: bool = True,
+    ) -> int:
+        """
+        Compute the features and labels (`tokenize(text)`) that `samples` are missing and save
+        them; returns the number of feature rows computed. `extract(audio_paths)` must yield
+        the features of the files in order, so it may compute them in parallel. Audio shared
+        by several rows is only extracted once. With `extract` None nothing is extracted: only
+        the clips saved with `save_clip` are moved into the shard. With `prune`, `samples` is
+        the whole dataset and whatever it does not use is removed from the store.
+        """
+        self._add_labels(samples, tokenize)
+        pending = {}
+        for sample in samples:
+            key = self.feature_key(sample)
+            if key not in self.index["features"]:
+                pending.setdefault(key, sample["audio_path"])
+        saved = {key for key in pending if self._clip_path(key).exists()}
+        if extract is None:
+            pending = {k: p for k, p in pending.items() if k in saved}
+
+        if pending:
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            name = self._new_shard_name()
+            tmp = self.store_dir / f".{name}.{os.getpid()}.tmp"
+            missing = [p for k, p in pending.items() if k not in saved]
+            extracted = iter(extract(missing) if missing else ())
+            shard = None
+            for row, key in enumerate(pending):
+                if key in saved:
+                    features = np.load(self._clip_path(key))
+                else:
+                    features = np.asarray(next(extracted), dtype=np.float32)
+                if shard is None:
+                    # rows are filled in place, so only one clip's features are in memory
+                    shard = np.lib.format.open_memmap(
+                        tmp,
+                        mode="w+",
+                        dtype=np.float32,
+                        shape=(len(pending), *features.shape),
+                    )
+                shard[row] = features
+                if progress is not None:
+                    progress(row + 1, len(pending))
+            shard.flush()
+            del shard
+            os.replace(tmp, self.store_dir / name)
+            for row, key in enumerate(pending):
+                self.index["features"][key] = [name, row]
+
+        self._remember_digests(samples)
+        if prune:
+            self._prune(samples)
+        self._save_index()
+        # the saved clips are all in a shard now, or of rows no longer in use
+        for path in [*self.clip_dir.glob("*.npy"), *self.clip_dir.glob(".*.tmp")]:
+            path.unlink()
+        return len(pending)
+
+    def add_labels(
+        self, samples: List[dict], tokenize: Callable[[str], List[int]]
+    ) -> int:
+        """Store the label ids `samples` are missing; returns the number tokenized"""
+        added = self._add_labels(samples, tokenize)
+        if added:
+            self._save_index()
+        return added
+
+    def features(self, sample: dict) -> np.ndarray:
+        name, row = self.index["features"][self.feature_key(sample)]
+        if name not in self._shards:
+            self._shards[name] = np.load(self.store_dir / name, mmap_mode="r")
+        return self._shards[name][row]
+
+    def labels(self, sample: dict) -> List[int]:
+        return self.index["labels"][self.label_key(sample)]
+
+    def lookup(self, sample: dict) -> Optional[np.ndarray]:
+        """The features of `sample` from a shard or a saved clip, or None if not stored"""
+        key = self.feature_key(sample)
+        if key in self.index["features"]:
+            return self.features(sample)
+        path = self._clip_path(key)
+        if path.exists():
+            return np.load(path, mmap_mode="r")
+        return None
+
+    def save_clip(self, sample: dict, features: np.ndarray):
+        """Save the features of one sample outside of a shard; safe from several processes"""
+        path = self._clip_path(self.feature_key(sample))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, np.asarray(features, dtype=np.float32))
+        os.replace(tmp, path)
+
+    def _add_labels(self, samples: List[dict], tokenize) -> int:
+        added = 0
+        for sample in samples:
+            key = self.label_key(sample)
+            if key not in self.index["labels"]:
+                self.index["labels"][key] = list(tokenize(sample["text"]))
+                added += 1
+        return added
+
+    def _known_digest(self, path: str) -> Optional[str]:
+        """The indexed digest of `path`, if the file's size and mtime still match"""
+        entry = self.index["files"].get(path)
+        if entry is None:
+            return None
+        stat = os.stat(path)
+        return entry[2] if entry[:2] == [stat.st_size, stat.st_mtime_ns] else None
+
+    def _remember_digests(self, samples: List[dict]):
+        for path in {s["audio_path"] for s in samples}:
+            if self._known_digest(path) is None:
+                stat = os.stat(path)
+                digest = self._digests.get(path) or file_digest(path)
+                self.index["files"][path] = [stat.st_size, stat.st_mtime_ns, digest]
+
+    def _clip_path(self, key: str) -> Path:
+        return self.clip_dir / f"{key}.npy"
+
+    def _new_shard_name(self) -> str:
+        shards = self.store_dir.glob("shard-*.npy")
+        numbers = [int(p.stem.split("-")[1]) for p in shards]
+        return f"shard-{max(numbers, default=-1) + 1:05d}.npy"
+
+    def _prune(self, samples: List[dict]):
+        """Drop the entries the current rows do not use, and shards left without any"""
+        feature_keys = {self.feature_key(s) for s in samples}
+        label_keys = {self.label_key(s) for s in samples}
+        self.index["features"] = {
+            k: v for k, v in self.index["features"].items() if k in feature_keys
+        }
+        self.index["labels"] = {
+            k: v for k, v in self.index["labels"].items() if k in label_keys
+        }
+        paths = {s["audio_path"] for s in samples}
+        self.index["files"] = {
+            k: v for k, v in self.index["files"].items() if k in paths
+        }
+
+        live = {name for name, _ in self.index["features"].values()}
+        for path in self.store_dir.glob("shard-*.npy"):
+            if path.name not in live:
+                self._shards.pop(path.name, None)
+                path.unlink()
+        # left by an interrupted update
+        for path in self.store_dir.glob(".shard-*.tmp"):
+            path.unlink()
+
+    def _save_index(self):
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
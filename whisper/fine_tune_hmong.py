@@ -5,9 +5,18 @@ Uses librosa directly for audio loading to avoid decoder issues
 
 import os
 import csv
+import hashlib
+import json
+import math
+import random
+import sys
 import torch
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 import librosa
 import numpy as np
+import soundfile
+import time
 from pathlib import Path
 from dataclasses import dataclass
 from typing import Any, Dict, List, Union
@@ -24,16 +33,44 @@ from transformers import (
     Seq2SeqTrainingArguments,
     Seq2SeqTrainer,
 )
-import evaluate
+
+from feature_store import FeatureStore
 
 
 # Configuration
 MODEL_NAME = "openai/whisper-small"
 DATASET_DIR = Path("hmong_dataset")
 OUTPUT_DIR = Path("whisper-hmong-finetuned")
+FEATURE_STORE_DIR = Path("hmong_features")
 LANGUAGE = "vi"  # Vietnamese as base (Hmong not supported)
 TASK = "transcribe"
 SAMPLE_RATE = 16000
+# Processes extracting features; 0 uses every core
+FEATURE_WORKERS = int(os.environ.get("FEATURE_WORKERS", 0)) or os.cpu_count() or 1
+# 1 extracts every missing clip with the process pool before training, rather than in the
+# DataLoader workers during the first epoch
+PREEXTRACT_FEATURES = os.environ.get("PREEXTRACT_FEATURES", "0") == "1"
+# Starting a worker (importing torch, transformers, librosa) costs seconds, about as much as
+# extracting a few dozen clips, so small updates use fewer workers
+MIN_CLIPS_PER_WORKER = 32
+# DataLoader processes computing features during training; 0 computes them in the main process
+DATALOADER_WORKERS = int(
+    os.environ.get("DATALOADER_WORKERS", min(4, (os.cpu_count() or 1) // 2))
+)
+# Batches' worth of shuffled clips sorted by length together; 0 turns length bucketing off
+BUCKET_BATCHES = int(os.environ.get("BUCKET_BATCHES", 50))
+N_FRAMES = 3000  # the encoder input: 30 seconds of 10 ms frames
+# Bytes per second assumed for files whose header doesn't give their duration, e.g. the WebM
+# recordings from the browser (32 kbps Opus)
+ESTIMATED_BYTES_PER_SECOND = 4000
+# Incremental runs (--incremental): passes over the new rows, and older rows replayed per new row
+INCREMENTAL_EPOCHS = int(os.environ.get("INCREMENTAL_EPOCHS", 5))
+REPLAY_RATIO = float(os.environ.get("REPLAY_RATIO", 1.0))
+# Rows of transcripts.csv the model in OUTPUT_DIR was trained on, written after each run
+WATERMARK_FILE = OUTPUT_DIR / "dataset_watermark.json"
+
+# Set once per worker process by `init_feature_worker`
+_feature_extractor = None
 
 
 def load_audio(audio_path: str) -> np.ndarray:
@@ -53,12 +90,13 @@ def load_hmong_dataset():
     
     with open(transcript_file, 'r', encoding='utf-8') as f:
         reader = csv.DictReader(f)
-        for row in reader:
+        for index, row in enumerate(reader):
             audio_path = DATASET_DIR / row['audio_path']
             if audio_path.exists():
                 data.append({
                     "audio_path": str(audio_path),
-                    "text": row['text']
+                    "text": row['text'],
+                    "row": index
                 })
             else:
                 print(f"Warning: Audio file not found: {audio_path}")
@@ -67,27 +105,147 @@ def load_hmong_dataset():
     return data
 
 
-def prepare_features(samples, feature_extractor, tokenizer):
-    """Prepare features for training"""
-    prepared_data = {"input_features": [], "labels": []}
-    
-    for sample in samples:
-        # Load audio
-        audio = load_audio(sample["audio_path"])
-        
-        # Extract features
-        input_features = feature_extractor(
-            audio,
-            sampling_rate=SAMPLE_RATE
-        ).input_features[0]
-        
-        # Encode text
-        labels = tokenizer(sample["text"]).input_ids
-        
-        prepared_data["input_features"].append(input_features)
-        prepared_data["labels"].append(labels)
+def transcript_rows(limit=None):
+    """
+    The number of rows in transcripts.csv, or the first `limit`, and a digest of them, so a
+    later run can tell whether those rows were edited rather than only appended to
+    """
+    digest = hashlib.sha256()
+    rows = 0
+    with open(DATASET_DIR / "transcripts.csv", 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            if rows == limit:
+                break
+            digest.update(json.dumps([row['audio_path'], row['text']]).encode())
+            rows += 1
+    return rows, digest.hexdigest()
+
+
+def read_watermark():
+    """
+    The watermark of the model in OUTPUT_DIR if it can be trained further on appended rows:
+    the model weights are there and the rows it was trained on are unchanged. Otherwise
+    None, with the reason printed.
+    """
+    if not any((OUTPUT_DIR / name).exists() for name in ("model.safetensors", "pytorch_model.bin")):
+        print(f"   No fine-tuned model in {OUTPUT_DIR} to resume from")
+        return None
+    if not WATERMARK_FILE.exists():
+        print(f"   {WATERMARK_FILE} is missing, so the rows already trained on are unknown")
+        return None
     
-    return prepared_data
+    with open(WATERMARK_FILE, 'r', encoding='utf-8') as f:
+        watermark = json.load(f)
+    if transcript_rows(watermark["rows"]) != (watermark["rows"], watermark["digest"]):
+        print("   Rows the model was trained on have changed since the last run")
+        return None
+    return watermark
+
+
+def write_watermark(rows: int, digest: str, incremental: bool):
+    watermark = {"rows": rows, "digest": digest, "incremental": incremental, "time": time.time()}
+    tmp = WATERMARK_FILE.with_suffix(".tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(watermark, f, indent=2)
+    os.replace(tmp, WATERMARK_FILE)
+
+
+def audio_seconds(audio_path: str) -> float:
+    """
+    Duration of an audio file from its header, without decoding it; estimated from the file
+    size for formats libsndfile can't read. Only used to group clips of similar length.
+    """
+    try:
+        return soundfile.info(audio_path).duration
+    except RuntimeError:  # libsndfile errors
+        return os.path.getsize(audio_path) / ESTIMATED_BYTES_PER_SECOND
+
+
+def extract_features(audio_path: str, feature_extractor) -> np.ndarray:
+    """Load one clip and compute its log-mel input features"""
+    audio = load_audio(audio_path)
+    return feature_extractor(audio, sampling_rate=SAMPLE_RATE).input_features[0]
+
+
+def init_feature_worker(feature_extractor):
+    """Process pool initializer: keep the feature extractor for `extract_in_worker`"""
+    global _feature_extractor
+    # one process per core already, so each of them runs torch single-threaded
+    torch.set_num_threads(1)
+    _feature_extractor = feature_extractor
+
+
+def extract_in_worker(audio_path: str) -> np.ndarray:
+    return extract_features(audio_path, _feature_extractor)
+
+
+def extract_all(audio_paths, feature_extractor, workers=FEATURE_WORKERS):
+    """
+    Yield the features of each file in order. With several workers the files are split into
+    chunks across a process pool; results still come back in the order of `audio_paths`.
+    """
+    workers = min(workers, -(-len(audio_paths) // MIN_CLIPS_PER_WORKER))
+    if workers <= 1:
+        for audio_path in audio_paths:
+            yield extract_features(audio_path, feature_extractor)
+        return
+
+    # a few chunks per worker, so that slow files even out without much IPC per clip
+    chunksize = max(1, min(16, len(audio_paths) // (4 * workers)))
+    # spawn rather than fork: forking a process that has torch threads running can deadlock
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=get_context("spawn"),
+        initializer=init_feature_worker,
+        initargs=(feature_extractor,),
+    ) as pool:
+        yield from pool.map(extract_in_worker, audio_paths, chunksize=chunksize)
+
+
+def open_feature_store(feature_extractor, tokenizer) -> FeatureStore:
+    """Feature store for this extractor and tokenizer; either changing invalidates its rows"""
+    return FeatureStore(
+        FEATURE_STORE_DIR,
+        extractor_config={
+            "feature_extractor": feature_extractor.to_dict(),
+            "loader": f"librosa-{librosa.__version__}",
+            "sampling_rate": SAMPLE_RATE,
+        },
+        tokenizer_config={
+            "name": tokenizer.name_or_path,
+            "language": LANGUAGE,
+            "task": TASK,
+            "vocab_size": len(tokenizer),
+        },
+    )
+
+
+def update_feature_store(
+    store, samples, feature_extractor, tokenizer, prune=True, extract_missing=True
+):
+    """
+    Compute and save the features and labels of new or changed samples; without
+    `extract_missing`, only move the features DataLoader workers saved into a shard
+    """
+    start = time.perf_counter()
+
+    def report(done, total):
+        if done == total or done % max(10, total // 20) == 0:
+            rate = done / (time.perf_counter() - start)
+            print(f"   Stored {done}/{total} clips ({rate:.1f} clips/s)")
+
+    computed = store.update(
+        samples,
+        extract=(
+            (lambda audio_paths: extract_all(audio_paths, feature_extractor))
+            if extract_missing
+            else None
+        ),
+        tokenize=lambda text: tokenizer(text).input_ids,
+        progress=report,
+        prune=prune,
+    )
+    print(f"   {computed} new or changed clips stored in {FEATURE_STORE_DIR}")
 
 
 @dataclass
@@ -111,21 +269,120 @@ class DataCollatorSpeechSeq2SeqWithPadding:
             labels = labels[:, 1:]
 
         batch["labels"] = labels
+
+        # how much of the batch is padding; the trainer takes these out before the forward
+        # pass and logs them. Whisper's encoder only accepts full 30-second windows, so the
+        # audio padding can only be measured, not trimmed
+        if "input_length" in features[0]:
+            frames = sum(min(f["input_length"], N_FRAMES) for f in features)
+            batch["audio_padding"] = torch.tensor(1 - frames / (len(features) * N_FRAMES))
+            batch["label_padding"] = (labels == -100).float().mean()
         return batch
 
 
-class SimpleDataset(torch.utils.data.Dataset):
-    """Simple PyTorch dataset"""
-    def __init__(self, data):
-        self.data = data
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """
+    Shuffles the dataset every epoch, then sorts each run of `bucket_batches` batches by
+    (label length, audio length) and cuts it into batches, which are shuffled again. Batches
+    stay random across the epoch, but each holds clips of similar length, so little of it is
+    padding. Only the last batch of the epoch can be short, which keeps the batches aligned
+    with the DataLoader's.
+    """
+    def __init__(self, lengths, batch_size, bucket_batches=BUCKET_BATCHES, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.epoch = 0
     
     def __len__(self):
-        return len(self.data["input_features"])
+        return len(self.lengths)
+    
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        
+        order = torch.randperm(len(self.lengths), generator=generator).tolist()
+        size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(order), size):
+            bucket = sorted(order[start:start + size], key=lambda i: self.lengths[i])
+            batches += [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        
+        if not batches:
+            return
+        last = batches.pop() if len(batches[-1]) < self.batch_size else None
+        for i in torch.randperm(len(batches), generator=generator).tolist():
+            yield from batches[i]
+        if last:
+            yield from last
+
+
+class HmongSeq2SeqTrainer(Seq2SeqTrainer):
+    """Seq2SeqTrainer that batches training clips by length and logs the padding per batch"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.padding = {"audio_padding": [], "label_padding": []}
+        self.total_padding = {"audio_padding": [], "label_padding": []}
+    
+    def _get_train_sampler(self, train_dataset=None):
+        dataset = train_dataset if train_dataset is not None else self.train_dataset
+        if not BUCKET_BATCHES or not hasattr(dataset, "lengths"):
+            return super()._get_train_sampler(train_dataset)
+        return LengthBucketSampler(dataset.lengths, self.args.train_batch_size, seed=self.args.seed)
+    
+    def _prepare_inputs(self, inputs):
+        for key in self.padding:
+            value = inputs.pop(key, None)
+            if value is not None and self.model.training:
+                self.padding[key].append(float(value))
+                self.total_padding[key].append(float(value))
+        return super()._prepare_inputs(inputs)
+    
+    def log(self, logs, *args, **kwargs):
+        for key, values in self.padding.items():
+            if values:
+                logs[key] = round(sum(values) / len(values), 4)
+                values.clear()
+        super().log(logs, *args, **kwargs)
+
+
+class LazyDataset(torch.utils.data.Dataset):
+    """
+    Dataset that loads audio and computes features when a sample is requested, i.e. inside
+    the DataLoader workers, so training starts right away and memory is bounded by the batch
+    size times the prefetch depth. Samples already in the feature store are read from it;
+    with `cache`, the others are saved to it on first use, so later epochs and the next
+    `update_feature_store` reuse them. Label ids always come from the store, so they must
+    have been added with `FeatureStore.add_labels`.
+    """
+    def __init__(self, samples, store, feature_extractor, cache=True):
+        self.samples = samples
+        self.store = store
+        self.feature_extractor = feature_extractor
+        self.cache = cache
+        # (label tokens, audio seconds) of each sample, for length bucketing
+        self.lengths = [
+            (len(store.labels(sample)), audio_seconds(sample["audio_path"]))
+            for sample in samples
+        ]
+    
+    def __len__(self):
+        return len(self.samples)
     
     def __getitem__(self, idx):
+        sample = self.samples[idx]
+        input_features = self.store.lookup(sample)
+        if input_features is None:
+            input_features = extract_features(sample["audio_path"], self.feature_extractor)
+            if self.cache:
+                self.store.save_clip(sample, input_features)
+        
         return {
-            "input_features": self.data["input_features"][idx],
-            "labels": self.data["labels"][idx]
+            "input_features": input_features,
+            "labels": self.store.labels(sample),
+            "input_length": round(self.lengths[idx][1] * SAMPLE_RATE / 160),
         }
 
 
@@ -143,7 +400,7 @@ def compute_metrics(pred, tokenizer, metric):
     return {"wer": wer}
 
 
-def main():
+def main(incremental=False):
     print("=" * 60)
     print("🎤 Whisper Fine-tuning for Hmong Language")
     print("=" * 60)
@@ -156,39 +413,75 @@ def main():
     
     # Load dataset
     print("\n📂 Loading dataset...")
-    raw_data = load_hmong_dataset()
+    rows, digest = transcript_rows()
+    raw_data = [s for s in load_hmong_dataset() if s["row"] < rows]
     
     if len(raw_data) < 5:
         print(f"⚠️  Only {len(raw_data)} samples. Recommend at least 50+ for good results.")
     
-    # Split dataset (80/20)
-    split_idx = int(len(raw_data) * 0.8)
-    train_samples = raw_data[:split_idx]
-    test_samples = raw_data[split_idx:]
+    watermark = read_watermark() if incremental else None
+    if incremental and watermark is None:
+        print("   Falling back to training from scratch")
+        incremental = False
     
-    print(f"   Train: {len(train_samples)}, Test: {len(test_samples)}")
+    if incremental:
+        # Rows appended since the last run, plus a sample of older rows so the model
+        # doesn't forget them
+        new_samples = [s for s in raw_data if s["row"] >= watermark["rows"]]
+        if not new_samples:
+            print(f"   No rows added since the last run ({watermark['rows']} rows), nothing to do")
+            return
+        old_samples = [s for s in raw_data if s["row"] < watermark["rows"]]
+        replay = random.Random(rows).sample(
+            old_samples, min(len(old_samples), math.ceil(len(new_samples) * REPLAY_RATIO))
+        )
+        train_samples = new_samples + replay
+        test_samples = []
+        base_model = str(OUTPUT_DIR)
+        print(f"   Incremental: {len(new_samples)} new rows since row {watermark['rows']}, "
+              f"{len(replay)} replayed")
+    else:
+        # Split dataset (80/20)
+        split_idx = int(len(raw_data) * 0.8)
+        train_samples = raw_data[:split_idx]
+        test_samples = raw_data[split_idx:]
+        base_model = MODEL_NAME
+        
+        print(f"   Train: {len(train_samples)}, Test: {len(test_samples)}")
+        
+        # The watermark only covers the rows trained on, so the next incremental run
+        # trains on the held-out ones as well as on new rows
+        if test_samples:
+            rows, digest = transcript_rows(test_samples[0]["row"])
     
-    # Load model and processor
-    print(f"\n🔄 Loading model: {MODEL_NAME}")
+    # Load model and processor. The feature extractor and tokenizer always come from the
+    # base model, so that the feature store's keys stay the same between runs
+    print(f"\n🔄 Loading model: {base_model}")
     
     feature_extractor = WhisperFeatureExtractor.from_pretrained(MODEL_NAME)
     tokenizer = WhisperTokenizer.from_pretrained(MODEL_NAME, language=LANGUAGE, task=TASK)
     processor = WhisperProcessor.from_pretrained(MODEL_NAME, language=LANGUAGE, task=TASK)
     
-    model = WhisperForConditionalGeneration.from_pretrained(MODEL_NAME)
+    model = WhisperForConditionalGeneration.from_pretrained(base_model)
     model.generation_config.language = None
     model.generation_config.task = TASK
     model.generation_config.forced_decoder_ids = None
     
-    # Prepare features
-    print("\n⚙️  Preparing dataset (loading audio)...")
-    train_data = prepare_features(train_samples, feature_extractor, tokenizer)
-    test_data = prepare_features(test_samples, feature_extractor, tokenizer)
+    # Label ids are tokenized once into the store. Features are computed on demand by the
+    # DataLoader, or up front with PREEXTRACT_FEATURES=1; stored ones are reused
+    store = open_feature_store(feature_extractor, tokenizer)
+    samples = train_samples + test_samples
+    store.add_labels(samples, lambda text: tokenizer(text).input_ids)
+    if PREEXTRACT_FEATURES:
+        print(f"\n⚙️  Extracting features ({FEATURE_WORKERS} workers)...")
+        update_feature_store(store, samples, feature_extractor, tokenizer, prune=not incremental)
     
-    train_dataset = SimpleDataset(train_data)
-    test_dataset = SimpleDataset(test_data)
+    train_dataset = LazyDataset(train_samples, store, feature_extractor)
+    test_dataset = LazyDataset(test_samples, store, feature_extractor) if test_samples else None
     
-    print(f"   Prepared {len(train_dataset)} train, {len(test_dataset)} test samples")
+    stored = sum(store.is_stored(sample) for sample in samples)
+    print(f"\n⚙️  {stored}/{len(samples)} clips have stored features, "
+          f"the rest are computed by {DATALOADER_WORKERS or 'the main'} DataLoader worker(s)")
     
     # Data collator
     data_collator = DataCollatorSpeechSeq2SeqWithPadding(
@@ -197,39 +490,60 @@ def main():
     )
     
     # Metric
+    import evaluate  # only needed here, so feature workers don't import it
+
     metric = evaluate.load("wer")
     
     # Sort out device and pin_memory
     use_cuda = torch.cuda.is_available()
     
+    # Incremental runs take a few passes over their rows, without evaluation or checkpoints
+    batch_size = 2 * 4
+    if incremental:
+        schedule = dict(
+            max_steps=max(1, math.ceil(len(train_samples) * INCREMENTAL_EPOCHS / batch_size)),
+            warmup_steps=0,
+            eval_strategy="no",
+            save_strategy="no",
+            load_best_model_at_end=False,
+        )
+    else:
+        schedule = dict(
+            max_steps=50,
+            warmup_steps=5,
+            eval_strategy="steps",
+            save_steps=25,
+            eval_steps=25,
+            load_best_model_at_end=True,
+            metric_for_best_model="wer",
+            greater_is_better=False,
+        )
+    
     # Training arguments
     training_args = Seq2SeqTrainingArguments(
         output_dir=str(OUTPUT_DIR),
         per_device_train_batch_size=2,
         gradient_accumulation_steps=4,
         learning_rate=1e-5,
-        warmup_steps=5,
-        max_steps=50,
         gradient_checkpointing=True,
         fp16=use_cuda,
         # Optimize dataloader for CPU vs GPU
         dataloader_pin_memory=use_cuda, 
-        eval_strategy="steps",
+        dataloader_num_workers=DATALOADER_WORKERS,
+        dataloader_persistent_workers=DATALOADER_WORKERS > 0,
+        # the collator's padding measurements are not model inputs; the trainer removes them
+        remove_unused_columns=False,
         per_device_eval_batch_size=2,
         predict_with_generate=True,
         generation_max_length=225,
-        save_steps=25,
-        eval_steps=25,
         logging_steps=10,
         report_to=[],
-        load_best_model_at_end=True,
-        metric_for_best_model="wer",
-        greater_is_better=False,
         push_to_hub=False,
+        **schedule,
     )
     
     # Trainer
-    trainer = Seq2SeqTrainer(
+    trainer = HmongSeq2SeqTrainer(
         args=training_args,
         model=model,
         train_dataset=train_dataset,
@@ -243,14 +557,33 @@ def main():
     print("\n🚀 Starting training...")
     trainer.train()
     
+    padding = {k: sum(v) / len(v) for k, v in trainer.total_padding.items() if v}
+    if padding:
+        print(f"   Padding: {padding['audio_padding']:.1%} of audio frames, "
+              f"{padding['label_padding']:.1%} of label tokens")
+    
     # Save model
     print(f"\n💾 Saving model to {OUTPUT_DIR}")
     trainer.save_model()
     processor.save_pretrained(OUTPUT_DIR)
+    write_watermark(rows, digest, incremental)
+    
+    # Move the features computed during training into a shard for the next run, without
+    # extracting the clips training never asked for; an incremental run only adds its own
+    # rows and keeps the others. The model is saved already, so a failure here only costs
+    # the next run some extraction
+    print("\n⚙️  Updating feature store...")
+    try:
+        update_feature_store(
+            store, samples, feature_extractor, tokenizer,
+            prune=not incremental, extract_missing=False,
+        )
+    except Exception as e:
+        print(f"⚠️  Could not update the feature store: {e}")
     
     print("\n✅ Training complete!")
     print(f"   Model saved to: {OUTPUT_DIR}")
 
 
 if __name__ == "__main__":
-    main()
+    main(incremental="--incremental" in sys.argv[1:])
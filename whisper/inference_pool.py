@@ -0,0 +1,102 @@
+"""
+Inference executor for the API
+Keeps model calls and CPU-bound preprocessing off the event loop: a thread pool runs the
+torch calls (which release the GIL) and a process pool runs audio decoding, resampling and
+feature extraction. Admission is bounded so overload turns into HTTP 503 instead of an
+ever-growing queue.
+"""
+
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Optional
+
+
+class ExecutorBusy(Exception):
+    """Raised when the executor already has `max_pending` requests in progress"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server is busy; retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """
+    Thread pool for model inference plus process pool for CPU-bound preprocessing.
+
+    `inference_workers` should usually stay at 1 per model replica, since concurrent
+    generate calls on one model only contend for the same cores or GPU; throughput comes
+    from batching instead. `cpu_workers` defaults to the number of cores.
+    """
+
+    def __init__(
+        self,
+        inference_workers: int = 1,
+        cpu_workers: Optional[int] = None,
+        max_pending: int = 32,
+        retry_after: int = 1,
+        cpu_initializer: Optional[Callable] = None,
+        cpu_initargs: tuple = (),
+    ):
+        self.inference_workers = max(1, inference_workers)
+        self.cpu_workers = max(1, cpu_workers or os.cpu_count() or 1)
+        self.max_pending = max(1, max_pending)
+        self.retry_after = retry_after
+
+        self.inference_pool = ThreadPoolExecutor(
+            self.inference_workers, thread_name_prefix="inference"
+        )
+        # spawn rather than fork: forking a process that has torch threads running can deadlock
+        self.cpu_pool = ProcessPoolExecutor(
+            self.cpu_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=cpu_initializer,
+            initargs=cpu_initargs,
+        )
+
+        self.pending = 0
+        self.total_admitted = 0
+        self.total_rejected = 0
+
+    @contextmanager
+    def admit(self):
+        """Reserve a slot for one request, raising `ExecutorBusy` when the queue is full"""
+        if self.pending >= self.max_pending:
+            self.total_rejected += 1
+            raise ExecutorBusy(self.retry_after)
+
+        self.pending += 1
+        self.total_admitted += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    async def run_inference(self, fn: Callable, *args, **kwargs):
+        """Run a model call on the inference thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.inference_pool, partial(fn, *args, **kwargs)
+        )
+
+    async def run_cpu(self, fn: Callable, *args, **kwargs):
+        """Run a picklable, module-level function on the preprocessing process pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.cpu_pool, partial(fn, *args, **kwargs))
+
+    def stats(self) -> dict:
+        return {
+            "inference_workers": self.inference_workers,
+            "cpu_workers": self.cpu_workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "total_admitted": self.total_admitted,
+            "total_rejected": self.total_rejected,
+        }
+
+    def shutdown(self):
+        self.inference_pool.shutdown(wait=False, cancel_futures=True)
+        self.cpu_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,113 @@
+"""
+Long-form transcription for the API
+Audio longer than one 30-second window is sliced into consecutive windows whose features
+go through the encoder and decoder together in batches. Each window's timestamp tokens are
+split into segments with the same logic `whisper.transcribe` uses for its seek loop.
+"""
+
+from typing import List
+
+import numpy as np
+import torch
+
+from whisper.audio import CHUNK_LENGTH, N_SAMPLES, SAMPLE_RATE
+from whisper.transcribe import split_segments
+
+TIME_PRECISION = 0.02  # seconds per timestamp token
+
+
+def split_windows(audio: np.ndarray) -> List[np.ndarray]:
+    """Slice a waveform into consecutive 30-second windows; the last one may be shorter"""
+    if len(audio) == 0:
+        return [audio]
+    return [audio[i : i + N_SAMPLES] for i in range(0, len(audio), N_SAMPLES)]
+
+
+def window_durations(n_samples: int) -> List[float]:
+    """Seconds of audio in each window produced by `split_windows`"""
+    if n_samples == 0:
+        return [0.0]
+    return [
+        min(N_SAMPLES, n_samples - i) / SAMPLE_RATE
+        for i in range(0, n_samples, N_SAMPLES)
+    ]
+
+
+def window_segments(
+    tokens: torch.Tensor,
+    tokenizer,
+    window_index: int,
+    window_duration: float,
+) -> List[dict]:
+    """Turn one window's generated token ids into segments with absolute timestamps"""
+    timestamp_begin = tokenizer.convert_tokens_to_ids("<|0.00|>")
+    eot = tokenizer.eos_token_id
+
+    # drop the SOT sequence, EOT and padding; keep text and timestamp tokens
+    tokens = tokens[(tokens < eot) | (tokens >= timestamp_begin)]
+    if len(tokens) == 0:
+        return []
+
+    slices, last_timestamp_pos = split_segments(
+        tokens, timestamp_begin, TIME_PRECISION, window_duration
+    )
+    if last_timestamp_pos is not None:
+        # windows are fixed, so there is no next decode to resume at the last timestamp;
+        # keep the unfinished segment, running to the end of the window
+        consumed = sum(len(sliced) for _, _, sliced in slices)
+        slices.append(
+            (last_timestamp_pos * TIME_PRECISION, window_duration, tokens[consumed:])
+        )
+
+    time_offset = window_index * CHUNK_LENGTH
+    segments = []
+    for start, end, sliced in slices:
+        text_tokens = sliced[sliced < eot].tolist()
+        text = tokenizer.decode(text_tokens).strip()
+        if not text:
+            continue
+        # timestamps can't point past the audio actually in the window
+        start, end = min(start, window_duration), min(end, window_duration)
+        segments.append(
+            {
+                "start": round(time_offset + start, 2),
+                "end": round(time_offset + end, 2),
+                "text": text,
+            }
+        )
+    return segments
+
+
+def generate_long_form(
+    model,
+    processor,
+    features: List[np.ndarray],
+    durations: List[float],
+    batch_size: int = 8,
+) -> List[dict]:
+    """
+    Transcribe consecutive windows of one recording, `batch_size` windows per generate call.
+    `features` holds each window's (n_mels, 3000) log-mel input and `durations` the seconds
+    of audio in it. Returns the timestamped segments of the whole recording, in order.
+    """
+    device = model.device
+    segments = []
+    for i in range(0, len(features), batch_size):
+        input_features = torch.from_numpy(np.stack(features[i : i + batch_size])).to(
+            device, model.dtype
+        )
+        attention_mask = torch.ones(
+            input_features.shape[:-1], dtype=torch.long, device=device
+        )
+        with torch.no_grad():
+            predicted_ids = model.generate(
+                input_features,
+                attention_mask=attention_mask,
+                return_timestamps=True,
+            )
+
+        for j, tokens in enumerate(predicted_ids.cpu()):
+            segments.extend(
+                window_segments(tokens, processor.tokenizer, i + j, durations[i + j])
+            )
+    return segments
@@ -0,0 +1,117 @@
+"""
+CPU-bound audio preprocessing for the API
+These functions run inside the inference executor's worker processes, so this module must
+stay cheap to import and must not load the model.
+"""
+
+import io
+import warnings
+from subprocess import CalledProcessError, run
+from typing import List, Tuple
+
+import numpy as np
+
+from transcription_cache import pcm_digest
+
+SAMPLE_RATE = 16000
+
+# Set once per worker process by `init_worker`
+_frontend = None
+
+
+def init_worker(model_dir: str):
+    """
+    Process pool initializer: set up the log-Mel frontend once per worker. It computes the
+    same features as the model's WhisperFeatureExtractor, but keeps its window, filterbank
+    and STFT buffers between requests.
+    """
+    global _frontend
+
+    warnings.filterwarnings("ignore", category=UserWarning)
+    warnings.filterwarnings("ignore", category=FutureWarning)
+
+    from transformers import WhisperFeatureExtractor
+
+    from whisper.audio import mel_frontend
+
+    n_mels = WhisperFeatureExtractor.from_pretrained(model_dir).feature_size
+    _frontend = mel_frontend(n_mels)
+
+
+def load_audio(path: str) -> np.ndarray:
+    """Decode and resample an audio file to 16 kHz mono float32"""
+    import librosa
+
+    audio, _ = librosa.load(path, sr=SAMPLE_RATE)
+    return audio
+
+
+def decode_audio(data: bytes) -> np.ndarray:
+    """
+    Decode an in-memory audio file to 16 kHz mono float32 without touching the disk.
+
+    Formats libsndfile understands (WAV, FLAC, OGG, MP3) are read straight from memory;
+    anything else (e.g. WebM recorded by the browser) is piped through ffmpeg's stdin.
+    """
+    import soundfile
+
+    try:
+        audio, sr = soundfile.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    except (RuntimeError, TypeError):  # not a format libsndfile can read
+        return _decode_with_ffmpeg(data)
+
+    audio = audio.mean(axis=1)
+    if sr != SAMPLE_RATE:
+        import librosa
+
+        audio = librosa.resample(audio, orig_sr=sr, target_sr=SAMPLE_RATE)
+    return audio
+
+
+def _decode_with_ffmpeg(data: bytes) -> np.ndarray:
+    # same conversion as whisper.audio.load_audio, reading from stdin instead of a file
+    # fmt: off
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-threads", "0",
+        "-i", "pipe:0",
+        "-f", "s16le",
+        "-ac", "1",
+        "-acodec", "pcm_s16le",
+        "-ar", str(SAMPLE_RATE),
+        "-"
+    ]
+    # fmt: on
+    try:
+        out = run(cmd, input=data, capture_output=True, check=True).stdout
+    except CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+
+    return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+
+
+def extract_window_features(audio: np.ndarray) -> Tuple[List[np.ndarray], List[float]]:
+    """Compute the input features of each 30-second window and the seconds of audio in each"""
+    import torch
+
+    from long_form import split_windows, window_durations
+    from whisper.audio import N_SAMPLES
+
+    features = [
+        _frontend(torch.from_numpy(window), padding=N_SAMPLES - len(window)).numpy()
+        for window in split_windows(audio)
+    ]
+    return features, window_durations(len(audio))
+
+
+def load_features(path: str) -> Tuple[List[np.ndarray], List[float], str]:
+    """Decode an audio file; return its window features, window durations and PCM digest"""
+    audio = load_audio(path)
+    return (*extract_window_features(audio), pcm_digest(audio))
+
+
+def decode_features(data: bytes) -> Tuple[List[np.ndarray], List[float], str]:
+    """Same as `load_features`, for an in-memory audio file"""
+    audio = decode_audio(data)
+    return (*extract_window_features(audio), pcm_digest(audio))
@@ -0,0 +1,28 @@
+"""
+int8 dynamic quantization of the fine-tuned Hmong model for CPU inference
+The weights of every linear layer of the encoder and decoder, and of the output projection,
+are stored as int8 and their inputs are quantized on the fly; convolutions, embeddings and
+layer norms stay in float32. Quantized layers only run on CPU.
+"""
+
+from typing import Optional
+
+import torch
+
+QUANTIZE_MODES = ("int8",)
+
+
+def quantize_model(model: torch.nn.Module, mode: Optional[str]) -> torch.nn.Module:
+    """Quantize a WhisperForConditionalGeneration in place; `mode` None leaves it as is"""
+    if mode is None:
+        return model
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(
+            f"Unsupported quantization {mode!r}; supported: {QUANTIZE_MODES}"
+        )
+    if model.device.type != "cpu":
+        raise ValueError("int8 quantization is only supported on CPU")
+
+    return torch.ao.quantization.quantize_dynamic(
+        model.float().eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
@@ -0,0 +1,102 @@
+"""
+Model weights shared between API worker processes
+The first process to load a model revision writes its state dict to one file (by default on
+/dev/shm); every worker then memory-maps that file and builds its model around the mapped
+tensors instead of reading a private copy, so N workers keep a single copy of the weights in
+memory whatever the checkpoint format. Workers only read the weights, so the pages stay shared.
+"""
+
+import fcntl
+import os
+from pathlib import Path
+
+import torch
+from transformers import (
+    GenerationConfig,
+    WhisperConfig,
+    WhisperForConditionalGeneration,
+)
+
+from transcription_cache import model_revision
+
+
+def shared_weights_path(model_dir: str, shared_dir: str) -> Path:
+    """File holding the weights of the current revision of `model_dir`"""
+    return Path(shared_dir) / f"{Path(model_dir).name}-{model_revision(model_dir)}.pt"
+
+
+def export_weights(model_dir: str, path: Path) -> None:
+    """
+    Write the state dict of `model_dir` to `path` unless it is already there. Workers starting
+    together take turns on a lock file, so only the first one loads the checkpoint; files left
+    behind by older revisions of the same model are removed.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.parent / f"{path.name}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if path.exists():
+            return
+
+        model = WhisperForConditionalGeneration.from_pretrained(model_dir)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save(model.state_dict(), tmp)
+        os.replace(tmp, path)
+
+        for stale in path.parent.glob(f"{Path(model_dir).name}-{'?' * 16}.pt"):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+                Path(f"{stale}.lock").unlink(missing_ok=True)
+
+
+def load_shared_model(
+    model_dir: str, shared_dir: str
+) -> WhisperForConditionalGeneration:
+    """Load `model_dir` with its parameters mapped from the shared weights file"""
+    path = shared_weights_path(model_dir, shared_dir)
+    if not path.exists():
+        export_weights(model_dir, path)
+
+    state_dict = torch.load(path, mmap=True, map_location="cpu", weights_only=True)
+    with torch.device("meta"):
+        model = WhisperForConditionalGeneration(
+            WhisperConfig.from_pretrained(model_dir)
+        )
+    # assign keeps the mapped tensors instead of copying them into fresh parameters; tied
+    # weights share one storage in the file, so they stay tied
+    model.load_state_dict(state_dict, assign=True)
+    if (Path(model_dir) / "generation_config.json").exists():
+        model.generation_config = GenerationConfig.from_pretrained(model_dir)
+    return model.eval()
+
+
+def worker_report(load_seconds: float) -> dict:
+    """
+    Startup time and memory of this process. `shared_mib` counts resident file and shared
+    memory pages (mapped weights, libraries), `private_mib` anonymous ones; `pss_mib` splits
+    each shared page between the processes mapping it, so it adds up across workers.
+    """
+    status = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM", "RssAnon", "RssFile", "RssShmem"):
+                status[key] = int(value.split()[0]) / 1024
+
+    pss = None
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    pss = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return {
+        "pid": os.getpid(),
+        "load_seconds": round(load_seconds, 3),
+        "rss_mib": round(status.get("VmRSS", 0), 1),
+        "peak_rss_mib": round(status.get("VmHWM", 0), 1),
+        "shared_mib": round(status.get("RssFile", 0) + status.get("RssShmem", 0), 1),
+        "private_mib": round(status.get("RssAnon", 0), 1),
+        "pss_mib": None if pss is None else round(pss, 1),
+    }
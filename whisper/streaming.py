@@ -0,0 +1,183 @@
+"""
+Real-time transcription sessions for the WebSocket endpoint
+Each session keeps a bounded rolling buffer of 16 kHz PCM, decides when the live window
+should be re-decoded, and turns hypotheses into partial and finalized segments.
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from whisper.audio import (
+    HOP_LENGTH,
+    N_FFT,
+    N_FRAMES,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    mel_frontend,
+)
+
+
+@dataclass
+class StreamingConfig:
+    n_mels: int = 80
+    # the live window is finalized once it is this long
+    max_window_seconds: float = 30.0
+    decode_interval_seconds: float = 1.0  # re-decode after this much new audio
+    min_decode_seconds: float = 0.5  # don't decode windows shorter than this
+    silence_seconds: float = 0.8  # trailing silence that ends a segment
+    silence_rms: float = 0.01  # RMS level below which audio counts as silence
+    max_prompt_chars: int = 200  # committed text carried over as the decoding prompt
+
+
+class StreamingSession:
+    """
+    Rolling audio buffer and segmentation state for one connection.
+
+    Memory per session is bounded by the preallocated `max_window_seconds` buffer and the
+    log-Mel frames of a 30-second window, plus `max_prompt_chars` of committed text;
+    finalized segments are handed to the caller and not retained.
+
+    The log-Mel frames are kept unnormalized as the window grows, so that each decode only
+    computes the frames of the samples received since the previous one, plus the few at the
+    end of the audio that overlap its padding.
+    """
+
+    def __init__(self, config: Optional[StreamingConfig] = None):
+        self.config = config or StreamingConfig()
+        self.max_samples = min(
+            int(self.config.max_window_seconds * SAMPLE_RATE), N_SAMPLES
+        )
+        self.buffer = np.zeros(self.max_samples, dtype=np.float32)
+        self.length = 0  # valid samples in the buffer
+        self.frontend = mel_frontend(self.config.n_mels)
+        self.log_spec = torch.empty(self.config.n_mels, N_FRAMES)
+        self.n_frames = 0  # frames of log_spec that only cover buffered samples
+
+        self.window_start = 0  # stream offset (in samples) of buffer[0]
+        self.decoded_length = 0  # buffer length at the last decode
+        self.last_received = None  # perf_counter of the newest chunk in the buffer
+        self.committed_text = ""
+
+    @property
+    def full(self) -> bool:
+        return self.length >= self.max_samples
+
+    def append(self, pcm: np.ndarray) -> np.ndarray:
+        """
+        Add float32 samples to the live window, returning whatever did not fit.
+        The caller should finalize the window and append the remainder again.
+        """
+        n = min(len(pcm), self.max_samples - self.length)
+        self.buffer[self.length : self.length + n] = pcm[:n]
+        self.length += n
+        self.last_received = time.perf_counter()
+        return pcm[n:]
+
+    def should_decode(self) -> bool:
+        new_audio = (self.length - self.decoded_length) / SAMPLE_RATE
+        return (
+            self.length / SAMPLE_RATE >= self.config.min_decode_seconds
+            and new_audio >= self.config.decode_interval_seconds
+        )
+
+    def should_finalize(self) -> bool:
+        """A segment ends when the window is full or speech is followed by silence"""
+        if self.full:
+            return True
+
+        tail = int(self.config.silence_seconds * SAMPLE_RATE)
+        if self.length <= tail:
+            return False
+
+        def rms(x):
+            return float(np.sqrt(np.mean(x**2))) if len(x) else 0.0
+
+        speech = rms(self.buffer[: self.length - tail]) >= self.config.silence_rms
+        silent_tail = (
+            rms(self.buffer[self.length - tail : self.length]) < self.config.silence_rms
+        )
+        return speech and silent_tail
+
+    def _extend_frames(self):
+        """Compute the frames that the samples appended since the last call complete"""
+        # frame i covers the samples around i * HOP_LENGTH, and the first ones a reflection
+        # of buffer[1 : N_FFT // 2 + 1]
+        if self.length < N_FFT:
+            return
+        n_frames = (self.length - N_FFT // 2 - 1) // HOP_LENGTH + 1
+        if n_frames <= self.n_frames:
+            return
+
+        audio = torch.from_numpy(self.buffer)
+        start = self.n_frames * HOP_LENGTH - N_FFT // 2
+        end = (n_frames - 1) * HOP_LENGTH + N_FFT // 2
+        if start < 0:
+            samples = torch.cat([audio[1 : N_FFT // 2 + 1].flip(0), audio[:end]])
+        else:
+            samples = audio[start:end]
+        self.log_spec[:, self.n_frames : n_frames] = self.frontend.log_mel(samples)
+        self.n_frames = n_frames
+
+    def features(self) -> np.ndarray:
+        """
+        Log-mel features of the live window, padded to the 30-second encoder input; the same
+        as `log_mel_spectrogram(audio, padding=N_SAMPLES - len(audio))` of the buffered audio
+        """
+        self._extend_frames()
+        if self.n_frames == 0:
+            audio = torch.from_numpy(self.buffer[: self.length])
+            return self.frontend(audio, N_SAMPLES - self.length).numpy()
+
+        # the frames after the kept ones overlap the zero padding, which is reflected at the
+        # end as torch.stft(center=True) does
+        padding = N_SAMPLES - self.length
+        start = self.n_frames * HOP_LENGTH - N_FFT // 2
+        audio = torch.from_numpy(self.buffer[start : self.length])
+        if padding < N_FFT:
+            n_tail = N_FRAMES - self.n_frames
+            samples = F.pad(audio, (0, padding))
+            samples = F.pad(samples[None], (0, N_FFT // 2), "reflect")[0]
+        else:
+            # later frames only cover zeros, whose log-Mel is the floor of the log scale
+            n_tail = min(-(-len(audio) // HOP_LENGTH), N_FRAMES - self.n_frames)
+            samples = F.pad(audio, (0, N_FFT))
+        samples = samples[: (n_tail - 1) * HOP_LENGTH + N_FFT]
+
+        log_spec = torch.full((self.config.n_mels, N_FRAMES), -10.0)
+        log_spec[:, : self.n_frames] = self.log_spec[:, : self.n_frames]
+        log_spec[:, self.n_frames : self.n_frames + n_tail] = self.frontend.log_mel(
+            samples
+        )
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        return log_spec.add_(4.0).div_(4.0).numpy()
+
+    def prompt(self) -> str:
+        return self.committed_text[-self.config.max_prompt_chars :]
+
+    def segment(self, kind: str, text: str) -> dict:
+        """Build a partial or final message for the current window"""
+        now = time.perf_counter()
+        latency = (now - self.last_received) * 1000 if self.last_received else 0.0
+        self.decoded_length = self.length
+        return {
+            "type": kind,
+            "text": text,
+            "start": round(self.window_start / SAMPLE_RATE, 3),
+            "end": round((self.window_start + self.length) / SAMPLE_RATE, 3),
+            "latency_ms": round(latency, 1),
+        }
+
+    def commit(self, text: str):
+        """Finalize the live window: keep its text as the next prompt and reset the buffer"""
+        if text:
+            self.committed_text = (self.committed_text + " " + text).strip()
+            self.committed_text = self.committed_text[-self.config.max_prompt_chars :]
+        self.window_start += self.length
+        self.length = 0
+        self.n_frames = 0
+        self.decoded_length = 0
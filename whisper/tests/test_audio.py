@@ -1,8 +1,26 @@
 import os.path
+import sys
+import wave
 
 import numpy as np
+import pytest
+import torch
 
-from whisper.audio import SAMPLE_RATE, load_audio, log_mel_spectrogram
+from whisper.audio import (
+    MAX_KEPT_PCM_SAMPLES,
+    N_FRAMES,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    AudioDecoder,
+    LogMelStream,
+    MelFrontend,
+    _buffers,
+    _decode_pcm16,
+    load_audio,
+    log_mel_spectrogram,
+    log_mel_spectrogram_batch,
+    mel_filters,
+)
 
 
 def test_audio():
@@ -17,3 +35,140 @@ def test_audio():
 
     assert np.allclose(mel_from_audio, mel_from_file)
     assert mel_from_audio.max() - mel_from_audio.min() <= 2.0
+
+
+def write_wav(path, samples, sr=SAMPLE_RATE, channels=1):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(samples.astype("<i2").tobytes())
+
+
+def test_load_wav_in_process(tmp_path, monkeypatch):
+    samples = np.random.default_rng(0).integers(-30000, 30000, SAMPLE_RATE, np.int16)
+    write_wav(tmp_path / "clip.wav", samples)
+
+    # 16 kHz mono PCM needs neither resampling nor down-mixing, so ffmpeg is not launched
+    def no_ffmpeg(*args, **kwargs):
+        raise AssertionError("ffmpeg should not be needed")
+
+    monkeypatch.setattr("whisper.audio.Popen", no_ffmpeg)
+    loaded = load_audio(str(tmp_path / "clip.wav"))
+    assert loaded.dtype == np.float32
+    assert np.array_equal(loaded, samples / np.float32(32768.0))
+
+    # other rates go through ffmpeg
+    write_wav(tmp_path / "clip_8k.wav", samples, sr=8000)
+    with pytest.raises(AssertionError, match="ffmpeg"):
+        load_audio(str(tmp_path / "clip_8k.wav"))
+
+
+def test_audio_decoder_keeps_order(tmp_path):
+    rng = np.random.default_rng(0)
+    clips = [
+        rng.integers(-30000, 30000, n, np.int16) for n in (16000, 4000, 32000, 800)
+    ]
+    paths = []
+    for i, clip in enumerate(clips):
+        write_wav(tmp_path / f"{i}.wav", clip)
+        paths.append(str(tmp_path / f"{i}.wav"))
+
+    with AudioDecoder(num_workers=2) as decoder:
+        decoded = list(decoder.map(paths * 3, prefetch=3))
+        assert np.array_equal(decoder.load(paths[1]), clips[1] / np.float32(32768.0))
+
+    assert [len(a) for a in decoded] == [len(c) for c in clips] * 3
+    for audio, clip in zip(decoded, clips * 3):
+        assert np.array_equal(audio, clip / np.float32(32768.0))
+
+
+def test_decode_pcm16_buffer(tmp_path, monkeypatch):
+    # a stand-in for ffmpeg that writes the raw samples of a file to stdout
+    def cat_command(file, sr):
+        return [
+            sys.executable,
+            "-c",
+            f"import sys; sys.stdout.buffer.write(open({file!r}, 'rb').read())",
+        ]
+
+    monkeypatch.setattr("whisper.audio._ffmpeg_command", cat_command)
+    rng = np.random.default_rng(0)
+    for n in (1000, N_SAMPLES + 1, 1000, MAX_KEPT_PCM_SAMPLES + 1):
+        samples = rng.integers(-30000, 30000, n, np.int16)
+        samples.tofile(tmp_path / "clip.pcm")
+        assert np.array_equal(
+            _decode_pcm16(str(tmp_path / "clip.pcm"), SAMPLE_RATE), samples
+        )
+        kept = getattr(_buffers, "pcm", None)
+        if n > MAX_KEPT_PCM_SAMPLES:
+            assert kept is None  # a long file's buffer is not held on to
+        else:
+            assert kept.size >= n
+
+
+@pytest.mark.parametrize("chunk_size", [100, 7777, N_SAMPLES])
+def test_log_mel_stream(chunk_size):
+    torch.manual_seed(0)
+    audio = torch.randn(20 * SAMPLE_RATE + 123) * 0.1
+    expected = log_mel_spectrogram(audio, padding=N_SAMPLES)
+
+    stream = LogMelStream(audio, chunk_size=chunk_size)
+    n_frames = stream.read(N_FRAMES)
+    assert stream.ended
+    assert n_frames == expected.shape[-1] - N_FRAMES
+    # one window, so normalizing by its maximum is the same as by the recording's
+    assert torch.allclose(stream.window(0, n_frames), expected[:, :n_frames], atol=1e-5)
+
+    # frames before a requested window are released
+    assert stream.window(1000, 500).shape == (80, 500)
+    with pytest.raises(ValueError):
+        stream.window(0, 500)
+
+
+def test_log_mel_spectrogram_batch():
+    torch.manual_seed(0)
+    clips = [
+        torch.randn(n) * scale for n, scale in [(16000, 0.1), (3201, 1.0), (800, 0.01)]
+    ]
+    mel, n_frames = log_mel_spectrogram_batch(clips, padding=N_SAMPLES)
+
+    assert mel.shape == (3, 80, n_frames.max())
+    for clip, clip_mel, length in zip(clips, mel, n_frames):
+        expected = log_mel_spectrogram(clip, padding=N_SAMPLES)
+        assert length == expected.shape[-1]
+        assert torch.allclose(clip_mel[:, :length], expected, atol=1e-5)
+        assert not clip_mel[:, length:].any()
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16])
+def test_mel_frontend(dtype):
+    torch.manual_seed(0)
+    audio = torch.randn(5 * SAMPLE_RATE + 123) * 0.1
+    window = torch.hann_window(400)
+    stft = torch.stft(audio, 400, 160, window=window, return_complex=True)
+    log_spec = (
+        (mel_filters("cpu", 80) @ stft[..., :-1].abs() ** 2).clamp(min=1e-10).log10()
+    )
+    expected = (torch.maximum(log_spec, log_spec.max() - 8.0) + 4.0) / 4.0
+
+    # blocks smaller than the spectrogram, and the buffers reused by a second call
+    frontend = MelFrontend(dtype=dtype, block_frames=128)
+    for _ in range(2):
+        mel = frontend(audio)
+        assert mel.dtype == torch.float32
+        assert torch.allclose(
+            mel, expected, atol=1e-5 if dtype == torch.float32 else 1e-3
+        )
+
+
+def test_log_mel_spectrogram_leading_dims():
+    torch.manual_seed(0)
+    audio = torch.randn(2, 3, 8000) * torch.tensor([0.01, 0.1, 1.0])[:, None]
+    mel = log_mel_spectrogram(audio, padding=160)
+
+    expected = [
+        log_mel_spectrogram(waveform, padding=160) for waveform in audio.reshape(6, -1)
+    ]
+    assert mel.shape == (2, 3, 80, 51)
+    assert torch.allclose(mel.reshape(6, 80, 51), torch.stack(expected))
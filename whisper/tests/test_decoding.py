@@ -0,0 +1,287 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+import whisper
+from whisper.decoding import (
+    ApplyTimestampRules,
+    BeamSearchDecoder,
+    Inference,
+    PyTorchInference,
+)
+from whisper.tokenizer import get_tokenizer
+
+
+@pytest.mark.parametrize("beam_size", [None, 3])
+def test_batched_decode_matches_single(tiny_model, beam_size):
+    mel = torch.randn(3, 80, 3000)
+    options = whisper.DecodingOptions(
+        language="en", fp16=False, beam_size=beam_size, sample_len=8
+    )
+
+    batched = whisper.decode(tiny_model, mel, options)
+    single = [whisper.decode(tiny_model, m, options) for m in mel]
+
+    assert [r.tokens for r in batched] == [r.tokens for r in single]
+
+
+def reference_timestamp_rules(rules, logits, tokens):
+    """The original row-by-row implementation of ApplyTimestampRules.apply"""
+    tokenizer = rules.tokenizer
+    if tokenizer.no_timestamps is not None:
+        logits[:, tokenizer.no_timestamps] = -np.inf
+
+    for k in range(tokens.shape[0]):
+        sampled_tokens = tokens[k, rules.sample_begin :]
+        seq = sampled_tokens.tolist()
+        last_was_timestamp = len(seq) >= 1 and seq[-1] >= tokenizer.timestamp_begin
+        penultimate_was_timestamp = len(seq) < 2 or seq[-2] >= tokenizer.timestamp_begin
+
+        if last_was_timestamp:
+            if penultimate_was_timestamp:
+                logits[k, tokenizer.timestamp_begin :] = -np.inf
+            else:
+                logits[k, : tokenizer.eot] = -np.inf
+
+        timestamps = sampled_tokens[sampled_tokens.ge(tokenizer.timestamp_begin)]
+        if timestamps.numel() > 0:
+            if last_was_timestamp and not penultimate_was_timestamp:
+                timestamp_last = timestamps[-1]
+            else:
+                timestamp_last = timestamps[-1] + 1
+            logits[k, tokenizer.timestamp_begin : timestamp_last] = -np.inf
+
+    if tokens.shape[1] == rules.sample_begin:
+        logits[:, : tokenizer.timestamp_begin] = -np.inf
+        if rules.max_initial_timestamp_index is not None:
+            last_allowed = tokenizer.timestamp_begin + rules.max_initial_timestamp_index
+            logits[:, last_allowed + 1 :] = -np.inf
+
+    logprobs = F.log_softmax(logits.float(), dim=-1)
+    for k in range(tokens.shape[0]):
+        timestamp_logprob = logprobs[k, tokenizer.timestamp_begin :].logsumexp(dim=-1)
+        max_text_token_logprob = logprobs[k, : tokenizer.timestamp_begin].max()
+        if timestamp_logprob > max_text_token_logprob:
+            logits[k, : tokenizer.timestamp_begin] = -np.inf
+
+
+@pytest.mark.parametrize("n_sampled", [0, 1, 2, 5, 20])
+def test_apply_timestamp_rules_matches_reference(random, n_sampled):
+    tokenizer = get_tokenizer(multilingual=True, language="en")
+    sample_begin = 3
+    rules = ApplyTimestampRules(tokenizer, sample_begin, 50)
+    vocab_size = tokenizer.timestamp_begin + 1501
+
+    for _ in range(20):
+        n_rows = np.random.randint(1, 10)
+        text = torch.randint(0, tokenizer.eot, (n_rows, sample_begin + n_sampled))
+        timestamps = torch.randint(tokenizer.timestamp_begin, vocab_size, text.shape)
+        tokens = torch.where(torch.rand(text.shape) < 0.4, timestamps, text)
+
+        # scale so that either side of the timestamp/text comparison can win
+        logits = torch.randn(n_rows, vocab_size) * np.random.uniform(0.5, 8)
+        expected = logits.clone()
+        reference_timestamp_rules(rules, expected, tokens)
+        rules.apply(logits, tokens)
+
+        assert torch.equal(logits, expected)
+
+
+class ReferenceBeamSearchDecoder(BeamSearchDecoder):
+    """The original dict-based implementation of BeamSearchDecoder"""
+
+    def update(self, tokens, logits, sum_logprobs):
+        n_audio = tokens.shape[0] // self.beam_size
+        if self.finished_sequences is None:
+            self.finished_sequences = [{} for _ in range(n_audio)]
+
+        logprobs = F.log_softmax(logits.float(), dim=-1)
+        next_tokens, source_indices, finished_sequences = [], [], []
+        for i in range(n_audio):
+            scores, sources, finished = {}, {}, {}
+            for j in range(self.beam_size):
+                idx = i * self.beam_size + j
+                prefix = tokens[idx].tolist()
+                for logprob, token in zip(*logprobs[idx].topk(self.beam_size + 1)):
+                    new_logprob = (sum_logprobs[idx] + logprob).item()
+                    sequence = tuple(prefix + [token.item()])
+                    scores[sequence] = new_logprob
+                    sources[sequence] = idx
+
+            saved = 0
+            for sequence in sorted(scores, key=scores.get, reverse=True):
+                if sequence[-1] == self.eot:
+                    finished[sequence] = scores[sequence]
+                else:
+                    sum_logprobs[len(next_tokens)] = scores[sequence]
+                    next_tokens.append(sequence)
+                    source_indices.append(sources[sequence])
+                    saved += 1
+                    if saved == self.beam_size:
+                        break
+
+            finished_sequences.append(finished)
+
+        tokens = torch.tensor(next_tokens, device=tokens.device)
+        self.inference.rearrange_kv_cache(source_indices)
+
+        for previously_finished, newly_finished in zip(
+            self.finished_sequences, finished_sequences
+        ):
+            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
+                if len(previously_finished) >= self.max_candidates:
+                    break
+                previously_finished[seq] = newly_finished[seq]
+
+        completed = all(
+            len(sequences) >= self.max_candidates
+            for sequences in self.finished_sequences
+        )
+        return tokens, completed
+
+    def finalize(self, preceding_tokens, sum_logprobs):
+        sum_logprobs = sum_logprobs.cpu()
+        for i, sequences in enumerate(self.finished_sequences):
+            if len(sequences) < self.beam_size:
+                for j in list(np.argsort(sum_logprobs[i]))[::-1]:
+                    sequence = preceding_tokens[i, j].tolist() + [self.eot]
+                    sequences[tuple(sequence)] = sum_logprobs[i][j].item()
+                    if len(sequences) >= self.beam_size:
+                        break
+
+        tokens = [
+            [torch.tensor(seq) for seq in sequences.keys()]
+            for sequences in self.finished_sequences
+        ]
+        sum_logprobs = [
+            list(sequences.values()) for sequences in self.finished_sequences
+        ]
+        return tokens, sum_logprobs
+
+
+class NoCacheInference(Inference):
+    def rearrange_kv_cache(self, source_indices):
+        pass
+
+
+@pytest.mark.parametrize("beam_size", [1, 2, 5])
+@pytest.mark.parametrize("patience", [None, 2.0])
+@pytest.mark.parametrize("quantize", [False, True])
+def test_beam_search_matches_reference(random, beam_size, patience, quantize):
+    n_audio, n_vocab, eot = 3, 40, 39
+
+    for _ in range(5):
+        decoders = [
+            cls(beam_size, eot, NoCacheInference(), patience)
+            for cls in (BeamSearchDecoder, ReferenceBeamSearchDecoder)
+        ]
+        prefix = torch.randint(0, eot, (n_audio, 3))
+        states = [
+            (
+                prefix.repeat_interleave(beam_size, dim=0),
+                torch.zeros(n_audio * beam_size),
+            )
+            for _ in decoders
+        ]
+
+        for step in range(12):
+            logits = torch.randn(n_audio * beam_size, n_vocab) * 2
+            logits[:, eot] += np.random.uniform(-2, 4)
+            if quantize:
+                logits = logits.round()  # produces ties between candidates
+            if step == 0:
+                # all beams of an audio start from the same prefix, so they see the same logits
+                logits = logits[::beam_size].repeat_interleave(beam_size, dim=0)
+
+            results = []
+            for k, decoder in enumerate(decoders):
+                tokens, sum_logprobs = states[k]
+                tokens, completed = decoder.update(tokens, logits, sum_logprobs)
+                states[k] = (tokens, sum_logprobs)
+                results.append((tokens, sum_logprobs.clone(), completed))
+
+            (tokens, sum_logprobs, completed), expected = results
+            assert torch.equal(tokens, expected[0])
+            assert torch.equal(sum_logprobs, expected[1])
+            assert completed == expected[2]
+            if completed:
+                break
+
+        outputs = [
+            decoder.finalize(
+                tokens.reshape(n_audio, beam_size, -1),
+                sum_logprobs.reshape(n_audio, beam_size),
+            )
+            for decoder, (tokens, sum_logprobs) in zip(decoders, states)
+        ]
+        (tokens, sum_logprobs), (expected_tokens, expected_sum_logprobs) = outputs
+        assert sum_logprobs == expected_sum_logprobs
+        assert [[t.tolist() for t in s] for s in tokens] == [
+            [t.tolist() for t in s] for s in expected_tokens
+        ]
+
+
+def test_static_kv_cache(tiny_model):
+    audio_features = tiny_model.embed_audio(torch.randn(4, 80, 3000))
+    tokens = torch.randint(0, 50000, (4, 3))
+    reorders = [[2, 0, 0, 1], [3, 2, 1, 0], [0, 1, 2, 3], [1, 1, 3, 3]]
+
+    logits = {}
+    for static_length in (None, 8):
+        inference = PyTorchInference(tiny_model, 3, static_length)
+        steps, sequence = [], tokens
+        with torch.no_grad():
+            for source_indices in reorders:
+                steps.append(inference.logits(sequence, audio_features)[:, -1])
+                inference.rearrange_kv_cache(torch.tensor(source_indices))
+                sequence = sequence[source_indices]
+                sequence = torch.cat([sequence, steps[-1].argmax(-1)[:, None]], dim=-1)
+        inference.cleanup_caching()
+        logits[static_length] = torch.stack(steps)
+
+    torch.testing.assert_close(logits[8], logits[None])
+
+    options = whisper.DecodingOptions(
+        language="en", fp16=False, beam_size=3, sample_len=5
+    )
+    static = whisper.DecodingOptions(**{**vars(options), "static_kv_cache": True})
+    mel = torch.randn(2, 80, 3000)
+    expected = [r.tokens for r in whisper.decode(tiny_model, mel, options)]
+    assert [r.tokens for r in whisper.decode(tiny_model, mel, static)] == expected
+
+
+def test_decode_several_temperatures(tiny_model):
+    mel = torch.randn(80, 3000)
+    options = whisper.DecodingOptions(language="en", fp16=False, sample_len=8)
+
+    results = whisper.decode(tiny_model, mel, options, temperature=(0.0, 0.5, 1.0))
+    assert [r.temperature for r in results] == [0.0, 0.5, 1.0]
+    assert results[0].tokens == whisper.decode(tiny_model, mel, options).tokens
+
+    results = whisper.decode(
+        tiny_model, mel, options, temperature=(0.0, 1.0), best_of=3
+    )
+    assert len(results) == 2
+    assert results[0].tokens == whisper.decode(tiny_model, mel, options).tokens
+
+    with pytest.raises(ValueError):
+        whisper.decode(tiny_model, mel, options, temperature=(0.0, 1.0), beam_size=2)
+    with pytest.raises(ValueError):
+        whisper.decode(tiny_model, mel.repeat(2, 1, 1), options, temperature=(0.0, 1.0))
+
+
+def test_quantize_int8(tiny_model):
+    mel = torch.randn(2, 80, 3000)
+    tokens = torch.tensor([[50258, 50259, 50359]] * 2)
+    with torch.no_grad():
+        expected = tiny_model(mel, tokens)
+
+    tiny_model.quantize_int8()
+    assert not any(isinstance(m, whisper.model.Linear) for m in tiny_model.modules())
+    with torch.no_grad():
+        logits = tiny_model(mel, tokens)
+
+    assert (logits - expected).abs().max() < 0.05 * expected.abs().max()
+    options = whisper.DecodingOptions(language="en", fp16=False, sample_len=8)
+    assert len(whisper.decode(tiny_model, mel, options)) == 2
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+
+import pytest
+import torch
+
+import whisper
+from whisper import _sha256
+
+
+@pytest.mark.parametrize("half", [False, True])
+def test_load_model_mmap(tiny_model, tmp_path, half):
+    state_dict = tiny_model.state_dict()
+    if half:
+        state_dict = {k: v.half() for k, v in state_dict.items()}
+    path = str(tmp_path / "tiny.pt")
+    torch.save({"dims": vars(tiny_model.dims), "model_state_dict": state_dict}, path)
+
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.tensor([[50258, 50259, 50359]])
+    models = [whisper.load_model(path, "cpu", mmap=mmap) for mmap in (False, True)]
+    with torch.no_grad():
+        expected, logits = [model(mel, tokens) for model in models]
+
+    torch.testing.assert_close(logits, expected)
+    assert all(p.dtype == torch.float32 for p in models[1].parameters())
+    assert models[1].decoder.mask.isneginf().sum() == 448 * 447 // 2
+
+
+@pytest.mark.parametrize("half", [False, True])
+def test_load_model_maps_float32_checkpoints_by_default(
+    tiny_model, tmp_path, monkeypatch, half
+):
+    state_dict = tiny_model.state_dict()
+    if half:
+        state_dict = {k: v.half() for k, v in state_dict.items()}
+    path = str(tmp_path / "tiny.pt")
+    torch.save({"dims": vars(tiny_model.dims), "model_state_dict": state_dict}, path)
+
+    devices = []
+
+    class Whisper(whisper.Whisper):
+        def __init__(self, dims):
+            super().__init__(dims)
+            devices.append(self.decoder.token_embedding.weight.device.type)
+
+    monkeypatch.setattr(whisper, "Whisper", Whisper)
+    model = whisper.load_model(path, "cpu")
+
+    # float16 weights are read, as mapping them would still convert them into a copy
+    assert devices == ["cpu" if half else "meta"]
+    assert model.decoder.mask.device.type == "cpu"
+    assert model.alignment_heads.device.type == "cpu"
+
+
+def test_load_model_mmap_needs_torch_2_1(tiny_model, tmp_path, monkeypatch):
+    path = str(tmp_path / "tiny.pt")
+    state_dict = tiny_model.state_dict()
+    torch.save({"dims": vars(tiny_model.dims), "model_state_dict": state_dict}, path)
+
+    load = torch.load
+
+    def torch_2_0_load(*args, **kwargs):
+        if "mmap" in kwargs:
+            raise TypeError("load() got an unexpected keyword argument 'mmap'")
+        return load(*args, **kwargs)
+
+    monkeypatch.setattr(torch, "__version__", "2.0.1")
+    monkeypatch.setattr(torch, "load", torch_2_0_load)
+    model = whisper.load_model(path, "cpu")
+    for name, tensor in state_dict.items():
+        torch.testing.assert_close(model.state_dict()[name], tensor)
+
+
+def test_sha256_is_cached(tmp_path):
+    path = str(tmp_path / "model.pt")
+    with open(path, "wb") as f:
+        f.write(b"weights")
+    assert _sha256(path) == hashlib.sha256(b"weights").hexdigest()
+
+    with open(path + ".sha256") as f:
+        assert json.load(f)["sha256"] == hashlib.sha256(b"weights").hexdigest()
+
+    # an unchanged file is not read again
+    with open(path + ".sha256", "w") as f:
+        stat = os.stat(path)
+        json.dump({"size": 7, "mtime_ns": stat.st_mtime_ns, "sha256": "cached"}, f)
+    assert _sha256(path) == "cached"
+
+    # a modified file is
+    with open(path, "wb") as f:
+        f.write(b"new weights")
+    assert _sha256(path) == hashlib.sha256(b"new weights").hexdigest()
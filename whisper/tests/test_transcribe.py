@@ -1,10 +1,13 @@
 import os
+import sys
 
+import numpy as np
 import pytest
 import torch
 
 import whisper
 from whisper.tokenizer import get_tokenizer
+from whisper.transcribe import split_segments
 
 
 @pytest.mark.parametrize("model_name", whisper.available_models())
@@ -40,3 +43,165 @@ def test_transcribe(model_name: str):
                 timing_checked = True
 
     assert timing_checked
+
+
+def test_split_segments():
+    tb = 50364  # <|0.00|>
+    tokens = torch.tensor([tb, 10, 11, tb + 50, tb + 50, 12, tb + 100, tb + 100, 13])
+    segments, last_timestamp_pos = split_segments(tokens, tb, 0.02, 30.0)
+
+    assert [(start, end) for start, end, _ in segments] == [(0.0, 1.0), (1.0, 2.0)]
+    assert segments[0][2].tolist() == [tb, 10, 11, tb + 50]
+    assert last_timestamp_pos == 100  # the trailing "13" is an unfinished segment
+
+    tokens = torch.tensor([tb, 10, tb + 50, tb + 50, 12, tb + 100])
+    segments, last_timestamp_pos = split_segments(tokens, tb, 0.02, 30.0)
+    assert len(segments) == 2 and segments[-1][:2] == (1.0, 2.0)
+    assert last_timestamp_pos is None
+
+    tokens = torch.tensor([tb, 10, 11, tb + 75])
+    segments, last_timestamp_pos = split_segments(tokens, tb, 0.02, 30.0)
+    assert segments[0][:2] == (0.0, 1.5)
+    assert last_timestamp_pos is None
+
+
+def test_transcribe_batched(tiny_model):
+    audio = torch.randn(75 * 16000) * 0.1
+    options = dict(
+        language="en",
+        fp16=False,
+        temperature=0.0,
+        condition_on_previous_text=False,
+        sample_len=16,
+    )
+
+    with pytest.raises(ValueError):
+        tiny_model.transcribe(
+            audio, **{**options, "condition_on_previous_text": True}, batch_size=2
+        )
+
+    results = [tiny_model.transcribe(audio, **options, batch_size=n) for n in (2, 3)]
+    assert results[0]["text"] == results[1]["text"]
+    assert {s["seek"] for s in results[0]["segments"]} <= {0, 3000, 6000}
+
+
+def test_transcribe_streaming_mel(tiny_model):
+    audio = torch.randn(75 * 16000) * 0.1
+    options = dict(language="en", fp16=False, temperature=0.0, sample_len=16)
+
+    with pytest.raises(ValueError):
+        tiny_model.transcribe(
+            audio,
+            **options,
+            condition_on_previous_text=False,
+            batch_size=2,
+            streaming_mel=True,
+        )
+
+    expected = tiny_model.transcribe(audio, **options)
+    result = tiny_model.transcribe(audio, **options, streaming_mel=True)
+    assert result["text"] == expected["text"]
+    assert [s["seek"] for s in result["segments"]] == [
+        s["seek"] for s in expected["segments"]
+    ]
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_fallback_encodes_once(tiny_model, batch_size):
+    windows_encoded, cross_projections, temperatures = [], [], []
+    decode = tiny_model.decode
+    tiny_model.decode = lambda mel, options, *args: (
+        temperatures.extend([options.temperature] * (len(mel) if mel.ndim == 3 else 1)),
+        decode(mel, options, *args),
+    )[1]
+    tiny_model.encoder.register_forward_hook(
+        lambda _, inputs, __: windows_encoded.append(inputs[0].shape[0])
+    )
+    tiny_model.decoder.blocks[0].cross_attn.key.register_forward_hook(
+        lambda _, __, output: cross_projections.append(output.shape[0])
+    )
+
+    # every decode fails the logprob threshold, so each window goes through all temperatures
+    audio = torch.randn(45 * 16000) * 0.1
+    result = tiny_model.transcribe(
+        audio,
+        language="en",
+        fp16=False,
+        temperature=(0.0, 0.5, 1.0),
+        best_of=2,
+        logprob_threshold=0.0,
+        no_speech_threshold=None,
+        condition_on_previous_text=False,
+        word_timestamps=True,
+        sample_len=8,
+        batch_size=batch_size,
+    )
+
+    n_windows = temperatures.count(0.0)
+    assert temperatures.count(0.5) == temperatures.count(1.0) == n_windows >= 2
+    assert all(s["temperature"] == 1.0 for s in result["segments"])
+    assert sum(windows_encoded) == n_windows
+    # once for all temperatures, and once more in the word alignment pass
+    assert sum(cross_projections) == 2 * n_windows
+
+
+@pytest.mark.parametrize("beam_size", [None, 2])
+def test_batched_fallback(tiny_model, beam_size):
+    decodes = []
+    decode = tiny_model.decode
+    tiny_model.decode = lambda mel, options, *args: (
+        decodes.append(options.temperature),
+        decode(mel, options, *args),
+    )[1]
+
+    # every decode fails the logprob threshold
+    result = tiny_model.transcribe(
+        torch.randn(20 * 16000) * 0.1,
+        language="en",
+        fp16=False,
+        temperature=(0.0, 0.5, 1.0),
+        best_of=2,
+        beam_size=beam_size,
+        logprob_threshold=0.0,
+        no_speech_threshold=None,
+        sample_len=8,
+        batched_fallback=True,
+    )
+
+    assert all(s["temperature"] == 1.0 for s in result["segments"])
+    if beam_size is None:
+        assert set(decodes) == {(0.0, 0.5, 1.0)}
+    else:
+        assert set(decodes[::2]) == {0.0} and set(decodes[1::2]) == {(0.5, 1.0)}
+
+
+@pytest.mark.parametrize("decode_workers", [0, 2])
+def test_cli_decode_workers(tiny_model, tmp_path, monkeypatch, decode_workers):
+    module = sys.modules["whisper.transcribe"]
+    paths = [str(tmp_path / f"{i}.wav") for i in range(3)]
+    loaded, transcribed = [], []
+
+    def load_audio(file, sr):
+        loaded.append(file)
+        return np.zeros(sr, dtype=np.float32)
+
+    def transcribe(model, audio, **kwargs):
+        transcribed.append(audio)
+        return {"text": "", "segments": [], "language": "en"}
+
+    monkeypatch.setattr(whisper, "load_model", lambda *args, **kwargs: tiny_model)
+    monkeypatch.setattr(whisper.audio, "load_audio", load_audio)
+    monkeypatch.setattr(module, "transcribe", transcribe)
+    argv = ["whisper", *paths, "--output_dir", str(tmp_path), "--output_format", "txt"]
+    monkeypatch.setattr(sys, "argv", [*argv, "--decode_workers", str(decode_workers)])
+    module.cli()
+
+    if decode_workers == 0:
+        # transcribe() decodes each file itself, in the main thread
+        assert loaded == [] and transcribed == paths
+    else:
+        assert loaded == paths and all(isinstance(a, np.ndarray) for a in transcribed)
+
+    monkeypatch.setattr(sys, "argv", [*argv, "--decode_workers", "-1"])
+    with pytest.raises(SystemExit):
+        module.cli()
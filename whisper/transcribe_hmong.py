@@ -6,10 +6,17 @@ import torch
 from transformers import WhisperProcessor, WhisperForConditionalGeneration
 import sys
 from pathlib import Path
+from typing import Optional
 
+from quantization import quantize_model
 
-def transcribe_hmong(audio_path: str, model_dir: str = "whisper-hmong-finetuned"):
-    """Transcribe Hmong audio using fine-tuned model"""
+
+def transcribe_hmong(
+    audio_path: str,
+    model_dir: str = "whisper-hmong-finetuned",
+    quantize: Optional[str] = None,
+):
+    """Transcribe Hmong audio using fine-tuned model; quantize="int8" for faster CPU inference"""
     
     model_path = Path(model_dir)
     if not model_path.exists():
@@ -18,6 +25,10 @@ def transcribe_hmong(audio_path: str, model_dir: str = "whisper-hmong-finetuned"
         return
     
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    if quantize and device != "cpu":
+        # quantized kernels only run on the CPU
+        print(f"⚠️  {quantize} quantization runs on the CPU; not using {device}")
+        device = "cpu"
     print(f"Device: {device}")
     
     # Load processor and model
@@ -25,6 +36,9 @@ def transcribe_hmong(audio_path: str, model_dir: str = "whisper-hmong-finetuned"
     processor = WhisperProcessor.from_pretrained(model_dir)
     model = WhisperForConditionalGeneration.from_pretrained(model_dir)
     model.to(device)
+    if quantize:
+        print(f"Quantization: {quantize}")
+        model = quantize_model(model, quantize)
     
     # Load audio
     import librosa
@@ -53,11 +67,17 @@ def transcribe_hmong(audio_path: str, model_dir: str = "whisper-hmong-finetuned"
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python transcribe_hmong.py <audio_file> [model_dir]")
+    args = sys.argv[1:]
+    quantize = None
+    if "--int8" in args:
+        args.remove("--int8")
+        quantize = "int8"
+    
+    if len(args) < 1:
+        print("Usage: python transcribe_hmong.py <audio_file> [model_dir] [--int8]")
         sys.exit(1)
     
-    audio_file = sys.argv[1]
-    model_dir = sys.argv[2] if len(sys.argv) > 2 else "whisper-hmong-finetuned"
+    audio_file = args[0]
+    model_dir = args[1] if len(args) > 1 else "whisper-hmong-finetuned"
     
-    transcribe_hmong(audio_file, model_dir)
+    transcribe_hmong(audio_file, model_dir, quantize)
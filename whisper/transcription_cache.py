@@ -0,0 +1,204 @@
+"""
+Content-addressed cache of transcription results
+Keys are hashes of the decoded PCM plus the model revision and decode options, so the same
+recording re-uploaded under any filename or container format hits the cache. Results live
+in an in-process LRU tier and, optionally, an SQLite tier on disk; both are bounded by size.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+
+
+def pcm_digest(audio: np.ndarray) -> str:
+    """SHA256 of a decoded waveform, independent of the file it was decoded from"""
+    return hashlib.sha256(np.ascontiguousarray(audio, dtype=np.float32)).hexdigest()
+
+
+def model_revision(model_dir: str) -> str:
+    """Fingerprint of a model directory from its files' names, sizes and mtimes"""
+    h = hashlib.sha256()
+    for path in sorted(Path(model_dir).glob("*")):
+        if path.is_file():
+            stat = path.stat()
+            h.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return h.hexdigest()[:16]
+
+
+def make_key(audio_digest: str, revision: str, options: dict) -> str:
+    payload = json.dumps([audio_digest, revision, options], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class TranscriptionCache:
+    """
+    Two-tier cache of JSON-serializable results.
+
+    The memory tier evicts least-recently-used entries once it holds more than
+    `max_memory_bytes`; the disk tier (enabled by `db_path`) evicts least-recently-accessed
+    rows once they exceed `max_disk_bytes`, down to `DISK_LOW_WATER` of it so that the next
+    puts don't evict again. Disk hits are promoted into memory.
+    """
+
+    DISK_LOW_WATER = 0.9
+
+    def __init__(
+        self,
+        max_memory_bytes: int = 64 * 1024 * 1024,
+        db_path: Optional[str] = None,
+        max_disk_bytes: int = 1024 * 1024 * 1024,
+    ):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.db_path = db_path
+
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+            self._db.commit()
+        # a running total of the disk tier, so that puts don't sum the table; re-summed
+        # before evicting, as other processes may share the database
+        self._disk_total = self._disk_bytes() if self._db is not None else 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(self._memory[key])
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE results SET accessed = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+                    self._db.commit()
+                    self._put_memory(key, row[0])
+                    self.disk_hits += 1
+                    return json.loads(row[0])
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Any):
+        encoded = json.dumps(value)
+        with self._lock:
+            self._put_memory(key, encoded)
+            if self._db is not None:
+                self._put_disk(key, encoded)
+
+    def _put_memory(self, key: str, encoded: str):
+        if key in self._memory:
+            self._memory_bytes -= self._entry_size(key, self._memory.pop(key))
+
+        size = self._entry_size(key, encoded)
+        if size > self.max_memory_bytes:
+            return
+
+        self._memory[key] = encoded
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            old_key, old_value = self._memory.popitem(last=False)
+            self._memory_bytes -= self._entry_size(old_key, old_value)
+            self.memory_evictions += 1
+
+    def _put_disk(self, key: str, encoded: str):
+        size = self._entry_size(key, encoded)
+        old = self._db.execute(
+            "SELECT size FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        self._db.execute(
+            "INSERT OR REPLACE INTO results (key, value, size, accessed) "
+            "VALUES (?, ?, ?, ?)",
+            (key, encoded, size, time.time()),
+        )
+        self._disk_total += size - (old[0] if old else 0)
+
+        if self._disk_total > self.max_disk_bytes:
+            self._disk_total = self._disk_bytes()
+            low_water = self.max_disk_bytes * self.DISK_LOW_WATER
+            # drop the least recently accessed rows, a batch at a time, until we are
+            # back under the low-water mark
+            while self._disk_total > low_water:
+                rows = self._db.execute(
+                    "SELECT key, size FROM results ORDER BY accessed ASC LIMIT ?",
+                    (64,),
+                ).fetchall()
+                if not rows:
+                    break
+                for old_key, old_size in rows:
+                    if self._disk_total <= low_water:
+                        break
+                    self._db.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                    self._disk_total -= old_size
+                    self.disk_evictions += 1
+        self._db.commit()
+
+    def _disk_bytes(self) -> int:
+        return self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()[0]
+
+    @staticmethod
+    def _entry_size(key: str, encoded: str) -> int:
+        return len(key) + len(encoded.encode())
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            stats = {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    round((self.memory_hits + self.disk_hits) / lookups, 4)
+                    if lookups
+                    else 0.0
+                ),
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+                "memory_evictions": self.memory_evictions,
+                "disk_enabled": self._db is not None,
+            }
+            if self._db is not None:
+                stats.update(
+                    disk_entries=self._db.execute(
+                        "SELECT COUNT(*) FROM results"
+                    ).fetchone()[0],
+                    disk_bytes=self._disk_bytes(),
+                    max_disk_bytes=self.max_disk_bytes,
+                    disk_evictions=self.disk_evictions,
+                )
+            return stats
@@ -1,5 +1,6 @@
 import hashlib
 import io
+import json
 import os
 import urllib
 import warnings
@@ -51,6 +52,39 @@ _ALIGNMENT_HEADS = {
 }
 
 
+def _sha256(path: str) -> str:
+    """
+    SHA256 of a file, read in chunks. The result is cached in a `.sha256` file next to it,
+    keyed by the file's size and modification time, so that an unchanged file is not read
+    again on every startup.
+    """
+    stat = os.stat(path)
+    key = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    sidecar = path + ".sha256"
+
+    try:
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if {k: cached.get(k) for k in key} == key:
+            return cached["sha256"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+
+    try:
+        with open(sidecar, "w") as f:
+            json.dump({**key, "sha256": digest}, f)
+    except OSError:
+        pass  # e.g. a read-only download root; the checksum is just not cached
+
+    return digest
+
+
 def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
     os.makedirs(root, exist_ok=True)
 
@@ -61,10 +95,11 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        with open(download_target, "rb") as f:
-            model_bytes = f.read()
-        if hashlib.sha256(model_bytes).hexdigest() == expected_sha256:
-            return model_bytes if in_memory else download_target
+        if _sha256(download_target) == expected_sha256:
+            if in_memory:
+                with open(download_target, "rb") as f:
+                    return f.read()
+            return download_target
         else:
             warnings.warn(
                 f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file"
@@ -86,13 +121,15 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
                 output.write(buffer)
                 loop.update(len(buffer))
 
-    model_bytes = open(download_target, "rb").read()
-    if hashlib.sha256(model_bytes).hexdigest() != expected_sha256:
+    if _sha256(download_target) != expected_sha256:
         raise RuntimeError(
             "Model has been downloaded but the SHA256 checksum does not not match. Please retry loading the model."
         )
 
-    return model_bytes if in_memory else download_target
+    if in_memory:
+        with open(download_target, "rb") as f:
+            return f.read()
+    return download_target
 
 
 def available_models() -> List[str]:
@@ -105,6 +142,8 @@ def load_model(
     device: Optional[Union[str, torch.device]] = None,
     download_root: str = None,
     in_memory: bool = False,
+    quantize: Optional[str] = None,
+    mmap: Optional[bool] = None,
 ) -> Whisper:
     """
     Load a Whisper ASR model
@@ -120,6 +159,15 @@ def load_model(
         path to download the model files; by default, it uses "~/.cache/whisper"
     in_memory: bool
         whether to preload the model weights into host memory
+    quantize: str
+        "int8" to quantize the weights of the linear layers to int8 for faster, smaller CPU
+        inference, or None to keep the checkpoint's weights
+    mmap: Optional[bool]
+        whether to memory-map the checkpoint instead of reading it, when it is not loaded
+        in memory and torch is 2.1 or newer; float32 weights on the CPU then stay backed
+        by the file, and are read lazily and shared through the page cache between
+        processes. By default only float32 checkpoints are mapped, as others (e.g. the
+        official float16 ones) are converted into a float32 copy anyway
 
     Returns
     -------
@@ -129,6 +177,10 @@ def load_model(
 
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
+    if quantize not in (None, "int8"):
+        raise ValueError(f"Unsupported quantization {quantize}; supported: int8")
+    if quantize is not None and torch.device(device).type != "cpu":
+        raise ValueError("int8 quantization is only supported on CPU")
     if download_root is None:
         default = os.path.join(os.path.expanduser("~"), ".cache")
         download_root = os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
@@ -144,18 +196,45 @@ def load_model(
             f"Model {name} not found; available models = {available_models()}"
         )
 
-    with (
-        io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")
-    ) as fp:
-        kwargs = {"weights_only": True} if torch.__version__ >= "1.13" else {}
-        checkpoint = torch.load(fp, map_location=device, **kwargs)
-    del checkpoint_file
+    checkpoint = None
+    kwargs = {"weights_only": True} if torch.__version__ >= "1.13" else {}
+    # mmap in torch.load and assign in load_state_dict need torch 2.1
+    if mmap is not False and not in_memory and torch.__version__ >= "2.1":
+        try:
+            checkpoint = torch.load(
+                checkpoint_file, map_location="cpu", mmap=True, **kwargs
+            )
+        except RuntimeError:
+            pass  # not a zipfile checkpoint, which is required for mmap
+        if mmap is None and checkpoint is not None:
+            state_dict = checkpoint["model_state_dict"]
+            if any(t.dtype != torch.float32 for t in state_dict.values()):
+                checkpoint = None  # read it instead
+
+    if checkpoint is not None:
+        # build the model on the meta device, without allocating or initializing weights,
+        # and use the memory-mapped tensors of the checkpoint as its parameters
+        dims = ModelDimensions(**checkpoint["dims"])
+        with torch.device("meta"):
+            model = Whisper(dims)
+        model.load_state_dict(checkpoint["model_state_dict"], assign=True)
+        if any(p.dtype != torch.float32 for p in model.parameters()):
+            model.float()  # e.g. half-precision checkpoints; this copies the weights
+    else:
+        with (
+            io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")
+        ) as fp:
+            checkpoint = torch.load(fp, map_location=device, **kwargs)
 
-    dims = ModelDimensions(**checkpoint["dims"])
-    model = Whisper(dims)
-    model.load_state_dict(checkpoint["model_state_dict"])
+        dims = ModelDimensions(**checkpoint["dims"])
+        model = Whisper(dims)
+        model.load_state_dict(checkpoint["model_state_dict"])
+    del checkpoint_file, checkpoint
 
     if alignment_heads is not None:
         model.set_alignment_heads(alignment_heads)
 
+    if quantize == "int8":
+        model.quantize_int8()
+
     return model.to(device)
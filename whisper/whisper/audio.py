@@ -1,7 +1,12 @@
 import os
+import tempfile
+import threading
+import wave
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import lru_cache
-from subprocess import CalledProcessError, run
-from typing import Optional, Union
+from subprocess import PIPE, Popen
+from typing import Iterable, Iterator, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
@@ -38,11 +43,93 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
     -------
     A NumPy array containing the audio waveform, in float32 dtype.
     """
+    chunks = _read_pcm16(file, sr)
+    pcm = next(chunks) if chunks is not None else _decode_pcm16(file, sr)
+    return pcm.astype(np.float32) / 32768.0
 
+
+def stream_audio(
+    file: str, sr: int = SAMPLE_RATE, chunk_size: int = N_SAMPLES
+) -> Iterator[np.ndarray]:
+    """
+    Open an audio file and read it as mono waveform chunk by chunk while it is being decoded,
+    so that long recordings are never held in memory at once
+
+    Parameters
+    ----------
+    file: str
+        The audio file to open
+
+    sr: int
+        The sample rate to resample the audio if necessary
+
+    chunk_size: int
+        The number of samples in each chunk; the last one may be shorter
+
+    Returns
+    -------
+    An iterator over NumPy arrays containing the consecutive parts of the waveform, in float32 dtype.
+    """
+    chunks = _read_pcm16(file, sr, chunk_size)
+    if chunks is None:
+        chunks = _stream_pcm16(file, sr, chunk_size)
+    for pcm in chunks:
+        yield pcm.astype(np.float32) / 32768.0
+
+
+def _read_pcm16(
+    file: str, sr: int, chunk_size: Optional[int] = None
+) -> Optional[Iterator[np.ndarray]]:
+    """
+    Read WAV and FLAC files that already hold 16-bit mono PCM at `sr` without launching
+    ffmpeg, which would return the same samples. Returns None for any other file, otherwise
+    an iterator over chunks of `chunk_size` samples (all of them in one chunk by default).
+    """
+    try:
+        with open(file, "rb") as f:
+            magic = f.read(4)
+    except (OSError, TypeError, ValueError):  # not a local file, e.g. a URL
+        return None
+
+    if magic == b"RIFF":
+        try:
+            f = wave.open(file, "rb")
+        except (wave.Error, EOFError):  # e.g. float samples
+            return None
+        if (f.getnchannels(), f.getsampwidth(), f.getframerate()) != (1, 2, sr):
+            f.close()
+            return None
+        return _read_wav_chunks(f, chunk_size)
+
+    if magic == b"fLaC":
+        try:
+            import soundfile
+        except ImportError:
+            return None
+        info = soundfile.info(file)
+        if (info.channels, info.subtype, info.samplerate) != (1, "PCM_16", sr):
+            return None
+        if chunk_size is None:
+            return iter([soundfile.read(file, dtype="int16")[0]])
+        return soundfile.blocks(file, blocksize=chunk_size, dtype="int16")
+
+    return None
+
+
+def _read_wav_chunks(f: wave.Wave_read, chunk_size: Optional[int]):
+    with f:
+        if chunk_size is None:
+            yield np.frombuffer(f.readframes(f.getnframes()), "<i2")
+            return
+        while data := f.readframes(chunk_size):
+            yield np.frombuffer(data, "<i2")
+
+
+def _ffmpeg_command(file: str, sr: int):
     # This launches a subprocess to decode audio while down-mixing
     # and resampling as necessary.  Requires the ffmpeg CLI in PATH.
     # fmt: off
-    cmd = [
+    return [
         "ffmpeg",
         "-nostdin",
         "-threads", "0",
@@ -54,12 +141,119 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
         "-"
     ]
     # fmt: on
-    try:
-        out = run(cmd, capture_output=True, check=True).stdout
-    except CalledProcessError as e:
-        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
 
-    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+# Each decoding thread keeps the int16 buffer ffmpeg's output is read into, so decoding many
+# files reuses one allocation instead of collecting and joining the output per file. A buffer
+# grown past MAX_KEPT_PCM_SAMPLES by a long file is dropped after it, rather than held for the
+# thread's lifetime.
+_buffers = threading.local()
+MAX_KEPT_PCM_SAMPLES = 4 * N_SAMPLES
+
+
+def _decode_pcm16(file: str, sr: int) -> np.ndarray:
+    buffer = getattr(_buffers, "pcm", None)
+    if buffer is None:
+        buffer = _buffers.pcm = np.empty(N_SAMPLES, np.int16)
+
+    # stderr goes to a file so that a chatty ffmpeg can't block on a full pipe while stdout
+    # is being read
+    with tempfile.TemporaryFile() as stderr:
+        with Popen(
+            _ffmpeg_command(file, sr), stdout=PIPE, stderr=stderr, bufsize=0
+        ) as process:
+            size = 0
+            while True:
+                if size == buffer.nbytes:
+                    buffer = _buffers.pcm = np.concatenate(
+                        [buffer, np.empty_like(buffer)]
+                    )
+                n = process.stdout.readinto(memoryview(buffer).cast("B")[size:])
+                if not n:
+                    break
+                size += n
+
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"Failed to load audio: {stderr.read().decode()}")
+
+    # the buffer is reused by the next file, so the caller gets a copy
+    pcm = buffer[: size // 2].copy()
+    if buffer.size > MAX_KEPT_PCM_SAMPLES:
+        del _buffers.pcm
+    return pcm
+
+
+def _stream_pcm16(file: str, sr: int, chunk_size: int) -> Iterator[np.ndarray]:
+    with tempfile.TemporaryFile() as stderr:
+        with Popen(
+            _ffmpeg_command(file, sr), stdout=PIPE, stderr=stderr, bufsize=0
+        ) as process:
+            try:
+                size = chunk = None
+                while size is None or size == chunk.nbytes:
+                    chunk = np.empty(chunk_size, np.int16)
+                    view = memoryview(chunk).cast("B")
+                    size = 0
+                    while size < chunk.nbytes:
+                        n = process.stdout.readinto(view[size:])
+                        if not n:
+                            break
+                        size += n
+                    if size:
+                        yield chunk[: size // 2]
+            finally:
+                if process.poll() is None:  # the caller stopped reading early
+                    process.kill()
+
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"Failed to load audio: {stderr.read().decode()}")
+
+
+class AudioDecoder:
+    """
+    A pool of threads that decode audio files with `load_audio`, so that at most
+    `num_workers` ffmpeg processes run at a time. The threads persist across calls; use the
+    decoder as a context manager, or call `close()`, to stop them.
+    """
+
+    def __init__(self, num_workers: Optional[int] = None, sr: int = SAMPLE_RATE):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.sr = sr
+        self.pool = ThreadPoolExecutor(self.num_workers, thread_name_prefix="audio")
+
+    def submit(self, file: str) -> Future:
+        """Start decoding `file`; the future's result is its waveform"""
+        return self.pool.submit(load_audio, file, self.sr)
+
+    def load(self, file: str) -> np.ndarray:
+        return self.submit(file).result()
+
+    def map(
+        self, files: Iterable[str], prefetch: Optional[int] = None
+    ) -> Iterator[np.ndarray]:
+        """
+        Decode `files` concurrently and yield their waveforms in order. At most `prefetch`
+        files (twice the number of workers by default) are decoded ahead of the consumer.
+        """
+        prefetch = prefetch or 2 * self.num_workers
+        pending = deque()
+        for file in files:
+            pending.append(self.submit(file))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
@@ -88,7 +282,7 @@ def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
     return array
 
 
-@lru_cache(maxsize=None)
+@lru_cache(maxsize=16)
 def mel_filters(device, n_mels: int) -> torch.Tensor:
     """
     load the mel filterbank matrix for projecting STFT into a Mel spectrogram.
@@ -107,6 +301,107 @@ def mel_filters(device, n_mels: int) -> torch.Tensor:
         return torch.from_numpy(f[f"mel_{n_mels}"]).to(device)
 
 
+class MelFrontend:
+    """
+    The log-Mel frontend of one device. The Hann window and the Mel filterbank are built once,
+    and the STFT runs in blocks of `block_frames` frames through work buffers that each thread
+    allocates on first use and then reuses, so a call only allocates its padded input and its
+    output. With `dtype=torch.float16` the Mel projection runs in half precision, which is
+    meant for GPUs; the log and the normalization stay in float32.
+    """
+
+    def __init__(
+        self,
+        n_mels: int = 80,
+        device: Optional[Union[str, torch.device]] = None,
+        dtype: torch.dtype = torch.float32,
+        block_frames: int = N_FRAMES,
+    ):
+        self.n_mels = n_mels
+        self.device = torch.device(device or "cpu")
+        self.dtype = dtype
+        self.block_frames = block_frames
+        self.window = torch.hann_window(N_FFT, device=self.device)
+        self.filters = mel_filters(self.device, n_mels)
+        # transposed, so that each block of frames is projected with one (frames, bins) matmul
+        self.projection = self.filters.T.to(dtype).contiguous()
+        self._buffers = threading.local()
+
+    def _work_buffers(self):
+        buffers = getattr(self._buffers, "stft", None)
+        if buffers is None:
+            shape = (self.block_frames, N_FFT // 2 + 1)
+            buffers = self._buffers.stft = (
+                torch.empty(self.block_frames, N_FFT, device=self.device),
+                torch.empty(shape, dtype=torch.complex64, device=self.device),
+                # |X|^2 <= sum(window)^2 = 40000 for samples in [-1, 1], within float16
+                torch.empty(shape, dtype=self.dtype, device=self.device),
+                torch.empty(
+                    self.block_frames, self.n_mels, dtype=self.dtype, device=self.device
+                ),
+            )
+        return buffers
+
+    def log_mel(self, samples: torch.Tensor) -> torch.Tensor:
+        """
+        The log-Mel frames, not yet normalized, of the STFT of `samples` without centering:
+        frame `i` is computed from `samples[i * HOP_LENGTH : i * HOP_LENGTH + N_FFT]`
+        """
+        n_frames = max(0, (len(samples) - N_FFT) // HOP_LENGTH + 1)
+        log_spec = torch.empty(self.n_mels, n_frames, device=self.device)
+        if n_frames == 0:
+            return log_spec
+
+        all_frames = samples.unfold(0, N_FFT, HOP_LENGTH)
+        frames, stft, magnitudes, mel_spec = self._work_buffers()
+        for start in range(0, n_frames, self.block_frames):
+            n = min(self.block_frames, n_frames - start)
+            torch.mul(all_frames[start : start + n], self.window, out=frames[:n])
+            torch.fft.rfft(frames[:n], out=stft[:n])
+            real, imag = torch.view_as_real(stft[:n]).unbind(-1)
+            torch.mul(real, real, out=magnitudes[:n]).addcmul_(imag, imag)
+            torch.matmul(magnitudes[:n], self.projection, out=mel_spec[:n])
+            log_spec[:, start : start + n] = mel_spec[:n].T
+
+        return log_spec.clamp_(min=1e-10).log10_()
+
+    def __call__(self, audio: torch.Tensor, padding: int = 0) -> torch.Tensor:
+        """The same as `log_mel_spectrogram(audio, padding=padding)`, for audio on this device"""
+        n_samples = len(audio) + padding
+        if n_samples <= N_FFT // 2:
+            raise ValueError(f"Cannot compute the spectrogram of {n_samples} samples")
+
+        # the audio and its padding, reflected at both ends as torch.stft(center=True) does
+        pad = N_FFT // 2
+        samples = torch.empty(n_samples + 2 * pad, device=self.device)
+        samples[pad : pad + len(audio)] = audio
+        samples[pad + len(audio) : pad + n_samples] = 0
+        samples[:pad] = samples[pad + 1 : 2 * pad + 1].flip(0)
+        samples[pad + n_samples :] = samples[n_samples - 1 : n_samples + pad - 1].flip(
+            0
+        )
+
+        # the last frame is dropped, as in the original implementation
+        n_frames = n_samples // HOP_LENGTH
+        log_spec = self.log_mel(samples[: (n_frames - 1) * HOP_LENGTH + N_FFT])
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        return log_spec.add_(4.0).div_(4.0)
+
+
+@lru_cache(maxsize=16)
+def _mel_frontend(n_mels: int, device: torch.device, dtype: torch.dtype) -> MelFrontend:
+    return MelFrontend(n_mels, device, dtype)
+
+
+def mel_frontend(
+    n_mels: int = 80,
+    device: Optional[Union[str, torch.device]] = None,
+    dtype: torch.dtype = torch.float32,
+) -> MelFrontend:
+    """The `MelFrontend` of a device, shared by every caller in the process"""
+    return _mel_frontend(n_mels, torch.device(device or "cpu"), dtype)
+
+
 def log_mel_spectrogram(
     audio: Union[str, np.ndarray, torch.Tensor],
     n_mels: int = 80,
@@ -118,8 +413,9 @@ def log_mel_spectrogram(
 
     Parameters
     ----------
-    audio: Union[str, np.ndarray, torch.Tensor], shape = (*)
-        The path to audio or either a NumPy array or Tensor containing the audio waveform in 16 kHz
+    audio: Union[str, np.ndarray, torch.Tensor], shape = (*, n_samples)
+        The path to audio or either a NumPy array or Tensor containing the audio waveform in 16 kHz;
+        leading dimensions hold separate waveforms, each normalized on its own
 
     n_mels: int
         The number of Mel-frequency filters, only 80 and 128 are supported
@@ -132,7 +428,7 @@ def log_mel_spectrogram(
 
     Returns
     -------
-    torch.Tensor, shape = (n_mels, n_frames)
+    torch.Tensor, shape = (*, n_mels, n_frames)
         A Tensor that contains the Mel spectrogram
     """
     if not torch.is_tensor(audio):
@@ -142,16 +438,177 @@ def log_mel_spectrogram(
 
     if device is not None:
         audio = audio.to(device)
-    if padding > 0:
-        audio = F.pad(audio, (0, padding))
-    window = torch.hann_window(N_FFT).to(audio.device)
-    stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=window, return_complex=True)
-    magnitudes = stft[..., :-1].abs() ** 2
-
-    filters = mel_filters(audio.device, n_mels)
-    mel_spec = filters @ magnitudes
-
-    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
-    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
-    log_spec = (log_spec + 4.0) / 4.0
-    return log_spec
+    frontend = mel_frontend(n_mels, audio.device)
+    if audio.ndim == 1:
+        return frontend(audio, padding)
+
+    mels = [
+        frontend(waveform, padding) for waveform in audio.reshape(-1, audio.shape[-1])
+    ]
+    return torch.stack(mels).reshape(*audio.shape[:-1], *mels[0].shape)
+
+
+def log_mel_spectrogram_batch(
+    audios: Sequence[Union[np.ndarray, torch.Tensor]],
+    n_mels: int = 80,
+    padding: int = 0,
+    device: Optional[Union[str, torch.device]] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute the log-Mel spectrograms of several waveforms of different lengths at once, with
+    one STFT and one Mel projection over the whole batch
+
+    Parameters
+    ----------
+    audios: Sequence[Union[np.ndarray, torch.Tensor]]
+        The audio waveforms in 16 kHz, each of shape (n_samples,)
+
+    n_mels: int
+        The number of Mel-frequency filters, only 80 and 128 are supported
+
+    padding: int
+        Number of zero samples to pad to the right of each waveform
+
+    device: Optional[Union[str, torch.device]]
+        If given, the audio tensors are moved to this device before STFT
+
+    Returns
+    -------
+    mel: torch.Tensor, shape = (len(audios), n_mels, max(n_frames))
+        The Mel spectrogram of each waveform, the same as `log_mel_spectrogram` computes for it
+        on its own, right-padded with zeros to the longest
+
+    n_frames: torch.Tensor, shape = (len(audios),)
+        The number of frames in each spectrogram
+    """
+    audios = [a if torch.is_tensor(a) else torch.from_numpy(a) for a in audios]
+    n_samples = torch.tensor([len(a) + padding for a in audios])
+    n_frames = n_samples // HOP_LENGTH
+
+    # reflect each waveform at its own ends, as torch.stft does for a single waveform, and
+    # fill the rest of the shorter rows with zeros
+    pad = N_FFT // 2
+    batch = torch.zeros(len(audios), int(n_samples.max()) + 2 * pad, device=device)
+    for i, audio in enumerate(audios):
+        audio = F.pad(audio.to(batch.device), (0, padding))
+        batch[i, : len(audio) + 2 * pad] = F.pad(audio[None], (pad, pad), "reflect")[0]
+
+    frontend = mel_frontend(n_mels, batch.device)
+    stft = torch.stft(
+        batch,
+        N_FFT,
+        HOP_LENGTH,
+        window=frontend.window,
+        center=False,
+        return_complex=True,
+    )
+    stft = stft[..., : int(n_frames.max())]
+    magnitudes = stft.real.square() + stft.imag.square()
+
+    log_spec = (frontend.filters @ magnitudes).clamp_(min=1e-10).log10_()
+
+    # frames past the end of a clip are set to the floor of the log scale, so that they do
+    # not change its maximum
+    n_frames = n_frames.to(batch.device)
+    padded = torch.arange(log_spec.shape[-1], device=batch.device) >= n_frames[:, None]
+    padded = padded[:, None, :]
+    log_spec.masked_fill_(padded, -10.0)
+    log_max = log_spec.amax(dim=(1, 2), keepdim=True)
+    log_spec = torch.maximum(log_spec, log_max - 8.0).add_(4.0).div_(4.0)
+    return log_spec.masked_fill_(padded, 0.0), n_frames
+
+
+class LogMelStream:
+    """
+    The log-Mel spectrogram of a recording, computed chunk by chunk as the audio is read.
+
+    Only the frames that have not been consumed yet are kept, so memory stays bounded however
+    long the recording is. The frames are those of `log_mel_spectrogram(audio, padding=N_SAMPLES)`,
+    including at chunk boundaries, since every STFT frame is computed from the same samples;
+    the normalization differs: `window()` scales each window by its own maximum, as for the
+    30-second clips the model was trained on, rather than by the maximum of the whole
+    recording.
+    """
+
+    def __init__(
+        self,
+        audio: Union[str, np.ndarray, torch.Tensor],
+        n_mels: int = 80,
+        device: Optional[Union[str, torch.device]] = None,
+        chunk_size: int = N_SAMPLES,
+    ):
+        if isinstance(audio, str):
+            self.chunks = stream_audio(audio, chunk_size=chunk_size)
+        else:
+            self.chunks = (
+                audio[i : i + chunk_size] for i in range(0, len(audio), chunk_size)
+            )
+        self.n_mels = n_mels
+        self.device = device
+        self.frontend = mel_frontend(n_mels, device)
+
+        self.ended = False  # whether the whole recording has been read
+        self.n_frames = 0  # frames computed so far; all of them once `ended`
+        self.n_samples = 0  # samples read so far
+        self.offset = 0  # index of the first frame still kept
+        self.log_spec = torch.empty(n_mels, 0, device=device)
+        self.samples = torch.empty(
+            0, device=device
+        )  # STFT input from the next frame on
+        self.padded = False  # whether `samples` starts with the reflection of the audio
+
+    def read(self, end: int) -> int:
+        """Compute frames until there are `end` of them or the recording ends; returns `n_frames`"""
+        while self.n_frames < end and not self.ended:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.ended = True
+                # the last frames overlap the silence that transcribe() pads the audio with
+                chunk = torch.zeros(N_FFT, device=self.device)
+            else:
+                if not torch.is_tensor(chunk):
+                    chunk = torch.from_numpy(chunk)
+                chunk = chunk.to(self.device)
+                self.n_samples += len(chunk)
+
+            self.samples = torch.cat([self.samples, chunk])
+            if not self.padded:
+                if len(self.samples) <= N_FFT // 2 and not self.ended:
+                    continue  # the reflection below needs more samples
+                # reflect the start of the padded audio around its first sample, as torch.stft
+                head = F.pad(self.samples[1 : N_FFT // 2 + 1], (0, N_FFT // 2))
+                self.samples = torch.cat([head[: N_FFT // 2].flip(0), self.samples])
+                self.padded = True
+            self._compute_frames()
+
+        return self.n_frames
+
+    def _compute_frames(self):
+        n_frames = (len(self.samples) - N_FFT) // HOP_LENGTH + 1
+        if self.ended:
+            n_frames = min(n_frames, self.n_samples // HOP_LENGTH - self.n_frames)
+        if n_frames <= 0:
+            return
+
+        samples = self.samples[: (n_frames - 1) * HOP_LENGTH + N_FFT]
+        log_spec = self.frontend.log_mel(samples)
+
+        self.log_spec = torch.cat([self.log_spec, log_spec], dim=1)
+        self.samples = self.samples[n_frames * HOP_LENGTH :]
+        self.n_frames += n_frames
+
+    def window(self, start: int, size: int) -> torch.Tensor:
+        """
+        The normalized frames `start` to `start + size`, which must have been read.
+        Frames before `start` are released, so windows must be requested in order.
+        """
+        if start < self.offset:
+            raise ValueError(f"Frame {start} was already released")
+        self.log_spec = self.log_spec[:, start - self.offset :]
+        self.offset = start
+
+        log_spec = self.log_spec[:, :size]
+        if size == 0:
+            return log_spec
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        return (log_spec + 4.0) / 4.0
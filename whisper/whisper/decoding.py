@@ -86,7 +86,8 @@ class DecodingOptions:
     language: Optional[str] = None
 
     # sampling-related options
-    temperature: float = 0.0
+    # several temperatures decode a single audio once per temperature, in one batch
+    temperature: Union[float, Tuple[float, ...]] = 0.0
     sample_len: Optional[int] = None  # maximum number of tokens to sample
     best_of: Optional[int] = None  # number of independent sample trajectories, if t > 0
     beam_size: Optional[int] = None  # number of beams in beam search, if t == 0
@@ -112,6 +113,7 @@ class DecodingOptions:
 
     # implementation details
     fp16: bool = True  # use fp16 for most of the calculation
+    static_kv_cache: bool = False  # preallocate the decoder's key/value cache
 
 
 @dataclass(frozen=True)
@@ -142,10 +144,19 @@ class Inference:
 
 
 class PyTorchInference(Inference):
-    def __init__(self, model: "Whisper", initial_token_length: int):
+    def __init__(
+        self,
+        model: "Whisper",
+        initial_token_length: int,
+        static_length: Optional[int] = None,
+        cross_attention_cache: Optional[dict] = None,
+    ):
         self.model: "Whisper" = model
         self.initial_token_length = initial_token_length
+        self.static_length = static_length
+        self.cross_attention_cache = cross_attention_cache
         self.kv_cache = {}
+        self.kv_scratch = None
         self.hooks = []
 
         key_modules = [block.attn.key for block in self.model.decoder.blocks]
@@ -154,7 +165,9 @@ class PyTorchInference(Inference):
 
     def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
         if not self.kv_cache:
-            self.kv_cache, self.hooks = self.model.install_kv_cache_hooks()
+            self.kv_cache, self.hooks = self.model.install_kv_cache_hooks(
+                self.cross_attention_cache, static_length=self.static_length
+            )
 
         if tokens.shape[-1] > self.initial_token_length:
             # only need to use the last token except in the first forward pass
@@ -167,13 +180,30 @@ class PyTorchInference(Inference):
             hook.remove()
 
         self.kv_cache = {}
+        self.kv_scratch = None
         self.hooks = []
 
     def rearrange_kv_cache(self, source_indices):
-        if source_indices != list(range(len(source_indices))):
+        source_indices = torch.as_tensor(source_indices)
+        identity = torch.arange(len(source_indices), device=source_indices.device)
+        if not torch.equal(source_indices, identity):
             for module in self.kv_modules:
                 # update the key/value cache to contain the selected sequences
-                self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
+                cached = self.kv_cache[module]
+                if self.static_length is None:
+                    self.kv_cache[module] = cached[source_indices].detach()
+                else:
+                    self._rearrange_static(cached, source_indices)
+
+    def _rearrange_static(self, cached: Tensor, source_indices: Tensor) -> None:
+        # the cache is a view into a preallocated buffer; gather the selected rows into a
+        # scratch buffer of the same size and copy them back, so nothing is allocated per step
+        n_batch, n_ctx, n_state = cached.shape
+        if self.kv_scratch is None:
+            self.kv_scratch = cached.new_empty(n_batch * self.static_length * n_state)
+        scratch = self.kv_scratch[: cached.numel()].view(n_batch, n_ctx, n_state)
+        torch.index_select(cached, 0, source_indices.to(cached.device), out=scratch)
+        cached.copy_(scratch)
 
 
 class SequenceRanker:
@@ -270,14 +300,20 @@ class TokenDecoder:
 
 
 class GreedyDecoder(TokenDecoder):
-    def __init__(self, temperature: float, eot: int):
-        self.temperature = temperature
+    def __init__(self, temperature: Union[float, Tensor], eot: int):
+        self.temperature = temperature  # a float, or one temperature per row
         self.eot = eot
 
     def update(
         self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
     ) -> Tuple[Tensor, bool]:
-        if self.temperature == 0:
+        if isinstance(self.temperature, Tensor):
+            temperature = self.temperature.to(logits.device)
+            greedy = temperature == 0
+            scaled = logits / temperature.masked_fill(greedy, 1.0)[:, None]
+            next_tokens = Categorical(logits=scaled).sample()
+            next_tokens = torch.where(greedy, logits.argmax(dim=-1), next_tokens)
+        elif self.temperature == 0:
             next_tokens = logits.argmax(dim=-1)
         else:
             next_tokens = Categorical(logits=logits / self.temperature).sample()
@@ -312,6 +348,7 @@ class BeamSearchDecoder(TokenDecoder):
         self.patience = patience or 1.0
         self.max_candidates: int = round(beam_size * self.patience)
         self.finished_sequences = None
+        self.finished_count = None
 
         assert (
             self.max_candidates > 0
@@ -319,6 +356,7 @@ class BeamSearchDecoder(TokenDecoder):
 
     def reset(self):
         self.finished_sequences = None
+        self.finished_count = None
 
     def update(
         self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
@@ -327,60 +365,77 @@ class BeamSearchDecoder(TokenDecoder):
             raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
 
         n_audio = tokens.shape[0] // self.beam_size
+        n_candidates = self.beam_size + 1
         if self.finished_sequences is None:  # for the first update
-            self.finished_sequences = [{} for _ in range(n_audio)]
+            self.finished_sequences = [[] for _ in range(n_audio)]
+            self.finished_count = torch.zeros(
+                n_audio, dtype=torch.long, device=tokens.device
+            )
 
+        # STEP 1: calculate the cumulative log probabilities for possible candidates
         logprobs = F.log_softmax(logits.float(), dim=-1)
-        next_tokens, source_indices, finished_sequences = [], [], []
-        for i in range(n_audio):
-            scores, sources, finished = {}, {}, {}
-
-            # STEP 1: calculate the cumulative log probabilities for possible candidates
-            for j in range(self.beam_size):
-                idx = i * self.beam_size + j
-                prefix = tokens[idx].tolist()
-                for logprob, token in zip(*logprobs[idx].topk(self.beam_size + 1)):
-                    new_logprob = (sum_logprobs[idx] + logprob).item()
-                    sequence = tuple(prefix + [token.item()])
-                    scores[sequence] = new_logprob
-                    sources[sequence] = idx
-
-            # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
-            saved = 0
-            for sequence in sorted(scores, key=scores.get, reverse=True):
-                if sequence[-1] == self.eot:
-                    finished[sequence] = scores[sequence]
-                else:
-                    sum_logprobs[len(next_tokens)] = scores[sequence]
-                    next_tokens.append(sequence)
-                    source_indices.append(sources[sequence])
-
-                    saved += 1
-                    if saved == self.beam_size:
-                        break
-
-            finished_sequences.append(finished)
-
-        tokens = torch.tensor(next_tokens, device=tokens.device)
+        top_logprobs, top_tokens = logprobs.topk(n_candidates)
+        scores = (sum_logprobs[:, None] + top_logprobs).view(n_audio, -1)
+        top_tokens = top_tokens.view(n_audio, -1)
+
+        # beams with the same prefix as an earlier beam of the same audio (all of them, at
+        # the first step) propose the same candidates; only the first copy is considered
+        beams = tokens.view(n_audio, self.beam_size, -1)
+        same_prefix = (beams[:, :, None] == beams[:, None]).all(dim=-1)
+        duplicate = same_prefix.tril(diagonal=-1).any(dim=-1)
+        duplicate = duplicate.repeat_interleave(n_candidates, dim=-1)
+
+        # STEP 2: rank the candidates and keep the top beam_size sequences for each audio;
+        # the sort is stable so that ties keep the order of beams and of topk within a beam
+        order = scores.argsort(dim=-1, descending=True, stable=True)
+        order = order.gather(
+            -1, duplicate.gather(-1, order).int().argsort(dim=-1, stable=True)
+        )
+        scores = scores.gather(-1, order)
+        candidates = top_tokens.gather(-1, order)
+        first_beam = torch.arange(n_audio, device=tokens.device) * self.beam_size
+        sources = order // n_candidates + first_beam[:, None]
+
+        # the top beam_size non-EOT candidates continue; the EOT candidates ranked above
+        # the last of them are finished
+        is_eot = candidates == self.eot
+        n_continuing = (~is_eot).cumsum(dim=-1)
+        continuing = ~is_eot & (n_continuing <= self.beam_size)
+        finished = is_eot & (n_continuing < self.beam_size)
+
+        selected = continuing.int().argsort(dim=-1, descending=True, stable=True)
+        selected = selected[:, : self.beam_size]
+        source_indices = sources.gather(-1, selected).flatten()
+        sum_logprobs.copy_(scores.gather(-1, selected).flatten())
+
+        self._add_finished(tokens, sources, scores, finished)
+
+        next_tokens = candidates.gather(-1, selected).flatten()
+        tokens = torch.cat([tokens[source_indices], next_tokens[:, None]], dim=-1)
         self.inference.rearrange_kv_cache(source_indices)
 
-        # add newly finished sequences to self.finished_sequences
-        assert len(self.finished_sequences) == len(finished_sequences)
-        for previously_finished, newly_finished in zip(
-            self.finished_sequences, finished_sequences
-        ):
-            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
-                if len(previously_finished) >= self.max_candidates:
-                    break  # the candidate list is full
-                previously_finished[seq] = newly_finished[seq]
-
         # mark as completed if all audio has enough number of samples
-        completed = all(
-            len(sequences) >= self.max_candidates
-            for sequences in self.finished_sequences
-        )
+        completed = bool((self.finished_count >= self.max_candidates).all())
         return tokens, completed
 
+    def _add_finished(
+        self, tokens: Tensor, sources: Tensor, scores: Tensor, finished: Tensor
+    ):
+        """Add newly finished sequences, best first, until each audio has max_candidates"""
+        rank = finished.cumsum(dim=-1)
+        finished &= self.finished_count[:, None] + rank <= self.max_candidates
+        self.finished_count += finished.sum(dim=-1)
+
+        audio_indices = finished.nonzero()[:, 0].tolist()
+        if not audio_indices:
+            return
+
+        sequences = F.pad(tokens[sources[finished]], (0, 1), value=self.eot)
+        for i, sequence, logprob in zip(
+            audio_indices, sequences, scores[finished].tolist()
+        ):
+            self.finished_sequences[i].append((sequence, logprob))
+
     def finalize(self, preceding_tokens: Tensor, sum_logprobs: Tensor):
         # collect all finished sequences, including patience, and add unfinished ones if not enough
         sum_logprobs = sum_logprobs.cpu()
@@ -389,17 +444,18 @@ class BeamSearchDecoder(TokenDecoder):
                 len(sequences) < self.beam_size
             ):  # when not enough sequences are finished
                 for j in list(np.argsort(sum_logprobs[i]))[::-1]:
-                    sequence = preceding_tokens[i, j].tolist() + [self.eot]
-                    sequences[tuple(sequence)] = sum_logprobs[i][j].item()
+                    sequence = F.pad(preceding_tokens[i, j], (0, 1), value=self.eot)
+                    sequences.append((sequence, sum_logprobs[i][j].item()))
                     if len(sequences) >= self.beam_size:
                         break
 
         tokens: List[List[Tensor]] = [
-            [torch.tensor(seq) for seq in sequences.keys()]
+            [sequence for sequence, _ in sequences]
             for sequences in self.finished_sequences
         ]
         sum_logprobs: List[List[float]] = [
-            list(sequences.values()) for sequences in self.finished_sequences
+            [logprob for _, logprob in sequences]
+            for sequences in self.finished_sequences
         ]
         return tokens, sum_logprobs
 
@@ -454,34 +510,38 @@ class ApplyTimestampRules(LogitFilter):
         if self.tokenizer.no_timestamps is not None:
             logits[:, self.tokenizer.no_timestamps] = -np.inf
 
-        # timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
-        for k in range(tokens.shape[0]):
-            sampled_tokens = tokens[k, self.sample_begin :]
-            seq = [t for t in sampled_tokens.tolist()]
-            last_was_timestamp = (
-                len(seq) >= 1 and seq[-1] >= self.tokenizer.timestamp_begin
-            )
-            penultimate_was_timestamp = (
-                len(seq) < 2 or seq[-2] >= self.tokenizer.timestamp_begin
-            )
-
-            if last_was_timestamp:
-                if penultimate_was_timestamp:  # has to be non-timestamp
-                    logits[k, self.tokenizer.timestamp_begin :] = -np.inf
-                else:  # cannot be normal text tokens
-                    logits[k, : self.tokenizer.eot] = -np.inf
-
-            timestamps = sampled_tokens[
-                sampled_tokens.ge(self.tokenizer.timestamp_begin)
-            ]
-            if timestamps.numel() > 0:
-                # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
-                # also force each segment to have a nonzero length, to prevent infinite looping
-                if last_was_timestamp and not penultimate_was_timestamp:
-                    timestamp_last = timestamps[-1]
-                else:
-                    timestamp_last = timestamps[-1] + 1
-                logits[k, self.tokenizer.timestamp_begin : timestamp_last] = -np.inf
+        timestamp_begin = self.tokenizer.timestamp_begin
+        sampled_tokens = tokens[:, self.sample_begin :]
+        n_sampled = sampled_tokens.shape[1]
+
+        if n_sampled > 0:
+            is_timestamp = sampled_tokens.ge(timestamp_begin)
+
+            # timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
+            last_was_timestamp = is_timestamp[:, -1]
+            if n_sampled >= 2:
+                penultimate_was_timestamp = is_timestamp[:, -2]
+            else:
+                penultimate_was_timestamp = torch.ones_like(last_was_timestamp)
+            after_pair = last_was_timestamp & penultimate_was_timestamp
+            after_single = last_was_timestamp & ~penultimate_was_timestamp
+
+            # after a single timestamp, cannot be normal text tokens
+            logits[after_single.nonzero().squeeze(1), : self.tokenizer.eot] = -np.inf
+
+            # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
+            # also force each segment to have a nonzero length, to prevent infinite looping
+            positions = torch.arange(n_sampled, device=tokens.device)
+            last_index = torch.where(is_timestamp, positions, -1).amax(dim=-1)
+            timestamp_last = sampled_tokens.gather(1, last_index.clamp(min=0)[:, None])
+            timestamp_last = timestamp_last + (~after_single)[:, None] - timestamp_begin
+            timestamp_last = timestamp_last.masked_fill(last_index.lt(0)[:, None], 0)
+
+            # after a pair of timestamps, has to be non-timestamp
+            timestamp_logits = logits[:, timestamp_begin:]
+            offsets = torch.arange(timestamp_logits.shape[-1], device=logits.device)
+            mask = offsets.lt(timestamp_last) | after_pair[:, None]
+            timestamp_logits.masked_fill_(mask, -np.inf)
 
         if tokens.shape[1] == self.sample_begin:
             # suppress generating non-timestamp tokens at the beginning
@@ -496,13 +556,10 @@ class ApplyTimestampRules(LogitFilter):
 
         # if sum of probability over timestamps is above any other token, sample timestamp
         logprobs = F.log_softmax(logits.float(), dim=-1)
-        for k in range(tokens.shape[0]):
-            timestamp_logprob = logprobs[k, self.tokenizer.timestamp_begin :].logsumexp(
-                dim=-1
-            )
-            max_text_token_logprob = logprobs[k, : self.tokenizer.timestamp_begin].max()
-            if timestamp_logprob > max_text_token_logprob:
-                logits[k, : self.tokenizer.timestamp_begin] = -np.inf
+        timestamp_logprob = logprobs[:, timestamp_begin:].logsumexp(dim=-1)
+        max_text_token_logprob = logprobs[:, :timestamp_begin].amax(dim=-1)
+        sample_timestamp = timestamp_logprob > max_text_token_logprob
+        logits[sample_timestamp.nonzero().squeeze(1), :timestamp_begin] = -np.inf
 
 
 class DecodingTask:
@@ -525,6 +582,9 @@ class DecodingTask:
         self.options: DecodingOptions = self._verify_options(options)
 
         self.n_group: int = options.beam_size or options.best_of or 1
+        self.temperatures: Optional[List[float]] = None
+        if isinstance(options.temperature, (list, tuple)):
+            self.temperatures = list(options.temperature)
         self.n_ctx: int = model.dims.n_text_ctx
         self.sample_len: int = options.sample_len or model.dims.n_text_ctx // 2
 
@@ -537,7 +597,12 @@ class DecodingTask:
         self.sot_index: int = self.initial_tokens.index(tokenizer.sot)
 
         # inference: implements the forward pass through the decoder, including kv caching
-        self.inference = PyTorchInference(model, len(self.initial_tokens))
+        static_length = None
+        if options.static_kv_cache:
+            static_length = min(self.n_ctx, self.sample_begin + self.sample_len)
+        self.inference = PyTorchInference(
+            model, len(self.initial_tokens), static_length
+        )
 
         # sequence ranker: implements how to rank a group of sampled sequences
         self.sequence_ranker = MaximumLikelihoodRanker(options.length_penalty)
@@ -547,6 +612,11 @@ class DecodingTask:
             self.decoder = BeamSearchDecoder(
                 options.beam_size, tokenizer.eot, self.inference, options.patience
             )
+        elif self.temperatures is not None:
+            temperatures = torch.tensor(self.temperatures, dtype=torch.float32)
+            self.decoder = GreedyDecoder(
+                temperatures.repeat_interleave(self.n_group), tokenizer.eot
+            )
         else:
             self.decoder = GreedyDecoder(options.temperature, tokenizer.eot)
 
@@ -572,7 +642,14 @@ class DecodingTask:
     def _verify_options(self, options: DecodingOptions) -> DecodingOptions:
         if options.beam_size is not None and options.best_of is not None:
             raise ValueError("beam_size and best_of can't be given together")
-        if options.temperature == 0:
+        if isinstance(options.temperature, (list, tuple)):
+            if len(options.temperature) == 0:
+                raise ValueError("at least one temperature should be given")
+            if options.beam_size is not None:
+                raise ValueError("beam_size with several temperatures is not supported")
+            if options.best_of is not None and max(options.temperature) == 0:
+                raise ValueError("best_of with greedy sampling (T=0) is not compatible")
+        elif options.temperature == 0:
             if options.best_of is not None:
                 raise ValueError("best_of with greedy sampling (T=0) is not compatible")
         if options.patience is not None and options.beam_size is None:
@@ -710,10 +787,14 @@ class DecodingTask:
         return tokens, sum_logprobs, no_speech_probs
 
     @torch.no_grad()
-    def run(self, mel: Tensor) -> List[DecodingResult]:
+    def run(
+        self, mel: Tensor, cross_attention_cache: Optional[dict] = None
+    ) -> List[DecodingResult]:
         self.decoder.reset()
         tokenizer: Tokenizer = self.tokenizer
         n_audio: int = mel.shape[0]
+        if self.temperatures is not None and n_audio != 1:
+            raise ValueError("several temperatures require a single audio to decode")
 
         audio_features: Tensor = self._get_audio_features(mel)  # encoder forward pass
         tokens: Tensor = torch.tensor([self.initial_tokens]).repeat(n_audio, 1)
@@ -730,14 +811,31 @@ class DecodingTask:
                 )
             ]
 
+        if self.temperatures is not None:
+            # the audio is decoded once per temperature; its features broadcast to all rows
+            n_audio = len(self.temperatures)
+            tokens = tokens.repeat(n_audio, 1)
+            languages = languages * n_audio
+
         # repeat text tensors by the group size, for beam search or best-of-n sampling
         tokens = tokens.repeat_interleave(self.n_group, dim=0).to(audio_features.device)
+        if audio_features.shape[0] > 1:
+            # a single audio broadcasts against its group; a batch has to be expanded
+            audio_features = audio_features.repeat_interleave(self.n_group, dim=0)
+        if cross_attention_cache is not None:
+            # cross-attention keys/values computed once for these audio features
+            self.inference.cross_attention_cache = {
+                module: (
+                    kv.repeat_interleave(self.n_group, dim=0) if kv.shape[0] > 1 else kv
+                )
+                for module, kv in cross_attention_cache.items()
+            }
 
         # call the main sampling loop
         tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens)
 
         # reshape the tensors to have (n_audio, n_group) as the first two dimensions
-        audio_features = audio_features[:: self.n_group]
+        audio_features = audio_features[:: self.n_group].expand(n_audio, -1, -1)
         no_speech_probs = no_speech_probs[:: self.n_group]
         assert audio_features.shape[0] == len(no_speech_probs) == n_audio
 
@@ -761,6 +859,8 @@ class DecodingTask:
             lp / (len(t) + 1) for t, lp in zip(tokens, sum_logprobs)
         ]
 
+        temperatures = self.temperatures or [self.options.temperature] * n_audio
+
         fields = (
             texts,
             languages,
@@ -768,6 +868,7 @@ class DecodingTask:
             audio_features,
             avg_logprobs,
             no_speech_probs,
+            temperatures,
         )
         if len(set(map(len, fields))) != 1:
             raise RuntimeError(f"inconsistent result lengths: {list(map(len, fields))}")
@@ -780,12 +881,18 @@ class DecodingTask:
                 text=text,
                 avg_logprob=avg_logprob,
                 no_speech_prob=no_speech_prob,
-                temperature=self.options.temperature,
+                temperature=temperature,
                 compression_ratio=compression_ratio(text),
             )
-            for text, language, tokens, features, avg_logprob, no_speech_prob in zip(
-                *fields
-            )
+            for (
+                text,
+                language,
+                tokens,
+                features,
+                avg_logprob,
+                no_speech_prob,
+                temperature,
+            ) in zip(*fields)
         ]
 
 
@@ -794,6 +901,7 @@ def decode(
     model: "Whisper",
     mel: Tensor,
     options: DecodingOptions = DecodingOptions(),
+    cross_attention_cache: Optional[dict] = None,
     **kwargs,
 ) -> Union[DecodingResult, List[DecodingResult]]:
     """
@@ -805,22 +913,29 @@ def decode(
         the Whisper model instance
 
     mel: torch.Tensor, shape = (80, 3000) or (*, 80, 3000)
-        A tensor containing the Mel spectrogram(s)
+        A tensor containing the Mel spectrogram(s), or the audio features encoded from them
 
     options: DecodingOptions
         A dataclass that contains all necessary options for decoding 30-second segments
 
+    cross_attention_cache: dict
+        Optional cross-attention keys and values of the encoded audio features, as returned by
+        `Whisper.cross_attention_cache`, to reuse instead of recomputing them
+
     Returns
     -------
     result: Union[DecodingResult, List[DecodingResult]]
-        The result(s) of decoding contained in `DecodingResult` dataclass instance(s)
+        The result(s) of decoding contained in `DecodingResult` dataclass instance(s); one per
+        temperature when several temperatures are given
     """
-    if single := mel.ndim == 2:
-        mel = mel.unsqueeze(0)
-
     if kwargs:
         options = replace(options, **kwargs)
 
-    result = DecodingTask(model, options).run(mel)
+    several_temperatures = isinstance(options.temperature, (list, tuple))
+    if single := mel.ndim == 2:
+        mel = mel.unsqueeze(0)
+    single = single and not several_temperatures
+
+    result = DecodingTask(model, options).run(mel, cross_attention_cache)
 
     return result[0] if single else result
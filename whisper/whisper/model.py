@@ -221,7 +221,9 @@ class TextDecoder(nn.Module):
         )
         self.ln = LayerNorm(n_state)
 
-        mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
+        # not in checkpoints, so it is built on the CPU even when the model is built on the
+        # meta device to be filled from one
+        mask = torch.empty(n_ctx, n_ctx, device="cpu").fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
     def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None):
@@ -231,7 +233,12 @@ class TextDecoder(nn.Module):
         xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
         """
-        offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
+        # the number of positions already in the self-attention cache; the cache may also hold
+        # precomputed cross-attention keys/values
+        self_attn_key = self.blocks[0].attn.key
+        offset = (
+            kv_cache[self_attn_key].shape[1] if self_attn_key in (kv_cache or {}) else 0
+        )
         x = (
             self.token_embedding(x)
             + self.positional_embedding[offset : offset + x.shape[-1]]
@@ -267,10 +274,14 @@ class Whisper(nn.Module):
             self.dims.n_text_head,
             self.dims.n_text_layer,
         )
-        # use the last half among the decoder layers for time alignment by default;
+        # use the last half among the decoder layers for time alignment by default (built
+        # on the CPU like the decoder's mask, as checkpoints don't hold it);
         # to use a specific set of heads, see `set_alignment_heads()` below.
         all_heads = torch.zeros(
-            self.dims.n_text_layer, self.dims.n_text_head, dtype=torch.bool
+            self.dims.n_text_layer,
+            self.dims.n_text_head,
+            dtype=torch.bool,
+            device="cpu",
         )
         all_heads[self.dims.n_text_layer // 2 :] = True
         self.register_buffer("alignment_heads", all_heads.to_sparse(), persistent=False)
@@ -290,11 +301,46 @@ class Whisper(nn.Module):
     def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor):
         return self.decoder(tokens, audio_features)
 
+    def cross_attention_cache(self, audio_features: torch.Tensor) -> dict:
+        """
+        Computes the cross-attention keys and values of every decoder layer for the encoded
+        audio, in the form `install_kv_cache_hooks` accepts as a precomputed cache. Decoding the
+        same audio features several times can then skip these projections.
+        """
+        cache = {}
+        for block in self.decoder.blocks:
+            cache[block.cross_attn.key] = block.cross_attn.key(audio_features)
+            cache[block.cross_attn.value] = block.cross_attn.value(audio_features)
+        return cache
+
     def forward(
         self, mel: torch.Tensor, tokens: torch.Tensor
     ) -> Dict[str, torch.Tensor]:
         return self.decoder(tokens, self.encoder(mel))
 
+    def quantize_int8(self) -> "Whisper":
+        """
+        Replaces the `Linear` layers of the encoder and decoder in place with dynamically quantized
+        ones, which store int8 weights and quantize their inputs on the fly. Quantized layers run
+        on CPU only, and take float32 inputs.
+        """
+        for module in list(self.modules()):
+            for name, child in module.named_children():
+                if type(child) is Linear:
+                    # dynamic quantization only converts plain `nn.Linear` layers
+                    linear = nn.Linear(
+                        child.in_features,
+                        child.out_features,
+                        bias=child.bias is not None,
+                        device="meta",
+                    )
+                    linear.weight, linear.bias = child.weight, child.bias
+                    setattr(module, name, linear)
+
+        return torch.ao.quantization.quantize_dynamic(
+            self, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
     @property
     def device(self):
         return next(self.parameters()).device
@@ -307,13 +353,28 @@ class Whisper(nn.Module):
     def num_languages(self):
         return self.dims.n_vocab - 51765 - int(self.is_multilingual)
 
-    def install_kv_cache_hooks(self, cache: Optional[dict] = None):
+    def install_kv_cache_hooks(
+        self, cache: Optional[dict] = None, static_length: Optional[int] = None
+    ):
         """
         The `MultiHeadAttention` module optionally accepts `kv_cache` which stores the key and value
         tensors calculated for the previous positions. This method returns a dictionary that stores
         all caches, and the necessary hooks for the key and value projection modules that save the
         intermediate tensors to be reused during later calculations.
 
+        By default the self-attention caches grow by concatenation, one copy of the whole cache
+        per generated token. With `static_length`, each one is instead written in place into a
+        buffer of shape (batch_size, static_length, n_text_state) that is allocated on the first
+        forward pass, and the dictionary holds views of the filled positions of these buffers.
+
+        Parameters
+        ----------
+        cache : dict
+            An optional dictionary of already computed key/value tensors to start from
+        static_length : int
+            The number of text positions to preallocate, at most `n_text_ctx`; None to grow the
+            caches by concatenation
+
         Returns
         -------
         cache : Dict[nn.Module, torch.Tensor]
@@ -322,11 +383,25 @@ class Whisper(nn.Module):
             List of PyTorch RemovableHandle objects to stop the hooks to be called
         """
         cache = {**cache} if cache is not None else {}
+        buffers = {}
         hooks = []
 
         def save_to_cache(module, _, output):
-            if module not in cache or output.shape[1] > self.dims.n_text_ctx:
-                # save as-is, for the first token or cross attention
+            if output.shape[1] > self.dims.n_text_ctx:
+                # save as-is for cross attention
+                cache[module] = output
+            elif static_length is not None:
+                offset = cache[module].shape[1] if module in cache else 0
+                if module not in buffers:
+                    n_batch, _, n_state = output.shape
+                    buffers[module] = output.new_empty(n_batch, static_length, n_state)
+                    if offset > 0:
+                        buffers[module][:, :offset] = cache[module]
+                end = offset + output.shape[1]
+                buffers[module][:, offset:end] = output.detach()
+                cache[module] = buffers[module][:, :end]
+            elif module not in cache:
+                # save as-is for the first token
                 cache[module] = output
             else:
                 cache[module] = torch.cat([cache[module], output], dim=1).detach()
@@ -194,7 +194,11 @@ def find_alignment(
     from .model import disable_sdpa
 
     with torch.no_grad(), disable_sdpa():
-        logits = model(mel.unsqueeze(0), tokens.unsqueeze(0))[0]
+        if mel.shape[-2:] == (model.dims.n_audio_ctx, model.dims.n_audio_state):
+            # encoded audio features are given; skip audio encoding
+            logits = model.decoder(tokens.unsqueeze(0), mel.unsqueeze(0))[0]
+        else:
+            logits = model(mel.unsqueeze(0), tokens.unsqueeze(0))[0]
         sampled_logits = logits[len(tokenizer.sot_sequence) :, : tokenizer.eot]
         token_probs = sampled_logits.softmax(dim=-1)
         text_token_probs = token_probs[np.arange(len(text_tokens)), text_tokens]
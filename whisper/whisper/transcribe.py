@@ -1,7 +1,9 @@
 import argparse
 import os
+import sys
 import traceback
 import warnings
+from collections import deque
 from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
 import numpy as np
@@ -14,6 +16,8 @@ from .audio import (
     N_FRAMES,
     N_SAMPLES,
     SAMPLE_RATE,
+    AudioDecoder,
+    LogMelStream,
     log_mel_spectrogram,
     pad_or_trim,
 )
@@ -52,6 +56,9 @@ def transcribe(
     append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
     clip_timestamps: Union[str, List[float]] = "0",
     hallucination_silence_threshold: Optional[float] = None,
+    batch_size: int = 1,
+    batched_fallback: bool = False,
+    streaming_mel: bool = False,
     **decode_options,
 ):
     """
@@ -119,6 +126,26 @@ def transcribe(
         When word_timestamps is True, skip silent periods longer than this threshold (in seconds)
         when a possible hallucination is detected
 
+    batch_size: int
+        Number of 30-second windows to encode and decode together. Values above 1 require
+        `condition_on_previous_text=False`: the audio is then cut into fixed 30-second windows
+        instead of seeking to the last timestamp of each window, and only the windows that
+        fail the thresholds above are re-decoded one at a time at higher temperatures.
+
+    batched_fallback: bool
+        Decode a window at all its sampling temperatures at once, in one batch, and keep the
+        result of the lowest temperature that passes the thresholds above, instead of trying
+        the temperatures one after another. With `beam_size`, the beam search at temperature 0
+        is still tried first on its own. This costs more compute on windows that would have
+        passed early, for a much lower worst case on the windows that fail.
+
+    streaming_mel: bool
+        Read the audio and compute its log-Mel spectrogram window by window as transcription
+        progresses, so that memory stays bounded however long the recording is, instead of
+        computing the spectrogram of the whole recording up front. Each 30-second window is
+        then normalized by its own loudest frame rather than by the recording's. Requires
+        `batch_size=1`.
+
     Returns
     -------
     A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
@@ -135,9 +162,24 @@ def transcribe(
     if dtype == torch.float32:
         decode_options["fp16"] = False
 
-    # Pad 30-seconds of silence to the input audio, for slicing
-    mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
-    content_frames = mel.shape[-1] - N_FRAMES
+    if batch_size > 1 and condition_on_previous_text:
+        raise ValueError("batch_size > 1 requires condition_on_previous_text=False")
+    if batch_size > 1 and hallucination_silence_threshold is not None:
+        raise ValueError(
+            "hallucination_silence_threshold is not supported with batch_size > 1"
+        )
+    if batch_size > 1 and streaming_mel:
+        raise ValueError("streaming_mel is not supported with batch_size > 1")
+
+    if streaming_mel:
+        # frames are computed as the loop below reaches them; until the end of the audio has
+        # been read, content_frames only counts the frames computed so far
+        mel = LogMelStream(audio, model.dims.n_mels)
+        content_frames = mel.read(2 * N_FRAMES)
+    else:
+        # Pad 30-seconds of silence to the input audio, for slicing
+        mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
+        content_frames = mel.shape[-1] - N_FRAMES
     content_duration = float(content_frames * HOP_LENGTH / SAMPLE_RATE)
 
     if decode_options.get("language", None) is None:
@@ -148,7 +190,11 @@ def transcribe(
                 print(
                     "Detecting language using up to the first 30 seconds. Use `--language` to specify the language"
                 )
-            mel_segment = pad_or_trim(mel, N_FRAMES).to(model.device).to(dtype)
+            if streaming_mel:
+                mel_segment = mel.window(0, min(N_FRAMES, content_frames))
+            else:
+                mel_segment = mel
+            mel_segment = pad_or_trim(mel_segment, N_FRAMES).to(model.device).to(dtype)
             _, probs = model.detect_language(mel_segment)
             decode_options["language"] = max(probs, key=probs.get)
             if verbose is not None:
@@ -173,7 +219,9 @@ def transcribe(
     if len(seek_points) == 0:
         seek_points.append(0)
     if len(seek_points) % 2 == 1:
-        seek_points.append(content_frames)
+        # a stream's length is only known once it has been read to the end
+        unknown = streaming_mel and not mel.ended
+        seek_points.append(sys.maxsize if unknown else content_frames)
     seek_clips: List[Tuple[int, int]] = list(zip(seek_points[::2], seek_points[1::2]))
 
     punctuation = "\"'“¿([{-\"'.。,，!！?？:：”)]}、"
@@ -181,48 +229,125 @@ def transcribe(
     if word_timestamps and task == "translate":
         warnings.warn("Word-level timestamps on translations may not be reliable.")
 
-    def decode_with_fallback(segment: torch.Tensor) -> DecodingResult:
-        temperatures = (
-            [temperature] if isinstance(temperature, (int, float)) else temperature
-        )
+    temperatures = (
+        [temperature] if isinstance(temperature, (int, float)) else temperature
+    )
+
+    def decoding_options(t: Union[float, Tuple[float, ...]]) -> DecodingOptions:
+        kwargs = {**decode_options}
+        if np.max(t) > 0:
+            # disable beam_size and patience when t > 0
+            kwargs.pop("beam_size", None)
+            kwargs.pop("patience", None)
+        else:
+            # disable best_of when t == 0
+            kwargs.pop("best_of", None)
+
+        return DecodingOptions(**kwargs, temperature=t)
+
+    def needs_fallback(decode_result: DecodingResult) -> bool:
+        needs_fallback = False
+        if (
+            compression_ratio_threshold is not None
+            and decode_result.compression_ratio > compression_ratio_threshold
+        ):
+            needs_fallback = True  # too repetitive
+        if (
+            logprob_threshold is not None
+            and decode_result.avg_logprob < logprob_threshold
+        ):
+            needs_fallback = True  # average log probability is too low
+        if (
+            no_speech_threshold is not None
+            and decode_result.no_speech_prob > no_speech_threshold
+            and logprob_threshold is not None
+            and decode_result.avg_logprob < logprob_threshold
+        ):
+            needs_fallback = False  # silence
+        return needs_fallback
+
+    def decode_with_fallback(
+        segment: torch.Tensor,
+        temperatures: List[float] = temperatures,
+        audio_features: Optional[torch.Tensor] = None,
+        cross_attention_cache: Optional[dict] = None,
+    ) -> DecodingResult:
         decode_result = None
 
-        for t in temperatures:
-            kwargs = {**decode_options}
-            if t > 0:
-                # disable beam_size and patience when t > 0
-                kwargs.pop("beam_size", None)
-                kwargs.pop("patience", None)
+        # encode the window and project its cross-attention keys/values once, for all
+        # temperatures and all best_of samples
+        with torch.no_grad():
+            if audio_features is None:
+                audio_features = model.embed_audio(segment.unsqueeze(0))[0]
+            if cross_attention_cache is None:
+                cross_attention_cache = model.cross_attention_cache(
+                    audio_features[None]
+                )
+
+        if batched_fallback and len(temperatures) > 1:
+            # beam search can't be batched with sampling, so it keeps its own decode
+            if temperatures[0] == 0 and decode_options.get("beam_size") is not None:
+                steps = [temperatures[0], tuple(temperatures[1:])]
             else:
-                # disable best_of when t == 0
-                kwargs.pop("best_of", None)
-
-            options = DecodingOptions(**kwargs, temperature=t)
-            decode_result = model.decode(segment, options)
-
-            needs_fallback = False
-            if (
-                compression_ratio_threshold is not None
-                and decode_result.compression_ratio > compression_ratio_threshold
-            ):
-                needs_fallback = True  # too repetitive
-            if (
-                logprob_threshold is not None
-                and decode_result.avg_logprob < logprob_threshold
-            ):
-                needs_fallback = True  # average log probability is too low
-            if (
-                no_speech_threshold is not None
-                and decode_result.no_speech_prob > no_speech_threshold
-                and logprob_threshold is not None
-                and decode_result.avg_logprob < logprob_threshold
-            ):
-                needs_fallback = False  # silence
-            if not needs_fallback:
-                break
+                steps = [tuple(temperatures)]
+        else:
+            steps = temperatures
+
+        for t in steps:
+            results = model.decode(
+                audio_features, decoding_options(t), cross_attention_cache
+            )
+            for decode_result in results if isinstance(t, tuple) else [results]:
+                if not needs_fallback(decode_result):
+                    return decode_result
 
         return decode_result
 
+    # in batched mode, windows are fixed slices of each clip and are all known up front
+    windows: List[Tuple[int, int]] = [
+        (start, min(N_FRAMES, content_frames - start, clip_end - start))
+        for clip_start, clip_end in seek_clips
+        for start in range(clip_start, min(clip_end, content_frames), N_FRAMES)
+    ]
+    window_index = {start: i for i, (start, _) in enumerate(windows)}
+    batched_results = {}  # window start -> DecodingResult, for windows decoded ahead
+
+    def decode_window_batch(seek: int):
+        """Encode and decode the windows from `seek` onward together, filling `batched_results`"""
+        index = window_index[seek]
+        batch = windows[index : index + batch_size]
+        if decode_options["prompt"] and not carry_initial_prompt:
+            batch = batch[:1]  # the following windows are decoded without the prompt
+
+        mel_segments = torch.stack(
+            [
+                pad_or_trim(mel[:, start : start + size], N_FRAMES)
+                for start, size in batch
+            ]
+        )
+        mel_segments = mel_segments.to(model.device).to(dtype)
+        with torch.no_grad():
+            audio_features = model.embed_audio(mel_segments)
+            cross_attention_cache = model.cross_attention_cache(audio_features)
+        results = model.decode(
+            audio_features, decoding_options(temperatures[0]), cross_attention_cache
+        )
+
+        for i, ((start, _), result) in enumerate(zip(batch, results)):
+            if len(temperatures) > 1 and needs_fallback(result):
+                # only the windows that failed are retried, one at a time, reusing their
+                # audio features and cross-attention keys/values
+                result = decode_with_fallback(
+                    mel_segments[i],
+                    temperatures[1:],
+                    result.audio_features,
+                    {
+                        module: kv[i : i + 1]
+                        for module, kv in cross_attention_cache.items()
+                    },
+                )
+            batched_results[start] = result
+
     clip_idx = 0
     seek = seek_clips[clip_idx][0]
     input_stride = exact_div(
@@ -262,7 +387,9 @@ def transcribe(
 
     # show the progress bar when verbose is False (if True, transcribed text will be printed)
     with tqdm.tqdm(
-        total=content_frames, unit="frames", disable=verbose is not False
+        total=None if streaming_mel and not mel.ended else content_frames,
+        unit="frames",
+        disable=verbose is not False,
     ) as pbar:
         last_speech_timestamp = 0.0
         # NOTE: This loop is obscurely flattened to make the diff readable.
@@ -273,6 +400,13 @@ def transcribe(
             seek_clip_start, seek_clip_end = seek_clips[clip_idx]
             if seek < seek_clip_start:
                 seek = seek_clip_start
+            if streaming_mel:
+                # a window ahead, so that the end of the recording is known when it is near
+                content_frames = mel.read(seek + 2 * N_FRAMES)
+                content_duration = float(content_frames * HOP_LENGTH / SAMPLE_RATE)
+                if mel.ended:
+                    seek_clip_end = min(seek_clip_end, content_frames)
+                    pbar.total = content_frames
             if seek >= seek_clip_end:
                 clip_idx += 1
                 if clip_idx < len(seek_clips):
@@ -281,7 +415,10 @@ def transcribe(
             time_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
             window_end_time = float((seek + N_FRAMES) * HOP_LENGTH / SAMPLE_RATE)
             segment_size = min(N_FRAMES, content_frames - seek, seek_clip_end - seek)
-            mel_segment = mel[:, seek : seek + segment_size]
+            if streaming_mel:
+                mel_segment = mel.window(seek, segment_size)
+            else:
+                mel_segment = mel[:, seek : seek + segment_size]
             segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
             mel_segment = pad_or_trim(mel_segment, N_FRAMES).to(model.device).to(dtype)
 
@@ -292,7 +429,12 @@ def transcribe(
             else:
                 decode_options["prompt"] = all_tokens[prompt_reset_since:]
 
-            result: DecodingResult = decode_with_fallback(mel_segment)
+            if batch_size > 1:
+                if seek not in batched_results:
+                    decode_window_batch(seek)
+                result: DecodingResult = batched_results.pop(seek)
+            else:
+                result: DecodingResult = decode_with_fallback(mel_segment)
             tokens = torch.tensor(result.tokens)
 
             if no_speech_threshold is not None:
@@ -336,81 +478,53 @@ def transcribe(
             def next_words_segment(segments: List[dict]) -> Optional[dict]:
                 return next((s for s in segments if s["words"]), None)
 
-            timestamp_tokens: torch.Tensor = tokens.ge(tokenizer.timestamp_begin)
-            single_timestamp_ending = timestamp_tokens[-2:].tolist() == [False, True]
-
-            consecutive = torch.where(timestamp_tokens[:-1] & timestamp_tokens[1:])[0]
-            consecutive.add_(1)
-            if len(consecutive) > 0:
-                # if the output contains two consecutive timestamp tokens
-                slices = consecutive.tolist()
-                if single_timestamp_ending:
-                    slices.append(len(tokens))
-
-                last_slice = 0
-                for current_slice in slices:
-                    sliced_tokens = tokens[last_slice:current_slice]
-                    start_timestamp_pos = (
-                        sliced_tokens[0].item() - tokenizer.timestamp_begin
-                    )
-                    end_timestamp_pos = (
-                        sliced_tokens[-1].item() - tokenizer.timestamp_begin
-                    )
-                    current_segments.append(
-                        new_segment(
-                            start=time_offset + start_timestamp_pos * time_precision,
-                            end=time_offset + end_timestamp_pos * time_precision,
-                            tokens=sliced_tokens,
-                            result=result,
-                        )
-                    )
-                    last_slice = current_slice
-
-                if single_timestamp_ending:
-                    # single timestamp at the end means no speech after the last timestamp.
-                    seek += segment_size
-                else:
-                    # otherwise, ignore the unfinished segment and seek to the last timestamp
-                    last_timestamp_pos = (
-                        tokens[last_slice - 1].item() - tokenizer.timestamp_begin
-                    )
-                    seek += last_timestamp_pos * input_stride
-            else:
-                duration = segment_duration
-                timestamps = tokens[timestamp_tokens.nonzero().flatten()]
-                if (
-                    len(timestamps) > 0
-                    and timestamps[-1].item() != tokenizer.timestamp_begin
-                ):
-                    # no consecutive timestamps but it has a timestamp; use the last one.
-                    last_timestamp_pos = (
-                        timestamps[-1].item() - tokenizer.timestamp_begin
+            timestamp_tokens: torch.Tensor = tokens[-2:].ge(tokenizer.timestamp_begin)
+            single_timestamp_ending = timestamp_tokens.tolist() == [False, True]
+
+            slices, last_timestamp_pos = split_segments(
+                tokens, tokenizer.timestamp_begin, time_precision, segment_duration
+            )
+            for start, end, sliced_tokens in slices:
+                current_segments.append(
+                    new_segment(
+                        start=time_offset + start,
+                        end=time_offset + end,
+                        tokens=sliced_tokens,
+                        result=result,
                     )
-                    duration = last_timestamp_pos * time_precision
+                )
 
+            if last_timestamp_pos is None:
+                seek += segment_size
+            elif batch_size > 1:
+                # windows are fixed; keep the unfinished segment up to the window's end
+                consumed = sum(len(sliced) for _, _, sliced in slices)
                 current_segments.append(
                     new_segment(
-                        start=time_offset,
-                        end=time_offset + duration,
-                        tokens=tokens,
+                        start=time_offset + last_timestamp_pos * time_precision,
+                        end=time_offset + segment_duration,
+                        tokens=tokens[consumed:],
                         result=result,
                     )
                 )
                 seek += segment_size
+            else:
+                # ignore the unfinished segment and seek to the last timestamp
+                seek += last_timestamp_pos * input_stride
 
             if word_timestamps:
                 add_word_timestamps(
                     segments=current_segments,
                     model=model,
                     tokenizer=tokenizer,
-                    mel=mel_segment,
+                    mel=result.audio_features,
                     num_frames=segment_size,
                     prepend_punctuations=prepend_punctuations,
                     append_punctuations=append_punctuations,
                     last_speech_timestamp=last_speech_timestamp,
                 )
 
-                if not single_timestamp_ending:
+                if not single_timestamp_ending and batch_size == 1:
                     last_word_end = get_end(current_segments)
                     if last_word_end is not None and last_word_end > time_offset:
                         seek = round(last_word_end * FRAMES_PER_SECOND)
@@ -514,6 +628,82 @@ def transcribe(
     )
 
 
+def split_segments(
+    tokens: torch.Tensor,
+    timestamp_begin: int,
+    time_precision: float,
+    segment_duration: float,
+) -> Tuple[List[Tuple[float, float, torch.Tensor]], Optional[int]]:
+    """
+    Split the tokens decoded from one window into timestamped segments
+
+    Parameters
+    ----------
+    tokens: torch.Tensor
+        The sampled tokens of the window, without the SOT sequence
+
+    timestamp_begin: int
+        The token id of the first timestamp token, `<|0.00|>`
+
+    time_precision: float
+        The duration of one timestamp step, in seconds
+
+    segment_duration: float
+        The duration of the audio in the window, in seconds
+
+    Returns
+    -------
+    segments: List[Tuple[float, float, torch.Tensor]]
+        (start, end, tokens) of each complete segment, in seconds from the start of the window
+
+    last_timestamp_pos: Optional[int]
+        If the window ends in an unfinished segment, the position of the last timestamp token
+        before it, where decoding of the next window should resume; None if the whole window
+        was consumed. The tokens of the unfinished segment are not part of `segments`.
+    """
+    timestamp_tokens: torch.Tensor = tokens.ge(timestamp_begin)
+    single_timestamp_ending = timestamp_tokens[-2:].tolist() == [False, True]
+
+    consecutive = torch.where(timestamp_tokens[:-1] & timestamp_tokens[1:])[0]
+    consecutive.add_(1)
+    if len(consecutive) > 0:
+        # if the output contains two consecutive timestamp tokens
+        slices = consecutive.tolist()
+        if single_timestamp_ending:
+            slices.append(len(tokens))
+
+        segments = []
+        last_slice = 0
+        for current_slice in slices:
+            sliced_tokens = tokens[last_slice:current_slice]
+            start_timestamp_pos = sliced_tokens[0].item() - timestamp_begin
+            end_timestamp_pos = sliced_tokens[-1].item() - timestamp_begin
+            segments.append(
+                (
+                    start_timestamp_pos * time_precision,
+                    end_timestamp_pos * time_precision,
+                    sliced_tokens,
+                )
+            )
+            last_slice = current_slice
+
+        if single_timestamp_ending:
+            # single timestamp at the end means no speech after the last timestamp.
+            return segments, None
+
+        last_timestamp_pos = tokens[last_slice - 1].item() - timestamp_begin
+        return segments, last_timestamp_pos
+
+    duration = segment_duration
+    timestamps = tokens[timestamp_tokens.nonzero().flatten()]
+    if len(timestamps) > 0 and timestamps[-1].item() != timestamp_begin:
+        # no consecutive timestamps but it has a timestamp; use the last one.
+        last_timestamp_pos = timestamps[-1].item() - timestamp_begin
+        duration = last_timestamp_pos * time_precision
+
+    return [(0.0, duration, tokens)], None
+
+
 def cli():
     from . import available_models
 
@@ -549,6 +739,7 @@ def cli():
 
     parser.add_argument("--condition_on_previous_text", type=str2bool, default=True, help="if True, provide the previous output of the model as a prompt for the next window; disabling may make the text inconsistent across windows, but the model becomes less prone to getting stuck in a failure loop")
     parser.add_argument("--fp16", type=str2bool, default=True, help="whether to perform inference in fp16; True by default")
+    parser.add_argument("--static_kv_cache", type=str2bool, default=False, help="whether to preallocate the decoder's key/value cache and update it in place instead of growing it every token")
 
     parser.add_argument("--temperature_increment_on_fallback", type=optional_float, default=0.2, help="temperature to increase when falling back when the decoding fails to meet either of the thresholds below")
     parser.add_argument("--compression_ratio_threshold", type=optional_float, default=2.4, help="if the gzip compression ratio is higher than this value, treat the decoding as failed")
@@ -564,6 +755,10 @@ def cli():
     parser.add_argument("--threads", type=optional_int, default=0, help="number of threads used by torch for CPU inference; supercedes MKL_NUM_THREADS/OMP_NUM_THREADS")
     parser.add_argument("--clip_timestamps", type=str, default="0", help="comma-separated list start,end,start,end,... timestamps (in seconds) of clips to process, where the last end timestamp defaults to the end of the file")
     parser.add_argument("--hallucination_silence_threshold", type=optional_float, help="(requires --word_timestamps True) skip silent periods longer than this threshold (in seconds) when a possible hallucination is detected")
+    parser.add_argument("--batch_size", type=int, default=1, help="(requires --condition_on_previous_text False) number of fixed 30-second windows to encode and decode together")
+    parser.add_argument("--batched_fallback", type=str2bool, default=False, help="whether to decode each window at all fallback temperatures in one batch, keeping the lowest temperature that passes the thresholds")
+    parser.add_argument("--streaming_mel", type=str2bool, default=False, help="whether to compute the log-Mel spectrogram window by window while transcribing, keeping memory bounded for long recordings")
+    parser.add_argument("--decode_workers", type=int, default=1, help="number of audio files decoded by ffmpeg in the background while earlier ones are transcribed; 0 decodes each file in the main thread when it is transcribed")
     # fmt: on
 
     args = parser.parse_args().__dict__
@@ -590,6 +785,9 @@ def cli():
     if (threads := args.pop("threads")) > 0:
         torch.set_num_threads(threads)
 
+    if (decode_workers := args.pop("decode_workers")) < 0:
+        parser.error("--decode_workers must be 0 or more")
+
     from . import load_model
 
     model = load_model(model_name, device=device, download_root=model_dir)
@@ -610,13 +808,22 @@ def cli():
     if args["max_words_per_line"] and args["max_line_width"]:
         warnings.warn("--max_words_per_line has no effect with --max_line_width")
     writer_args = {arg: args.pop(arg) for arg in word_options}
-    for audio_path in args.pop("audio"):
-        try:
-            result = transcribe(model, audio_path, temperature=temperature, **args)
-            writer(result, audio_path, **writer_args)
-        except Exception as e:
-            traceback.print_exc()
-            print(f"Skipping {audio_path} due to {type(e).__name__}: {str(e)}")
+    audio_paths = args.pop("audio")
+    with AudioDecoder(max(decode_workers, 1)) as decoder:
+        # with --streaming_mel, or --decode_workers 0, transcribe() decodes each file as it
+        # goes instead
+        ahead = 0 if args["streaming_mel"] else decode_workers
+        decoding = deque(decoder.submit(path) for path in audio_paths[:ahead])
+        for i, audio_path in enumerate(audio_paths):
+            if ahead and i + ahead < len(audio_paths):
+                decoding.append(decoder.submit(audio_paths[i + ahead]))
+            try:
+                audio = decoding.popleft().result() if ahead else audio_path
+                result = transcribe(model, audio, temperature=temperature, **args)
+                writer(result, audio_path, **writer_args)
+            except Exception as e:
+                traceback.print_exc()
+                print(f"Skipping {audio_path} due to {type(e).__name__}: {str(e)}")
 
 
 if __name__ == "__main__":